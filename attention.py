@@ -0,0 +1,196 @@
+import inspect
+from functools import partial
+from typing import List, Optional
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+"""
+Label-wise attention, optionally with the MeSH mask.
+
+The masked models computed
+    atten_mask = label_feature.transpose(0, 1) * mask.unsqueeze(1)     # (bs, dim, num_labels)
+    alpha = torch.softmax(torch.matmul(inputs, atten_mask), dim=1)
+    features = torch.matmul(inputs.transpose(1, 2), alpha).transpose(1, 2)
+which copies the whole label matrix for every document (and again for its gradient).
+``masked_label_attention`` applies the mask to the attention scores instead,
+softmax(inputs @ label_feature.T * mask), the same values for a 0/1 mask, and its hand-written backward
+only keeps the attention weights, so no (bs, dim, num_labels) tensor is built in either direction.
+
+The attention features are still (bs, num_labels, dim) per channel. ``chunked_label_scores`` goes
+through the labels in blocks instead: each block does the attention and the read-out to one score per
+label, and only the (bs, num_labels) scores are kept. With autograd each block is checkpointed and
+recomputed in backward, so only one block's intermediates are alive at a time.
+``checkpoint_stage`` does the same for a whole stage of a model (e.g. the attention of one channel).
+
+``candidate_label_scores`` only scores the labels inside each document's MeSH mask: the candidate
+label features are gathered per document, and the scores are scattered back into a dense
+(bs, num_labels) matrix with ``fill`` at the masked-out labels. Its cost grows with the mask size
+instead of the label space.
+
+Under bf16 autocast the matmuls run in bfloat16 but the attention softmax (and its backward) stays in
+fp32, see ``fp32_softmax``.
+"""
+
+CANDIDATE_FILL = -10.
+
+
+def fp32_softmax(scores, dim):
+    # type: (Tensor, int) -> Tensor
+    """ Softmax computed in at least fp32, whatever the (autocast) dtype of the scores """
+    return torch.softmax(scores, dim=dim, dtype=torch.promote_types(scores.dtype, torch.float32))
+
+
+def masked_attention_weights(inputs, label_feature, mask):
+    """ softmax(inputs @ label_feature.T * mask) over the sequence, (bs, seq_len, num_labels) """
+    scores = torch.matmul(inputs, label_feature.t())  # (bs, seq_len, num_labels)
+    scores.mul_(mask.unsqueeze(1))
+    return fp32_softmax(scores, dim=1)
+
+
+class MaskedLabelAttention(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, inputs, label_feature, mask):
+        alpha = masked_attention_weights(inputs, label_feature, mask)
+        ctx.save_for_backward(inputs, label_feature, mask, alpha)
+        return torch.matmul(alpha.transpose(1, 2), inputs)  # (bs, num_labels, dim)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        inputs, label_feature, mask, alpha = ctx.saved_tensors
+        grad_inputs = grad_label = None
+        # under autocast the forward matmuls ran in grad_output's dtype, the backward ones do too
+        dtype = grad_output.dtype
+        inputs, label_feature = inputs.to(dtype), label_feature.to(dtype)
+
+        grad_scores = torch.matmul(inputs, grad_output.transpose(1, 2))  # d alpha, (bs, seq_len, num_labels)
+        # softmax over the sequence dimension (in the dtype of alpha), then the mask
+        grad_scores = grad_scores.to(alpha.dtype)
+        grad_scores.sub_((grad_scores * alpha).sum(dim=1, keepdim=True)).mul_(alpha).mul_(mask.unsqueeze(1))
+        grad_scores = grad_scores.to(dtype)
+        if ctx.needs_input_grad[0]:
+            grad_inputs = torch.matmul(alpha.to(dtype), grad_output) + torch.matmul(grad_scores, label_feature)
+        if ctx.needs_input_grad[1]:
+            grad_label = torch.matmul(grad_scores.transpose(1, 2), inputs).sum(dim=0)
+        return grad_inputs, grad_label, None
+
+
+def masked_label_attention(inputs, label_feature, mask):
+    """
+    Arguments:
+        inputs: document features, (bs, seq_len, dim).
+        label_feature: label features, (num_labels, dim).
+        mask: 0/1 MeSH mask, (bs, num_labels).
+    Returns:
+        label-wise document features, (bs, num_labels, dim).
+    """
+    mask = mask.to(inputs.dtype)
+    if torch.jit.is_scripting() or torch.jit.is_tracing() or not torch.is_grad_enabled():
+        # the hand-written backward is only needed with autograd, the exported graphs use the plain ops
+        return torch.matmul(masked_attention_weights(inputs, label_feature, mask).transpose(1, 2), inputs)
+    return MaskedLabelAttention.apply(inputs, label_feature, mask)
+
+
+def label_attention(inputs, label_feature, mask=None):
+    # type: (Tensor, Tensor, Optional[Tensor]) -> Tensor
+    """ Label-wise attention features (bs, num_labels, dim), masked if a MeSH mask is given """
+    if mask is not None:
+        return masked_label_attention(inputs, label_feature, mask)
+    alpha = fp32_softmax(torch.matmul(inputs, label_feature.transpose(0, 1)), dim=1)
+    return torch.matmul(inputs.transpose(1, 2), alpha).transpose(1, 2)
+
+
+def label_dot_scores(start, end, label_feature, mask, *channels):
+    """
+    Scores of labels start..end: the attention features of all channels (e.g. title and abstract) summed
+    and dotted with the label features, (bs, end - start).
+    """
+    label_feature = label_feature[start:end]
+    mask = mask[:, start:end] if mask is not None else None
+    return label_scores(label_feature, mask, list(channels))
+
+
+def label_scores(label_feature, mask, channels):
+    # type: (Tensor, Optional[Tensor], List[Tensor]) -> Tensor
+    """ ``label_dot_scores`` of all labels of ``label_feature``, with the channels as a list (TorchScript) """
+    x_feature = label_attention(channels[0], label_feature, mask)
+    for inputs in channels[1:]:
+        x_feature = x_feature + label_attention(inputs, label_feature, mask)
+    return torch.sum(x_feature * label_feature, dim=2)
+
+
+def _checkpoint(function, *inputs):
+    # torch >= 1.11 checkpoints without the reentrant backward (which also works with torch.autograd.grad),
+    # newer torch warns when the mode is not given
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters:
+        return checkpoint(function, *inputs, use_reentrant=False)
+    return checkpoint(function, *inputs)
+
+
+def chunked_label_scores(score_fn, num_labels, chunk_size, *inputs):
+    """
+    Arguments:
+        score_fn: ``score_fn(start, end, *inputs)`` returns the (bs, end - start) scores of labels start..end.
+        num_labels: size of the label dimension.
+        chunk_size: labels per block, 0 computes all labels at once.
+        inputs: tensors (or None) passed to ``score_fn``. Every tensor the scores depend on, apart from
+                module parameters, must be passed here for the gradients to reach it.
+    Returns:
+        (bs, num_labels) scores.
+    """
+    if not chunk_size or chunk_size >= num_labels:
+        return score_fn(0, num_labels, *inputs)
+    blocks = []
+    for start in range(0, num_labels, chunk_size):
+        block_fn = partial(score_fn, start, min(start + chunk_size, num_labels))
+        if torch.is_grad_enabled():
+            blocks.append(_checkpoint(block_fn, *inputs))
+        else:
+            blocks.append(block_fn(*inputs))
+    return torch.cat(blocks, dim=1)
+
+
+def checkpoint_stage(stages, name, function, *inputs):
+    """
+    ``function(*inputs)``, checkpointed if the stage ``name`` is in ``stages`` and autograd is on: its
+    intermediate activations are recomputed in backward instead of kept. Before torch 1.11 (reentrant
+    checkpointing only) at least one of ``inputs`` must require grad for the gradients to reach the
+    parameters used by ``function``.
+    """
+    if name in stages and torch.is_grad_enabled():
+        return _checkpoint(function, *inputs)
+    return function(*inputs)
+
+
+def candidate_indices(mask):
+    """
+    Label indices inside each document's mask, (bs, num_candidates) with num_candidates the largest
+    mask of the batch, and whether each entry is a candidate (shorter masks are padded).
+    """
+    num_candidates = int((mask > 0).sum(dim=1).max()) if mask.shape[0] else 0
+    values, indices = mask.topk(num_candidates, dim=1, sorted=False)
+    return indices, values > 0
+
+
+def candidate_label_scores(label_feature, mask, channels, fill=CANDIDATE_FILL):
+    """
+    Arguments:
+        label_feature: label features, (num_labels, dim).
+        mask: 0/1 MeSH mask, (bs, num_labels).
+        channels: document features of each channel, (bs, seq_len, dim).
+        fill: score of the labels outside the mask.
+    Returns:
+        (bs, num_labels) scores, the same as ``label_dot_scores`` with the mask inside the mask.
+    """
+    indices, valid = candidate_indices(mask)
+    candidates = label_feature[indices]  # (bs, num_candidates, dim)
+    x_feature = 0
+    for inputs in channels:
+        alpha = fp32_softmax(torch.matmul(inputs, candidates.transpose(1, 2)), dim=1)  # (bs, seq_len, num_candidates)
+        x_feature = x_feature + torch.matmul(alpha.transpose(1, 2), inputs)
+    scores = torch.sum(x_feature * candidates, dim=2)  # (bs, num_candidates)
+
+    rows = torch.arange(mask.shape[0], device=mask.device).unsqueeze(1).expand_as(indices)
+    dense = scores.new_full(mask.shape, fill)
+    return dense.index_put((rows[valid], indices[valid]), scores[valid])
@@ -0,0 +1,305 @@
+import argparse
+import gc
+import multiprocessing
+import pickle
+import random
+import threading
+import time
+
+import numpy as np
+import psutil
+import torch
+from torch.utils.data import DataLoader
+from sklearn.preprocessing import MultiLabelBinarizer
+from torchtext.data.utils import get_tokenizer
+
+from prefetch import BatchPrefetcher
+from utils import CompactMultiLabelDataset, MultiLabelTextClassificationDataset, densify, generate_batch, \
+    label_offsets, normalize_batch, pad_batch, pad_sequence, stop_words, table
+
+"""
+Benchmarks of the data pipeline. Speed benchmarks first check that the fast path gives the same
+output as the reference implementation, then report throughput.
+
+    python benchmark_data.py --bench normalizer --abstract_path abstracts.pkl
+    python benchmark_data.py --bench dataset_memory --num_docs 200000 --num_workers 8
+    python benchmark_data.py --bench labels --num_labels 29368 --batch_sz 32
+    python benchmark_data.py --bench padding --batch_sz 32
+    python benchmark_data.py --bench prefetch --num_docs 8000 --num_workers 0
+"""
+
+
+def _synthetic_corpus(num_docs, seed=0):
+    words = ('the expression of the gene (p53) in mouse liver cells, was increased; '
+             'patients\' x-ray "results" showed 3 tumors! <br /> were they benign? e.g. no: '
+             'Protein-binding assays in vitro').split()
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(50, 400))) for _ in range(num_docs)]
+
+
+def _load_corpus(args):
+    if args.abstract_path is not None:
+        texts = pickle.load(open(args.abstract_path, 'rb'))
+        return list(texts[:args.num_docs])
+    return _synthetic_corpus(args.num_docs)
+
+
+def reference_text_clean(texts):
+    """ basic_english tokenization followed by the former chained text_clean """
+    tokenizer = get_tokenizer('basic_english')
+    cleaned = []
+    for text in texts:
+        tokens = tokenizer(text)
+        stripped = [w.translate(table) for w in tokens]  # remove punctuation
+        clean_tokens = [w for w in stripped if w.isalpha()]  # remove non alphabetic tokens
+        text_nostop = [word for word in clean_tokens if word not in stop_words]  # remove stopwords
+        filtered_text = [w for w in text_nostop if len(w) > 1]  # remove single character token
+        cleaned.append(filtered_text)
+    return cleaned
+
+
+def _time(fn, texts, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(texts)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_normalizer(args):
+    texts = _load_corpus(args)
+    expected = reference_text_clean(texts)
+    result = normalize_batch(texts)
+    mismatches = sum(1 for a, b in zip(expected, result) if a != b)
+    print('token-for-token mismatches: %d / %d documents' % (mismatches, len(texts)))
+    if mismatches:
+        raise SystemExit(1)
+
+    num_chars = sum(len(text) for text in texts)
+    for name, fn in (('reference', reference_text_clean), ('normalize_batch', normalize_batch)):
+        seconds = _time(fn, texts, args.repeat)
+        print('%-16s %8.3fs  %10.0f docs/s  %6.1f MB/s' % (name, seconds, len(texts) / seconds,
+                                                          num_chars / seconds / 1e6))
+
+
+def _synthetic_data(num_docs, seed=0):
+    """ Tokenized documents shaped like the PubMed corpus: (label, mask, ab_tokens, title_tokens) """
+    rng = np.random.RandomState(seed)
+    data = []
+    for _ in range(num_docs):
+        label = rng.randint(0, 29000, size=rng.randint(5, 20)).tolist()
+        mask = rng.randint(0, 29000, size=rng.randint(100, 400)).tolist()
+        abstract = torch.from_numpy(rng.randint(2, 120000, size=rng.randint(50, 400)))
+        title = torch.from_numpy(rng.randint(2, 120000, size=rng.randint(5, 30)))
+        data.append((label, mask, abstract, title))
+    return data
+
+
+def _memory(processes):
+    rss, pss = 0, 0
+    for process in processes:
+        try:
+            info = process.memory_full_info()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        rss += info.rss
+        pss += getattr(info, 'pss', info.rss)
+    return rss, pss
+
+
+def _collate(batch):
+    label = [entry[0] for entry in batch]
+    mesh_mask = [entry[1] for entry in batch]
+    abstract = pad_sequence([entry[2] for entry in batch], ksz=3, batch_first=True)
+    title = pad_sequence([entry[3] for entry in batch], ksz=3, batch_first=True)
+    return label, mesh_mask, abstract, title
+
+
+def _measure_dataset(name, num_docs, num_workers, batch_sz, epochs, queue):
+    process = psutil.Process()
+    gc.collect()
+    before = process.memory_info().rss
+    data = _synthetic_data(num_docs)
+    dataset = MultiLabelTextClassificationDataset(None, data, None)
+    if name == 'compact':
+        dataset = CompactMultiLabelDataset.from_dataset(dataset)
+        del data
+    gc.collect()
+    if name == 'compact':
+        # the freed tuples stay in the allocator's arenas, so count the arrays themselves
+        bytes_per_doc = dataset.nbytes() / num_docs
+    else:
+        bytes_per_doc = (process.memory_info().rss - before) / num_docs
+
+    peak = [0, 0]
+    done = threading.Event()
+
+    def _sample():
+        while not done.is_set():
+            rss, pss = _memory([process] + process.children(recursive=True))
+            peak[0], peak[1] = max(peak[0], rss), max(peak[1], pss)
+            time.sleep(0.1)
+
+    sampler = threading.Thread(target=_sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    loader = DataLoader(dataset, batch_size=batch_sz, shuffle=True, collate_fn=_collate, num_workers=num_workers)
+    for _ in range(epochs):
+        for _ in loader:
+            pass
+    seconds = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    queue.put((name, bytes_per_doc, peak[0], peak[1], seconds))
+
+
+def bench_dataset_memory(args):
+    """ Memory of MultiLabelTextClassificationDataset vs CompactMultiLabelDataset while DataLoader workers read it """
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    print('%d documents, %d workers, %d epoch(s)' % (args.num_docs, args.num_workers, args.epochs))
+    print('%-8s %14s %16s %16s %10s' % ('dataset', 'bytes/doc', 'peak RSS (MB)', 'peak PSS (MB)', 'time (s)'))
+    for name in ('tuples', 'compact'):
+        # each variant runs in its own process so the measurements do not share a heap
+        process = ctx.Process(target=_measure_dataset,
+                              args=(name, args.num_docs, args.num_workers, args.batch_sz, args.epochs, queue))
+        process.start()
+        name, bytes_per_doc, rss, pss, seconds = queue.get()
+        process.join()
+        print('%-8s %14.0f %16.1f %16.1f %10.1f' % (name, bytes_per_doc, rss / 2 ** 20, pss / 2 ** 20, seconds))
+
+
+def bench_labels(args):
+    """ Per-batch label/mask densification: MultiLabelBinarizer on the host vs ``label_offsets`` + ``densify`` """
+    device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
+    mlb = MultiLabelBinarizer(classes=list(range(args.num_labels)))
+    mlb.fit(list(range(args.num_labels)))
+    rng = np.random.RandomState(0)
+    batches = [[rng.randint(0, args.num_labels, size=rng.randint(100, 400)).tolist() for _ in range(args.batch_sz)]
+               for _ in range(args.num_batches)]
+
+    expected = torch.from_numpy(mlb.fit_transform(batches[0])).type(torch.float)
+    result = densify(*label_offsets(batches[0]), args.num_labels, device).cpu()
+    if not torch.equal(expected, result):
+        print('densify does not match MultiLabelBinarizer')
+        raise SystemExit(1)
+
+    def _binarizer(batches):
+        for batch in batches:
+            torch.from_numpy(mlb.fit_transform(batch)).type(torch.float).to(device)
+
+    def _densify(batches):
+        # label_offsets runs in the DataLoader workers, it is timed here as well
+        for batch in batches:
+            densify(*label_offsets(batch), args.num_labels, device)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    print('%d batches of %d documents, %d labels, device %s' % (args.num_batches, args.batch_sz, args.num_labels, device))
+    for name, fn in (('binarizer', _binarizer), ('densify', _densify)):
+        seconds = _time(fn, batches, args.repeat)
+        print('%-10s %8.3fs  %8.2f ms/batch' % (name, seconds, seconds / len(batches) * 1e3))
+
+
+def reference_pad_sequence(sequences, ksz):
+    """ The former row-by-row batch-first pad_sequence """
+    max_len = max(max([s.size(0) for s in sequences]), ksz)
+    dtype = torch.long if sequences[0].dtype == torch.int32 else None
+    out_tensor = sequences[0].new_full((len(sequences), max_len) + sequences[0].size()[1:], 0, dtype=dtype)
+    for i, tensor in enumerate(sequences):
+        out_tensor[i, :tensor.size(0), ...] = tensor
+    return out_tensor
+
+
+def bench_padding(args):
+    """ Padding of the abstract and title channels: the former Python loop vs ``pad_batch`` """
+    data = _synthetic_data(args.batch_sz * args.num_batches)
+    batches = [[(entry[2].int(), entry[3].int()) for entry in data[start:start + args.batch_sz]]
+               for start in range(0, len(data), args.batch_sz)]
+
+    for batch in batches[:20]:
+        for channel in range(2):
+            sequences = [entry[channel] for entry in batch]
+            if not torch.equal(reference_pad_sequence(sequences, 3), pad_batch(sequences, 3)[0]):
+                print('pad_batch does not match the reference')
+                raise SystemExit(1)
+
+    def _reference(batches):
+        for batch in batches:
+            abstract = [entry[0] for entry in batch]
+            title = [entry[1] for entry in batch]
+            reference_pad_sequence(abstract, 3), [len(seq) for seq in abstract]
+            reference_pad_sequence(title, 3), [max(len(seq), 1) for seq in title]
+
+    def _vectorized(batches):
+        for batch in batches:
+            pad_batch([entry[0] for entry in batch], 3)
+            pad_batch([entry[1] for entry in batch], 3, min_length=1)
+
+    print('%d batches of %d documents' % (len(batches), args.batch_sz))
+    for name, fn in (('reference', _reference), ('pad_batch', _vectorized)):
+        seconds = _time(fn, batches, args.repeat)
+        print('%-10s %8.3fs  %8.3f ms/batch' % (name, seconds, seconds / len(batches) * 1e3))
+
+
+def bench_prefetch(args):
+    """ Training loop over a DataLoader with the batch preparation inline vs in a ``BatchPrefetcher`` """
+    device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
+    dataset = MultiLabelTextClassificationDataset(None, _synthetic_data(args.num_docs))
+    loader = DataLoader(dataset, batch_size=args.batch_sz, collate_fn=generate_batch, num_workers=args.num_workers,
+                        pin_memory=device.type == 'cuda')
+    # stands in for the model: a fixed amount of compute per batch
+    weight = torch.randn(args.num_labels // 16, 1024, device=device)
+
+    def _compute(label, abstract):
+        for _ in range(args.compute_steps):
+            torch.matmul(weight, weight.t())
+        return label.sum() + abstract.sum()
+
+    def _inline():
+        start = time.perf_counter()
+        for label, mask, abstract, title, abstract_length, title_length in loader:
+            label = densify(*label, args.num_labels, device)
+            mask = densify(*mask, args.num_labels, device)
+            abstract, title = abstract.to(device), title.to(device)
+            _compute(label, abstract).item()
+        return time.perf_counter() - start, None
+
+    def _prefetched():
+        batches = BatchPrefetcher(loader, args.num_labels, device)
+        start = time.perf_counter()
+        for label, mask, abstract, title, abstract_length, title_length in batches:
+            _compute(label, abstract).item()
+        return time.perf_counter() - start, batches.wait_time
+
+    print('%d batches of %d documents, %d workers, device %s' % (len(loader), args.batch_sz, args.num_workers, device))
+    for name, fn in (('inline', _inline), ('prefetch', _prefetched)):
+        seconds, wait = min((fn() for _ in range(args.repeat)), key=lambda result: result[0])
+        print('%-10s %8.3fs  data wait %s' % (name, seconds, '-' if wait is None else '%.3fs' % wait))
+
+
+BENCHMARKS = {'normalizer': bench_normalizer, 'dataset_memory': bench_dataset_memory, 'labels': bench_labels,
+              'padding': bench_padding, 'prefetch': bench_prefetch}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', choices=sorted(BENCHMARKS), default='normalizer')
+    parser.add_argument('--abstract_path', help='pickled list of abstracts, synthetic documents are used if missing')
+    parser.add_argument('--num_docs', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--batch_sz', type=int, default=32)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--num_labels', type=int, default=29368)
+    parser.add_argument('--num_batches', type=int, default=200)
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--compute_steps', type=int, default=1, help='matmuls per batch standing in for the model')
+    args = parser.parse_args()
+
+    BENCHMARKS[args.bench](args)
+
+
+if __name__ == "__main__":
+    main()
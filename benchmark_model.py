@@ -0,0 +1,468 @@
+import argparse
+import copy
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import psutil
+import torch
+import torch.nn as nn
+
+from attention import candidate_label_scores, chunked_label_scores, label_dot_scores, masked_label_attention
+from export import check_export, example_inputs, export_onnx
+from model import LABEL_FEATURES_KEY, multichannel_dilatedCNN_with_MeSH_mask, rnn_channels
+from onnx_backend import OnnxScorer
+from optimizers import split_adam
+from utils import bf16_autocast
+
+"""
+Benchmarks of the model computations, on synthetic inputs of the KenMeSH shapes. Each variant is
+first checked against the reference implementation, then measured in its own process.
+
+    python benchmark_model.py --bench attention --batch_sizes 2 4 8
+    python benchmark_model.py --bench label_chunk --batch_sizes 4 8 --label_chunks 0 4096 1024
+    python benchmark_model.py --bench candidates --batch_sizes 8 --mask_sizes 200 1000 4000
+    python benchmark_model.py --bench rnn --batch_sizes 16 32 64
+    python benchmark_model.py --bench onnx --batch_sizes 1 4 16 64
+    python benchmark_model.py --bench bf16 --batch_sizes 8 --steps 20
+    python benchmark_model.py --bench checkpoint_stages --batch_sizes 2 4 8
+    python benchmark_model.py --bench sparse_embedding --batch_sizes 8 32 --vocab_size 120000 --steps 6
+"""
+
+
+def reference_masked_label_attention(inputs, label_feature, mask):
+    atten_mask = label_feature.transpose(0, 1) * mask.unsqueeze(1)
+    alpha = torch.softmax(torch.matmul(inputs, atten_mask), dim=1)
+    return torch.matmul(inputs.transpose(1, 2), alpha).transpose(1, 2)
+
+
+ATTENTION = {'reference': reference_masked_label_attention, 'fused': masked_label_attention}
+
+
+def _attention_inputs(args, batch_sz, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    title = torch.randn(batch_sz, args.title_len, args.dim, generator=generator).requires_grad_()
+    abstract = torch.randn(batch_sz, args.abstract_len, args.dim, generator=generator).requires_grad_()
+    label_feature = torch.randn(args.num_labels, args.dim, generator=generator).requires_grad_()
+    mask = (torch.rand(batch_sz, args.num_labels, generator=generator) < args.mask_density).float()
+    return title, abstract, label_feature, mask
+
+
+def _attention_step(attention, title, abstract, label_feature, mask):
+    """ The label-wise attention of multichannel_dilatedCNN_with_MeSH_mask, up to the logits, and its backward """
+    x_feature = attention(title, label_feature, mask) + attention(abstract, label_feature, mask)
+    logits = torch.sum(x_feature * label_feature, dim=2)
+    logits.sum().backward()
+    return logits
+
+
+def _measure_attention(name, args, batch_sz, queue):
+    torch.set_num_threads(args.num_threads)
+    inputs = _attention_inputs(args, batch_sz)
+    before = psutil.Process().memory_info().rss
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        _attention_step(ATTENTION[name], *inputs)
+    seconds = (time.perf_counter() - start) / args.repeat
+    # ru_maxrss is in kB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((peak - before, seconds))
+
+
+def bench_attention(args):
+    """ Peak memory and time of a forward/backward step: masked label matrix vs mask on the scores """
+    small = argparse.Namespace(**vars(args))
+    small.num_labels, small.dim = 500, 16
+    outputs = []
+    for name in sorted(ATTENTION):
+        inputs = [t.double().detach().requires_grad_(t.requires_grad) for t in _attention_inputs(small, 3)]
+        logits = _attention_step(ATTENTION[name], *inputs)
+        outputs.append([logits] + [t.grad for t in inputs[:3]])
+    for a, b in zip(*outputs):
+        assert torch.allclose(a, b, rtol=1e-9, atol=1e-9)
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    print('%d labels, dim %d, title %d, abstract %d tokens, mask density %.2f' %
+          (args.num_labels, args.dim, args.title_len, args.abstract_len, args.mask_density))
+    print('%-10s %6s %16s %10s' % ('attention', 'bs', 'peak extra (MB)', 'step (s)'))
+    for batch_sz in args.batch_sizes:
+        for name in ('reference', 'fused'):
+            process = ctx.Process(target=_measure_attention, args=(name, args, batch_sz, queue))
+            process.start()
+            extra, seconds = queue.get()
+            process.join()
+            print('%-10s %6d %16.1f %10.2f' % (name, batch_sz, extra / 2 ** 20, seconds))
+
+
+def _chunked_step(label_chunk, title, abstract, label_feature, mask):
+    """ Label-wise attention and logits of multichannel_dilatedCNN_with_MeSH_mask, and the backward """
+    logits = chunked_label_scores(label_dot_scores, label_feature.shape[0], label_chunk, label_feature, mask,
+                                  title, abstract)
+    logits.sum().backward()
+    return logits
+
+
+def _measure_label_chunk(label_chunk, args, batch_sz, queue):
+    torch.set_num_threads(args.num_threads)
+    inputs = _attention_inputs(args, batch_sz)
+    before = psutil.Process().memory_info().rss
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        _chunked_step(label_chunk, *inputs)
+    seconds = (time.perf_counter() - start) / args.repeat
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((peak - before, seconds))
+
+
+def bench_label_chunk(args):
+    """ Peak memory and time of a forward/backward step with the labels scored in blocks of --label_chunks """
+    small = argparse.Namespace(**vars(args))
+    small.num_labels, small.dim = 1000, 16
+    for mask in (True, False):
+        outputs = []
+        for label_chunk in (0, 64, 300, 1000):
+            inputs = [t.double().detach().requires_grad_(t.requires_grad) for t in _attention_inputs(small, 3)]
+            if not mask:
+                inputs[3] = None
+            logits = _chunked_step(label_chunk, *inputs)
+            outputs.append([logits] + [t.grad for t in inputs[:3]])
+        for chunked in outputs[1:]:
+            for a, b in zip(outputs[0], chunked):
+                assert torch.allclose(a, b, rtol=1e-9, atol=1e-9)
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    print('%d labels, dim %d, title %d, abstract %d tokens, mask density %.2f' %
+          (args.num_labels, args.dim, args.title_len, args.abstract_len, args.mask_density))
+    print('%-12s %6s %16s %10s' % ('label chunk', 'bs', 'peak extra (MB)', 'step (s)'))
+    for batch_sz in args.batch_sizes:
+        for label_chunk in args.label_chunks:
+            process = ctx.Process(target=_measure_label_chunk, args=(label_chunk, args, batch_sz, queue))
+            process.start()
+            extra, seconds = queue.get()
+            process.join()
+            print('%-12s %6d %16.1f %10.2f' % (label_chunk or 'all', batch_sz, extra / 2 ** 20, seconds))
+
+
+def _candidate_mask(num_labels, batch_sz, mask_size, generator):
+    """ Masks of about mask_size labels per document (between half and all of it) """
+    mask = torch.zeros(batch_sz, num_labels)
+    for row in mask:
+        size = int(mask_size * (0.5 + 0.5 * torch.rand(1, generator=generator).item()))
+        row[torch.randperm(num_labels, generator=generator)[:size]] = 1
+    return mask
+
+
+def _scores(name, title, abstract, label_feature, mask):
+    if name == 'candidates':
+        return candidate_label_scores(label_feature, mask, (title, abstract))
+    return label_dot_scores(0, label_feature.shape[0], label_feature, mask, title, abstract)
+
+
+def bench_candidates(args):
+    """ Scoring time of all labels vs only the labels inside the MeSH mask, eval forward and training step """
+    torch.set_num_threads(args.num_threads)
+    generator = torch.Generator().manual_seed(0)
+    small = argparse.Namespace(**vars(args))
+    small.num_labels, small.dim = 1000, 16
+    title, abstract, label_feature, _ = [t.double() for t in _attention_inputs(small, 3)]
+    mask = _candidate_mask(small.num_labels, 3, 100, generator).double()
+    inside = mask > 0
+    dense, candidates = (_scores(name, title, abstract, label_feature, mask) for name in ('dense', 'candidates'))
+    assert torch.allclose(dense[inside], candidates[inside], rtol=1e-9, atol=1e-9)
+
+    print('%d labels, dim %d, title %d, abstract %d tokens' %
+          (args.num_labels, args.dim, args.title_len, args.abstract_len))
+    print('%-11s %6s %10s %12s %12s' % ('scoring', 'bs', 'mask size', 'eval (s)', 'train (s)'))
+    for batch_sz in args.batch_sizes:
+        title, abstract, label_feature, _ = _attention_inputs(args, batch_sz)
+        for mask_size in args.mask_sizes:
+            mask = _candidate_mask(args.num_labels, batch_sz, mask_size, generator)
+            for name in ('dense', 'candidates'):
+                start = time.perf_counter()
+                with torch.no_grad():
+                    for _ in range(args.repeat):
+                        _scores(name, title, abstract, label_feature, mask)
+                eval_seconds = (time.perf_counter() - start) / args.repeat
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    _scores(name, title, abstract, label_feature, mask).sum().backward()
+                train_seconds = (time.perf_counter() - start) / args.repeat
+                print('%-11s %6d %10d %12.3f %12.3f' % (name, batch_sz, mask_size, eval_seconds, train_seconds))
+
+
+def _rnn_inputs(args, batch_sz, generator):
+    title_length = torch.randint(args.title_len // 4, args.title_len + 1, (batch_sz,), generator=generator)
+    ab_length = torch.randint(args.abstract_len // 4, args.abstract_len + 1, (batch_sz,), generator=generator)
+    title = torch.randn(batch_sz, int(title_length.max()), args.embedding_dim, generator=generator)
+    abstract = torch.randn(batch_sz, int(ab_length.max()), args.embedding_dim, generator=generator)
+    return (title.requires_grad_(), abstract.requires_grad_()), (title_length, ab_length)
+
+
+def bench_rnn(args):
+    """ BiLSTM step (forward and backward) over title and abstract: one packed call per channel vs one for both """
+    torch.set_num_threads(args.num_threads)
+    generator = torch.Generator().manual_seed(0)
+    rnn = nn.LSTM(input_size=args.embedding_dim, hidden_size=args.embedding_dim, num_layers=2, bidirectional=True,
+                  batch_first=True)
+    embedded, lengths = _rnn_inputs(args, 4, generator)
+    outputs = [rnn_channels(rnn, embedded, lengths, fused) for fused in (False, True)]
+    for a, b in zip(*outputs):
+        assert a.shape == b.shape and torch.allclose(a, b, atol=1e-6)
+
+    print('BiLSTM %d -> 2x%d, 2 layers, title up to %d, abstract up to %d tokens' %
+          (args.embedding_dim, args.embedding_dim, args.title_len, args.abstract_len))
+    print('%-9s %6s %12s' % ('calls', 'bs', 'step (ms)'))
+    for batch_sz in args.batch_sizes:
+        embedded, lengths = _rnn_inputs(args, batch_sz, generator)
+        for fused in (False, True):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                title, abstract = rnn_channels(rnn, embedded, lengths, fused)
+                (title.sum() + abstract.sum()).backward()
+            seconds = (time.perf_counter() - start) / args.repeat
+            print('%-9s %6d %12.1f' % ('single' if fused else 'separate', batch_sz, seconds * 1000))
+
+
+def bench_onnx(args):
+    """ Latency and throughput of the Full model, eager PyTorch vs ONNX Runtime, with the label features frozen in """
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    model = multichannel_dilatedCNN_with_MeSH_mask(args.vocab_size, 0.2, 3, args.num_labels, None, 'cpu',
+                                                   embedding_dim=args.embedding_dim)
+    state_dict = model.state_dict()
+    state_dict[LABEL_FEATURES_KEY] = torch.randn(args.num_labels, args.embedding_dim * 2) / args.embedding_dim ** 0.5
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.onnx')
+        export_onnx(model, state_dict[LABEL_FEATURES_KEY], path)
+        difference = check_export(model, None, path, 'onnx')
+        scorer = OnnxScorer(path, args.num_threads)
+
+        print('%d labels, embedding dim %d, title %d, abstract %d tokens, %d threads, max score difference %.2g' %
+              (args.num_labels, args.embedding_dim, args.title_len, args.abstract_len, args.num_threads, difference))
+        print('%-9s %6s %12s %10s' % ('runtime', 'bs', 'batch (ms)', 'docs/s'))
+        for batch_sz in args.batch_sizes:
+            inputs = example_inputs(args.vocab_size, args.num_labels, batch_sz, args.title_len, args.abstract_len)
+            for name, forward in (('eager', lambda *x: model(*x, None, None)), ('onnx', scorer)):
+                with torch.no_grad():
+                    forward(*inputs)
+                    start = time.perf_counter()
+                    for _ in range(args.repeat):
+                        forward(*inputs)
+                seconds = (time.perf_counter() - start) / args.repeat
+                print('%-9s %6d %12.1f %10.1f' % (name, batch_sz, seconds * 1000, batch_sz / seconds))
+
+
+def _training_model(args, **kwargs):
+    """ Full model of the benchmark sizes, trained with fixed label features (the label graph is left out) """
+    torch.manual_seed(0)
+    model = multichannel_dilatedCNN_with_MeSH_mask(args.vocab_size, 0., 3, args.num_labels, None, 'cpu',
+                                                   embedding_dim=args.embedding_dim, **kwargs)
+    label_feature = (torch.randn(args.num_labels, args.embedding_dim * 2) / args.embedding_dim ** 0.5).requires_grad_()
+    model.label_features = lambda g, g_node_feature: label_feature
+    return model
+
+
+def _train_steps(model, batches, bf16=False, optimizer=None):
+    """
+    Adam (or ``optimizer``) steps of the Full model over fixed batches, returns the losses, the mean step
+    time and the mean time of the optimizer update
+    """
+    optimizer = optimizer or torch.optim.Adam(model.parameters(), lr=1e-3)
+    criterion = nn.BCEWithLogitsLoss()
+    losses, seconds, update_seconds = [], 0., 0.
+    model.train()
+    for label, inputs in batches:
+        start = time.perf_counter()
+        with bf16_autocast(bf16, 'cpu'):
+            output = model(*inputs, None, None)
+        loss = criterion(output.float(), label)
+        loss.backward()
+        update = time.perf_counter()
+        optimizer.step()
+        optimizer.zero_grad()
+        update_seconds += time.perf_counter() - update
+        seconds += time.perf_counter() - start
+        losses.append(loss.item())
+    return losses, seconds / len(batches), update_seconds / len(batches)
+
+
+def _training_batches(args, batch_sz):
+    """ --steps batches cycling through --subset fixed ones """
+    batches = []
+    for step in range(args.steps):
+        inputs = example_inputs(args.vocab_size, args.num_labels, batch_sz, args.title_len, args.abstract_len,
+                                seed=step % args.subset)
+        # labels inside the mask, so the loss has something to learn
+        label = inputs[2] * (torch.rand(inputs[2].shape, generator=torch.Generator().manual_seed(step % args.subset)) < 0.1)
+        batches.append((label, inputs))
+    return batches
+
+
+def bench_bf16(args):
+    """ Training loss curve and step time of the Full model, fp32 vs bf16 autocast, from the same weights and batches """
+    torch.set_num_threads(args.num_threads)
+    model = _training_model(args)
+
+    results = {}
+    for batch_sz in args.batch_sizes:
+        batches = _training_batches(args, batch_sz)
+        for bf16 in (False, True):
+            results[batch_sz, bf16] = _train_steps(copy.deepcopy(model), batches, bf16)
+
+    print('%d labels, embedding dim %d, title %d, abstract %d tokens, %d threads, %d steps over %d fixed batches' %
+          (args.num_labels, args.embedding_dim, args.title_len, args.abstract_len, args.num_threads, args.steps,
+           args.subset))
+    for batch_sz in args.batch_sizes:
+        (fp32_losses, fp32_seconds, _), (bf16_losses, bf16_seconds, _) = results[batch_sz, False], results[batch_sz, True]
+        print('bs %d: step fp32 %.2f s, bf16 %.2f s' % (batch_sz, fp32_seconds, bf16_seconds))
+        print('%6s %10s %10s %10s' % ('step', 'fp32 loss', 'bf16 loss', 'rel diff'))
+        for step, (a, b) in enumerate(zip(fp32_losses, bf16_losses)):
+            print('%6d %10.5f %10.5f %10.4f' % (step, a, b, abs(a - b) / abs(a)))
+
+
+def _checkpoint_step(model, args, batch_sz, seed=0):
+    inputs = example_inputs(args.vocab_size, args.num_labels, batch_sz, args.title_len, args.abstract_len, seed=seed)
+    torch.manual_seed(seed)
+    output = model(*inputs, None, None)
+    output.sum().backward()
+    return output
+
+
+def _measure_checkpoint_stages(stages, args, batch_sz, queue):
+    torch.set_num_threads(args.num_threads)
+    model = _training_model(args, checkpoint_stages=stages)
+    model.train()
+    # the gradient buffers are the same for every configuration, allocate them before measuring
+    for param in model.parameters():
+        param.grad = torch.zeros_like(param)
+    # a tiny first step, so that one-off allocations and imports of the first checkpoint are not counted
+    tiny = argparse.Namespace(**vars(args))
+    tiny.title_len, tiny.abstract_len = 4, 24
+    _checkpoint_step(model, tiny, 1)
+    before = psutil.Process().memory_info().rss
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        _checkpoint_step(model, args, batch_sz)
+    seconds = (time.perf_counter() - start) / args.repeat
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((peak - before, seconds))
+
+
+CHECKPOINT_CONFIGS = [(), ('dconv',), ('title_attention', 'abstract_attention'),
+                      ('title_attention', 'abstract_attention', 'dconv')]
+
+
+def bench_checkpoint_stages(args):
+    """ Peak memory and time of a training step of the Full model with different stages checkpointed """
+    small = argparse.Namespace(**vars(args))
+    small.num_labels, small.vocab_size, small.embedding_dim, small.title_len, small.abstract_len = 300, 500, 16, 12, 40
+    outputs = []
+    for stages in CHECKPOINT_CONFIGS:
+        model = _training_model(small, checkpoint_stages=stages)
+        model.train()
+        output = _checkpoint_step(model, small, 3)
+        # the GCN is left out and has no gradients
+        outputs.append([output] + [param.grad for param in model.parameters() if param.grad is not None])
+    for checkpointed in outputs[1:]:
+        for a, b in zip(outputs[0], checkpointed):
+            assert torch.allclose(a, b, rtol=1e-4, atol=1e-5)
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    print('%d labels, embedding dim %d, title %d, abstract %d tokens, %d threads' %
+          (args.num_labels, args.embedding_dim, args.title_len, args.abstract_len, args.num_threads))
+    print('%-42s %6s %16s %10s %10s' % ('checkpointed stages', 'bs', 'peak extra (MB)', 'step (s)', 'docs/s'))
+    for batch_sz in args.batch_sizes:
+        for stages in CHECKPOINT_CONFIGS:
+            process = ctx.Process(target=_measure_checkpoint_stages, args=(stages, args, batch_sz, queue))
+            process.start()
+            extra, seconds = queue.get()
+            process.join()
+            print('%-42s %6d %16.1f %10.2f %10.2f' % (' '.join(stages) or 'none', batch_sz, extra / 2 ** 20, seconds,
+                                                      batch_sz / seconds))
+
+
+def bench_sparse_embedding(args):
+    """
+    Training step time of the Full model with a dense embedding and Adam vs a sparse embedding with
+    SparseAdam (Adam for the other parameters), from the same weights and batches
+    """
+    torch.set_num_threads(args.num_threads)
+    # after one step from the same weights the other parameters are the same, and the embedding moved in the
+    # same rows and directions: Adam leaves the rows without gradient unchanged, SparseAdam adds eps before
+    # the bias correction so the step sizes differ for small gradients
+    small = argparse.Namespace(**vars(args))
+    small.num_labels, small.vocab_size, small.embedding_dim, small.title_len, small.abstract_len = 300, 500, 16, 12, 40
+    small.steps = 1
+    batches = _training_batches(small, 3)
+    models, updates = [], []
+    for sparse in (False, True):
+        models.append(_training_model(small, sparse_embedding=sparse))
+        before = models[-1].embedding_layer.weight.detach().clone()
+        torch.manual_seed(0)
+        _train_steps(models[-1], batches, optimizer=split_adam(models[-1], 1e-3))
+        updates.append(models[-1].embedding_layer.weight.detach() - before)
+    assert torch.equal(torch.sign(updates[0]), torch.sign(updates[1]))
+    for (name, a), b in zip(models[0].named_parameters(), models[1].parameters()):
+        if name != 'embedding_layer.weight':
+            assert torch.allclose(a, b, rtol=1e-4, atol=1e-6)
+
+    results = {}
+    for batch_sz in args.batch_sizes:
+        batches = _training_batches(args, batch_sz)
+        for sparse in (False, True):
+            model = _training_model(args, sparse_embedding=sparse)
+            optimizer = split_adam(model, 1e-3)
+            torch.manual_seed(0)
+            # the first step pays one-off allocations, leave it out
+            _train_steps(model, batches[:1], optimizer=optimizer)
+            results[batch_sz, sparse] = _train_steps(model, batches[1:], optimizer=optimizer)
+
+    print('%d labels, vocab %d, embedding dim %d, title %d, abstract %d tokens, %d threads, %d steps over %d fixed batches' %
+          (args.num_labels, args.vocab_size, args.embedding_dim, args.title_len, args.abstract_len, args.num_threads,
+           args.steps - 1, args.subset))
+    print('%-24s %6s %10s %12s %10s' % ('embedding', 'bs', 'step (s)', 'update (ms)', 'mean loss'))
+    for batch_sz in args.batch_sizes:
+        for sparse in (False, True):
+            losses, seconds, update_seconds = results[batch_sz, sparse]
+            print('%-24s %6d %10.3f %12.1f %10.5f' % ('sparse, SparseAdam+Adam' if sparse else 'dense, Adam', batch_sz,
+                                                     seconds, update_seconds * 1000, sum(losses) / len(losses)))
+
+
+BENCHMARKS = {'attention': bench_attention, 'label_chunk': bench_label_chunk, 'candidates': bench_candidates,
+              'rnn': bench_rnn, 'onnx': bench_onnx,
+              'bf16': bench_bf16, 'checkpoint_stages': bench_checkpoint_stages,
+              'sparse_embedding': bench_sparse_embedding}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', choices=sorted(BENCHMARKS), default='attention')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--num_labels', type=int, default=29368)
+    parser.add_argument('--vocab_size', type=int, default=50000)
+    parser.add_argument('--dim', type=int, default=400)
+    parser.add_argument('--embedding_dim', type=int, default=200)
+    parser.add_argument('--title_len', type=int, default=60)
+    parser.add_argument('--abstract_len', type=int, default=394)
+    parser.add_argument('--mask_density', type=float, default=0.1)
+    parser.add_argument('--mask_sizes', type=int, nargs='+', default=[200, 1000, 4000], help='largest mask per document')
+    parser.add_argument('--label_chunks', type=int, nargs='+', default=[0, 4096, 1024], help='0 scores all labels at once')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=20, help='training steps of the bf16 and sparse_embedding benchmarks')
+    parser.add_argument('--subset', type=int, default=4, help='fixed batches the bf16 and sparse_embedding benchmarks cycle through')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    BENCHMARKS[args.bench](args)
+
+
+if __name__ == "__main__":
+    main()
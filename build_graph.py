@@ -1,5 +1,4 @@
 import argparse
-import os
 import timeit
 
 import dgl
@@ -9,11 +8,12 @@ import pandas as pd
 import torch
 from dgl.data.utils import save_graphs
 from torchtext.data.utils import get_tokenizer
-from torchtext.vocab import Vectors
 from tqdm import tqdm
 from transformers import AutoTokenizer
 from transformers import BertModel
 
+from word_vectors import load_vectors
+
 tokenizer = get_tokenizer('basic_english')
 
 
@@ -428,8 +428,7 @@ def main():
         G = build_MeSH_graph(edge, node_count, label_embedding)
     else:
         print('Load pre-trained vectors')
-        cache, name = os.path.split(args.word2vec_path)
-        vectors = Vectors(name=name, cache=cache)
+        vectors = load_vectors(args.word2vec_path)
         if args.graph_type == 'GCN':
             edges, node_count, label_embedding = get_edge_and_node_fatures(args.meSH_pair_path, args.mesh_parent_children_path,
                                                                            vectors)
@@ -0,0 +1,157 @@
+import argparse
+import copy
+import io
+import random
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+
+from attention import CANDIDATE_FILL
+from corpus_store import load_corpus
+from eval_helper import micro_macro_eval, precision_at_ks
+from model import multichannel_dilatedCNN_with_MeSH_mask
+from quantization import QUANTIZATION_MODES, is_quantized_checkpoint, load_checkpoint, quantize_model, quantized_checkpoint
+from run_eval import prepare_dataset, test
+from utils import HASH_RESERVED, MeSH_indexing
+from vocab_io import check_embedding, vocab_path_for
+
+"""
+Quantize a trained multichannel_dilatedCNN_with_MeSH_mask (Full) model to int8 for CPU inference and
+compare it with the float model.
+
+--calibration_docs documents sampled (with --seed) from the training part of the corpus, before the
+held-out test slice of run_eval.py, calibrate the static conv quantization. The first --eval_docs test
+documents measure P@k, micro-F1 (at --threshold on the sigmoid scores) and the CPU latency of both models. The quantized checkpoint is saved to --save_path and loads with run_eval.py --model.
+
+    python -u calibrate_quantization.py --title_path pmc_title.pkl --abstract_path pmc_abstract.pkl --label_path pmc_meshLabel.pkl --mask_path mesh_mask.pkl --meSH_pair_path MeSH_name_id_mapping_pmc_2020.txt --word2vec_path BioWord2Vec_standard.w2v --graph gcn_pmc.bin --model model.pt --mode static --save_path model.int8.pt
+"""
+
+KS = [1, 3, 5, 10, 15]
+
+
+def checkpoint_size(checkpoint):
+    buffer = io.BytesIO()
+    torch.save(checkpoint, buffer)
+    return len(buffer.getvalue())
+
+
+def validation_dataset(args, vocab, num_test_docs):
+    """ A seeded sample of --calibration_docs documents of the corpus outside the last num_test_docs (the test slice) """
+    all_title, all_text, label_id, mesh_mask = load_corpus(args.title_path, args.abstract_path, args.label_path,
+                                                           args.mask_path, args.corpus_path)
+    num_train_docs = len(all_title) - num_test_docs
+    indices = sorted(random.Random(args.seed).sample(range(num_train_docs), min(args.calibration_docs, num_train_docs)))
+    titles, texts = [all_title[i] for i in indices], [all_text[i] for i in indices]
+    labels, masks = [label_id[i] for i in indices], [mesh_mask[i] for i in indices]
+    # not cached: the token cache keys a subset by its size, not by the documents in it
+    return MeSH_indexing(all_text, all_title, texts, titles, labels, masks, texts, titles, labels, masks, is_test=True,
+                         is_multichannel=True, num_workers=args.preprocess_workers, vocab=vocab,
+                         compact=args.compact_dataset, ngrams=getattr(vocab, 'settings', {}).get('ngrams', args.ngrams),
+                         hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
+
+
+def evaluate(model, dataset, mlb, G, batch_sz, threshold):
+    """ P@k, micro-F1, seconds per document and the scores of a model on the CPU """
+    with torch.no_grad():
+        model.eval()
+        # the label features are computed once in eval mode, keep them out of the timing
+        model.label_features(G, G.ndata['feat'])
+    start = time.perf_counter()
+    pred, true_label = test(dataset, model, mlb, G, batch_sz, torch.device('cpu'))
+    seconds = (time.perf_counter() - start) / len(dataset)
+    pred = np.concatenate(pred, axis=0)
+    true_label = np.concatenate(true_label, axis=0)
+
+    precisions = precision_at_ks(pred, [np.nonzero(labels)[0] for labels in true_label], ks=KS)[0]
+    micro_f1 = micro_macro_eval(1 / (1 + np.exp(-pred)), true_label, threshold)[0]
+    return [np.mean(p) for p in precisions], micro_f1, seconds, pred
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--title_path')
+    parser.add_argument('--abstract_path')
+    parser.add_argument('--label_path')
+    parser.add_argument('--mask_path')
+    parser.add_argument('--corpus_path', help='corpus store written by corpus_store.py, used instead of the pickles')
+    parser.add_argument('--cache_dir', help='directory caching the tokenized corpus and vocab between runs')
+    parser.add_argument('--preprocess_workers', type=int, default=1, help='processes used to tokenize the corpus')
+    parser.add_argument('--vocab_path', help='vocab saved with the model, defaults to <model>.vocab.json')
+    parser.add_argument('--compact_dataset', action='store_true', help='keep the tokenized corpus in flat arrays (less memory per DataLoader worker)')
+    parser.add_argument('--label_chunk', type=int, default=0, help='score the labels in blocks of this size, 0 scores all at once')
+    parser.add_argument('--candidates', action='store_true', help='only score the labels inside the MeSH mask')
+    parser.add_argument('--candidate_fill', type=float, default=CANDIDATE_FILL, help='score of the labels outside the mask with --candidates')
+    parser.add_argument('--fuse_rnn', action='store_true', help='run title and abstract through the BiLSTM in one packed call')
+    parser.add_argument('--ngrams', type=int, default=1, help='n-gram order of the vocab, best used with --hash_buckets')
+    parser.add_argument('--hash_buckets', type=int, default=0, help='hash words outside the reserved vocab and n-grams into this many embedding rows')
+    parser.add_argument('--hash_reserved', type=int, default=HASH_RESERVED, help='most frequent words with their own embedding row in a hashed vocab')
+    parser.add_argument('--word2vec_path')
+    parser.add_argument('--meSH_pair_path')
+    parser.add_argument('--graph')
+
+    parser.add_argument('--model', help='float checkpoint of the Full model')
+    parser.add_argument('--mode', choices=QUANTIZATION_MODES, default='dynamic', help='static also quantizes the dilated convolutions')
+    parser.add_argument('--save_path', help='quantized checkpoint')
+    parser.add_argument('--ksz', default=3)
+    parser.add_argument('--dropout', type=float, default=0.2)
+    parser.add_argument('--calibration_docs', type=int, default=512, help='documents of the training part of the corpus calibrating static quantization')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the calibration sample')
+    parser.add_argument('--eval_docs', type=int, default=2000)
+    parser.add_argument('--batch_sz', type=int, default=16)
+    parser.add_argument('--threshold', type=float, default=0.5, help='micro-F1 threshold on the sigmoid scores')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    vocab_path = args.vocab_path or vocab_path_for(args.model)
+    num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
+                                                                      args.label_path, args.mask_path, args.meSH_pair_path,
+                                                                      args.word2vec_path, args.graph, is_multichannel=True, corpus_path=args.corpus_path,
+                                                                      cache_dir=args.cache_dir,
+                                                                      preprocess_workers=args.preprocess_workers, vocab_path=vocab_path,
+                                                                      compact_dataset=args.compact_dataset,
+                                                                      ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
+    calibration_dataset = validation_dataset(args, vocab, len(test_dataset))
+    eval_dataset = Subset(test_dataset, range(min(args.eval_docs, len(test_dataset))))
+    if args.mode == 'static' and len(calibration_dataset) == 0:
+        parser.error('static quantization needs calibration documents outside the test slice')
+    print('calibration documents %d, evaluation documents %d' % (len(calibration_dataset), len(eval_dataset)))
+
+    model = multichannel_dilatedCNN_with_MeSH_mask(len(vocab), args.dropout, args.ksz, num_nodes, G, 'cpu',
+                                                   embedding_dim=200, rnn_num_layers=2, cornet_dim=1000,
+                                                   n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                                   candidates=args.candidates, candidate_fill=args.candidate_fill, fuse_rnn=args.fuse_rnn)
+    state_dict = load_checkpoint(args.model, map_location='cpu')
+    if is_quantized_checkpoint(state_dict):
+        parser.error('--model has to be a float checkpoint, %s is already quantized' % args.model)
+    check_embedding(state_dict, vocab, model.embedding_layer.weight.shape[1])
+    model.load_state_dict(state_dict)
+
+    print('quantizing (%s)' % args.mode)
+    quantized = quantize_model(copy.deepcopy(model), args.mode,
+                               calibrate=lambda m: test(calibration_dataset, m, mlb, G, args.batch_sz,
+                                                        torch.device('cpu')))
+    checkpoint = quantized_checkpoint(quantized)
+
+    results = {}
+    for name, m in (('fp32', model), ('int8-' + args.mode, quantized)):
+        results[name] = evaluate(m, eval_dataset, mlb, G, args.batch_sz, args.threshold)
+    sizes = {'fp32': checkpoint_size(model.state_dict()), 'int8-' + args.mode: checkpoint_size(checkpoint)}
+
+    print('%d threads, batch size %d' % (args.num_threads, args.batch_sz))
+    print('%-14s' % 'model' + ''.join('%8s' % ('P@%d' % k) for k in KS) + '%8s %10s %10s' % ('MiF', 'ms/doc', 'size (MB)'))
+    for name, (precisions, micro_f1, seconds, _) in results.items():
+        print('%-14s' % name + ''.join('%8.4f' % p for p in precisions) +
+              '%8.4f %10.2f %10.1f' % (micro_f1, seconds * 1000, sizes[name] / 2 ** 20))
+    difference = np.abs(results['fp32'][3] - results['int8-' + args.mode][3])
+    print('score difference to fp32: max %.4f, mean %.4f' % (difference.max(), difference.mean()))
+
+    if args.save_path:
+        torch.save(checkpoint, args.save_path)
+        print('saved the quantized model to %s' % args.save_path)
+
+
+if __name__ == "__main__":
+    main()
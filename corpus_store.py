@@ -0,0 +1,277 @@
+import abc
+import argparse
+import json
+import os
+import pickle
+from array import array
+
+import ijson
+import numpy as np
+from tqdm import tqdm
+
+"""
+Columnar on-disk corpus store.
+
+Each column is a flat data buffer plus an int64 offset array, so document ``i`` lives in
+``data[offsets[i]:offsets[i + 1]]``. Titles and abstracts are stored as UTF-8 bytes, labels and
+MeSH masks as int32 label indices (CSR layout). Every buffer is opened with ``np.memmap`` and
+documents are decoded lazily on access, so opening a store costs O(1) in corpus size.
+
+Layout of a store directory:
+    meta.json                      number of documents and column dtypes
+    <column>.bin                   contiguous data buffer
+    <column>.offsets.bin           int64 offsets, length num_docs + 1
+"""
+
+TEXT_COLUMNS = ('title', 'abstract')
+INDEX_COLUMNS = ('label', 'mask')
+COLUMN_DTYPES = {'title': 'uint8', 'abstract': 'uint8', 'label': 'int32', 'mask': 'int32'}
+OFFSET_DTYPE = 'int64'
+
+
+def _open_buffer(path, dtype):
+    # np.memmap refuses to map empty files
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class _Column(abc.ABC):
+    """Read-only sequence view over one column, supporting int indexing and slicing."""
+
+    def __init__(self, data, offsets, start=0, stop=None):
+        self.data = data
+        self.offsets = offsets
+        self._start = start
+        self._stop = len(offsets) - 1 if stop is None else stop
+
+    @abc.abstractmethod
+    def _get(self, i):
+        """Decoded document ``i`` of the whole column."""
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError('column slices must be contiguous')
+            stop = max(start, stop)
+            return self.__class__(self.data, self.offsets, self._start + start, self._start + stop)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('document index out of range')
+        return self._get(self._start + i)
+
+    def __iter__(self):
+        for i in range(self._start, self._stop):
+            yield self._get(i)
+
+    def row_offsets(self):
+        """Offsets of the documents in this view, rebased to start at the first document."""
+        offsets = np.asarray(self.offsets[self._start:self._stop + 1])
+        return offsets - offsets[0]
+
+    def row_data(self):
+        """Data buffer covering the documents in this view."""
+        return self.data[self.offsets[self._start]:self.offsets[self._stop]]
+
+
+class TextColumn(_Column):
+    def _get(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+
+class IndexColumn(_Column):
+    def _get(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+
+class CorpusStore(object):
+    """Memory-mapped corpus written by ``CorpusWriter``.
+
+    Arguments:
+        path: directory of the store.
+
+    The ``titles``, ``abstracts``, ``labels`` and ``masks`` attributes behave like the lists that
+    used to be unpickled (indexing, slicing, iteration and ``len``), so they can be passed to
+    ``utils.MeSH_indexing`` unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        columns = {}
+        for name in self.meta['columns']:
+            data = _open_buffer(os.path.join(path, name + '.bin'), COLUMN_DTYPES[name])
+            offsets = _open_buffer(os.path.join(path, name + '.offsets.bin'), OFFSET_DTYPE)
+            column_cls = TextColumn if name in TEXT_COLUMNS else IndexColumn
+            columns[name] = column_cls(data, offsets)
+
+        self.titles = columns.get('title')
+        self.abstracts = columns.get('abstract')
+        self.labels = columns.get('label')
+        self.masks = columns.get('mask')
+
+    def __len__(self):
+        return self.meta['num_docs']
+
+
+class _ColumnWriter(object):
+    def __init__(self, path, name):
+        self.name = name
+        self.dtype = COLUMN_DTYPES[name]
+        self._data = open(os.path.join(path, name + '.bin'), 'wb')
+        self._offsets_path = os.path.join(path, name + '.offsets.bin')
+        self._offsets = array('q', [0])
+
+    def append(self, value):
+        if self.name in TEXT_COLUMNS:
+            buf = value.encode('utf-8')
+        else:
+            buf = np.asarray(value, dtype=self.dtype).tobytes()
+        self._data.write(buf)
+        self._offsets.append(self._offsets[-1] + len(buf) // np.dtype(self.dtype).itemsize)
+
+    def close(self):
+        self._data.close()
+        with open(self._offsets_path, 'wb') as f:
+            self._offsets.tofile(f)
+
+
+class CorpusWriter(object):
+    """Streams documents into a new store directory.
+
+    Usage:
+        with CorpusWriter(path) as writer:
+            writer.add(title, abstract, label, mask)
+    """
+
+    def __init__(self, path, columns=TEXT_COLUMNS + INDEX_COLUMNS):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.columns = list(columns)
+        self._writers = {name: _ColumnWriter(path, name) for name in self.columns}
+        self.num_docs = 0
+
+    def add(self, title=None, abstract=None, label=None, mask=None):
+        values = {'title': title, 'abstract': abstract, 'label': label, 'mask': mask}
+        for name in self.columns:
+            self._writers[name].append(values[name])
+        self.num_docs += 1
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'num_docs': self.num_docs, 'columns': self.columns}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def convert_pickles(title_path, abstract_path, label_path, mask_path, save_path):
+    """ Convert the title/abstract/label/mask pickles used by the training scripts """
+    all_title = pickle.load(open(title_path, 'rb'))
+    all_text = pickle.load(open(abstract_path, 'rb'))
+    label_id = pickle.load(open(label_path, 'rb'))
+    mesh_mask = pickle.load(open(mask_path, 'rb'))
+    assert len(all_text) == len(all_title), 'title and abstract in the training set are not matching'
+
+    with CorpusWriter(save_path) as writer:
+        for i in tqdm(range(len(all_title))):
+            writer.add(all_title[i], all_text[i], label_id[i], mesh_mask[i])
+    return writer.num_docs
+
+
+def _to_index(mesh_list, index_dic):
+    return [index_dic[m] if isinstance(m, str) else int(m) for m in mesh_list]
+
+
+def convert_json(data_path, MeSH_id_pair_file, save_path):
+    """ Convert an ``articles.item`` json file (e.g. the output of get_mesh_mask.py) """
+    mapping_id = {}
+    with open(MeSH_id_pair_file, 'r') as f:
+        for line in f:
+            (key, value) = line.split('=')
+            mapping_id[key] = value.strip()
+    meshIDs = list(mapping_id.values())
+    index_dic = {k: v for v, k in enumerate(meshIDs)}
+
+    f = open(data_path, encoding="utf8")
+    objects = ijson.items(f, 'articles.item')
+
+    no_title, no_abstract = 0, 0
+    with CorpusWriter(save_path) as writer:
+        for obj in tqdm(objects):
+            heading = obj['title'].strip()
+            heading = heading.translate(str.maketrans('', '', '[]'))
+            abstract = obj["abstractText"].strip()
+            clean_abstract = abstract.translate(str.maketrans('', '', '[]'))
+            if len(heading) == 0 or heading == 'In process':
+                no_title += 1
+                continue
+            elif len(clean_abstract) == 0:
+                no_abstract += 1
+                continue
+            label = _to_index(obj['meshID'], index_dic)
+            mask = _to_index(obj.get('meshMask', []), index_dic)
+            writer.add(heading, clean_abstract, label, mask)
+    if no_title or no_abstract:
+        print('skipped %d papers without title and %d without abstract' % (no_title, no_abstract))
+    return writer.num_docs
+
+
+def load_corpus(title_path, abstract_path, label_path, mask_path, corpus_path=None):
+    """
+    Load titles, abstracts, labels and MeSH masks, either lazily from a corpus store (if
+    ``corpus_path`` is given) or from the pickled lists.
+    """
+    if corpus_path is not None:
+        store = CorpusStore(corpus_path)
+        return store.titles, store.abstracts, store.labels, store.masks
+
+    mesh_mask = pickle.load(open(mask_path, 'rb'))
+    all_title = pickle.load(open(title_path, 'rb'))
+    all_text = pickle.load(open(abstract_path, 'rb'))
+    label_id = pickle.load(open(label_path, 'rb'))
+    return all_title, all_text, label_id, mesh_mask
+
+
+def corpus_files(title_path, abstract_path, label_path, mask_path, corpus_path=None):
+    """ The files a corpus is read from, e.g. to key caches derived from it """
+    if corpus_path is not None:
+        store = CorpusStore(corpus_path)
+        names = ['meta.json'] + [name + ext for name in store.meta['columns'] for ext in ('.bin', '.offsets.bin')]
+        return [os.path.join(corpus_path, name) for name in names]
+    return [title_path, abstract_path, label_path, mask_path]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--title_path')
+    parser.add_argument('--abstract_path')
+    parser.add_argument('--label_path')
+    parser.add_argument('--mask_path')
+    parser.add_argument('--data_path', help='articles.item json file, used instead of the pickles')
+    parser.add_argument('--meSH_pair_path')
+    parser.add_argument('--save_path')
+    args = parser.parse_args()
+
+    if args.data_path is not None:
+        num_docs = convert_json(args.data_path, args.meSH_pair_path, args.save_path)
+    else:
+        num_docs = convert_pickles(args.title_path, args.abstract_path, args.label_path, args.mask_path,
+                                   args.save_path)
+    print('wrote %d documents to %s' % (num_docs, args.save_path))
+
+
+if __name__ == "__main__":
+    main()
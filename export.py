@@ -0,0 +1,241 @@
+import argparse
+import inspect
+import subprocess
+import sys
+import time
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from attention import label_scores
+from model import LABEL_FEATURES_KEY, multichannel_dilatedCNN_with_MeSH_mask
+from onnx_backend import ONNX_INPUTS, ONNX_OUTPUT, OnnxScorer
+from quantization import is_quantized_checkpoint, load_checkpoint, load_quantized
+try:
+    from dgl.data.utils import load_graphs
+except ImportError:
+    load_graphs = None
+
+"""
+Export of the Full model (multichannel_dilatedCNN_with_MeSH_mask) for serving.
+
+``KenMeSHInference`` takes the embedding, BiLSTM, dilated CNN and CorNet of a trained model and freezes
+its label features (GCN output and node features) into a buffer, so the forward only takes tensors:
+    scores = module(abstract, title, mask, ab_length, title_length)
+It is written for TorchScript: ``export_model`` scripts (or traces) it, freezes the weights into
+constants where ``torch.jit.freeze`` exists, and the saved artifact loads with ``torch.jit.load``
+alone, without model.py, DGL, transformers or torchtext.
+
+``export_onnx`` writes the same module as an ONNX graph with dynamic batch and sequence axes, run
+with ``onnx_backend.OnnxScorer`` under ONNX Runtime.
+
+    python export.py --model model.pt --graph gcn_pmc.bin --save_path model.ts.pt
+    python export.py --model model.pt --graph gcn_pmc.bin --save_path model.onnx --method onnx
+"""
+
+EXPORT_METHODS = ('script', 'trace', 'onnx')
+ONNX_OPSET = 11
+
+_LOAD_CHECK = """
+import sys
+import torch
+module = torch.jit.load(sys.argv[1])
+loaded = [name for name in ('model', 'dgl', 'transformers', 'torchtext') if name in sys.modules]
+assert not loaded, 'loading the artifact imported ' + ', '.join(loaded)
+"""
+
+
+class KenMeSHInference(nn.Module):
+    """
+    Arguments:
+        model: trained multichannel_dilatedCNN_with_MeSH_mask.
+        label_feature: its label features, (num_labels, embedding_dim * 2).
+        label_chunk: score the labels in blocks of this size, 0 scores all at once.
+    """
+
+    def __init__(self, model, label_feature, label_chunk=0):
+        super(KenMeSHInference, self).__init__()
+        if model.candidates:
+            raise ValueError('candidate scoring is not supported by the exported model')
+        self.embedding_layer = model.embedding_layer
+        self.rnn = model.rnn
+        self.dconv = model.dconv
+        self.cornet = model.cornet
+        self.label_chunk = label_chunk
+        self.register_buffer('label_feature', label_feature.detach().clone())
+
+    def _rnn(self, inputs, length):
+        packed = pack_padded_sequence(inputs, length, batch_first=True, enforce_sorted=False)
+        output, _ = self.rnn(packed)
+        return pad_packed_sequence(output, batch_first=True)[0]
+
+    def forward(self, abstract, title, mask, ab_length, title_length):
+        output_title = self._rnn(self.embedding_layer(title.long()), title_length)
+        output_abstract = self._rnn(self.embedding_layer(abstract), ab_length)
+        output_abstract = self.dconv(output_abstract.permute(0, 2, 1)).transpose(1, 2)
+
+        # the masked label-wise attention and read-out of the model (attention.label_dot_scores), in blocks
+        num_labels = self.label_feature.shape[0]
+        chunk = self.label_chunk if self.label_chunk > 0 else num_labels
+        blocks = []
+        for start in range(0, num_labels, chunk):
+            end = min(start + chunk, num_labels)
+            blocks.append(label_scores(self.label_feature[start:end], mask[:, start:end],
+                                       [output_title, output_abstract]))
+        return self.cornet(torch.cat(blocks, dim=1))
+
+
+def example_inputs(vocab_size, num_labels, batch_sz=2, title_len=20, abstract_len=100, seed=0):
+    """ Random (abstract, title, mask, ab_length, title_length) of a batch, by decreasing abstract length """
+    generator = torch.Generator().manual_seed(seed)
+    ab_length = torch.randint(abstract_len // 2, abstract_len + 1, (batch_sz,), generator=generator)
+    title_length = torch.randint(title_len // 2, title_len + 1, (batch_sz,), generator=generator)
+    ab_length[0], title_length[0] = abstract_len, title_len
+    # sorted by abstract length, like the batches of generate_batch
+    ab_length = ab_length.sort(descending=True)[0]
+    abstract = torch.randint(1, vocab_size, (batch_sz, abstract_len), generator=generator)
+    title = torch.randint(1, vocab_size, (batch_sz, title_len), generator=generator)
+    mask = (torch.rand(batch_sz, num_labels, generator=generator) < 0.1).float()
+    return abstract, title, mask, ab_length, title_length
+
+
+def export_model(model, label_feature, method='script', label_chunk=0):
+    """ TorchScript module of a trained model with its label features frozen in """
+    module = KenMeSHInference(model, label_feature, label_chunk).eval()
+    if method == 'onnx':
+        raise ValueError('use export_onnx for ONNX')
+    if method == 'script':
+        exported = torch.jit.script(module)
+    elif method == 'trace':
+        inputs = example_inputs(model.embedding_layer.num_embeddings, label_feature.shape[0])
+        exported = torch.jit.trace(module, inputs)
+    else:
+        raise ValueError('unknown export method %s, expected one of %s' % (method, ', '.join(EXPORT_METHODS)))
+    if hasattr(torch.jit, 'freeze'):
+        exported = torch.jit.freeze(exported)
+    # the exported graph has to give the scores of the eager module on inputs other than the trace ones
+    with torch.no_grad():
+        for batch_sz, title_len, abstract_len in ((1, 7, 333), (3, 20, 100)):
+            inputs = example_inputs(model.embedding_layer.num_embeddings, label_feature.shape[0], batch_sz, title_len,
+                                    abstract_len, seed=batch_sz)
+            difference = (exported(*inputs) - module(*inputs)).abs().max().item()
+            if difference > 1e-4:
+                raise AssertionError('%s export differs from the eager module by %g' % (method, difference))
+    return exported
+
+
+def export_onnx(model, label_feature, path, label_chunk=0, opset_version=ONNX_OPSET):
+    """ Write a trained model with its label features frozen in as ONNX, with dynamic batch and sequence axes """
+    module = KenMeSHInference(model, label_feature, label_chunk).eval()
+    inputs = example_inputs(model.embedding_layer.num_embeddings, label_feature.shape[0])
+    dynamic_axes = {'abstract': {0: 'batch', 1: 'abstract_tokens'}, 'title': {0: 'batch', 1: 'title_tokens'},
+                    'mask': {0: 'batch'}, 'ab_length': {0: 'batch'}, 'title_length': {0: 'batch'},
+                    ONNX_OUTPUT: {0: 'batch'}}
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # newer torch exports through torch.export by default, keep the tracing exporter
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(module, inputs, path, input_names=list(ONNX_INPUTS), output_names=[ONNX_OUTPUT],
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, do_constant_folding=True, **kwargs)
+
+
+def _node_features(G):
+    return G.ndata['feat'] if G is not None else None
+
+
+def check_export(model, G, path, method='script', batch_sizes=(1, 4), atol=1e-4):
+    """
+    Compare the saved artifact with the eager model (with the label graph ``G``, or None for stored label
+    features) at several batch and sequence sizes, and check that loading a TorchScript artifact imports
+    none of model.py, DGL, transformers or torchtext. Returns the largest score difference.
+    """
+    exported = OnnxScorer(path) if method == 'onnx' else torch.jit.load(path)
+    vocab_size, num_labels = model.embedding_layer.num_embeddings, model.cornet.intlv_layers[0].dstbn2cntxt.in_features
+    difference = 0.
+    with torch.no_grad():
+        for batch_sz in batch_sizes:
+            for title_len, abstract_len in ((20, 100), (7, 333)):
+                inputs = example_inputs(vocab_size, num_labels, batch_sz, title_len, abstract_len, seed=batch_sz)
+                expected = model(*inputs, G, _node_features(G))
+                difference = max(difference, (exported(*inputs) - expected).abs().max().item())
+    if difference > atol:
+        raise AssertionError('exported scores differ from the eager model by %g' % difference)
+    if method != 'onnx':
+        subprocess.run([sys.executable, '-c', _LOAD_CHECK, path], check=True)
+    return difference
+
+
+def _num_labels(state_dict):
+    bias = state_dict.get('cornet.intlv_layers.0.cntxt2dstbn.bias')
+    if bias is None:
+        # int8 Linear of a quantized checkpoint, (weight, bias) packed together
+        bias = state_dict['cornet.intlv_layers.0.cntxt2dstbn._packed_params._packed_params'][1]
+    return bias.shape[0]
+
+
+def load_model(path, graph_file=None, ksz=3, cornet_dim=1000, n_cornet_blocks=2, label_chunk=0):
+    """
+    Full model of a float or quantized checkpoint in eval mode on the CPU, and the label graph (None if
+    the checkpoint has stored label features).
+    """
+    checkpoint = load_checkpoint(path, map_location='cpu')
+    state_dict = checkpoint['state_dict'] if is_quantized_checkpoint(checkpoint) else checkpoint
+    vocab_size, embedding_dim = state_dict['embedding_layer.weight'].shape
+    model = multichannel_dilatedCNN_with_MeSH_mask(vocab_size, 0., ksz, _num_labels(state_dict), None, 'cpu',
+                                                   embedding_dim=embedding_dim, cornet_dim=cornet_dim,
+                                                   n_cornet_blocks=n_cornet_blocks, label_chunk=label_chunk)
+    if is_quantized_checkpoint(checkpoint):
+        load_quantized(model, checkpoint)
+    else:
+        model.load_state_dict(state_dict)
+    model.eval()
+    if LABEL_FEATURES_KEY in state_dict:
+        return model, None
+    if graph_file is None or load_graphs is None:
+        raise ValueError('the checkpoint has no stored label features, --graph (and DGL) is needed')
+    return model, load_graphs(graph_file)[0][0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='checkpoint of the Full model')
+    parser.add_argument('--graph', help='label graph, if the checkpoint has no stored label features')
+    parser.add_argument('--save_path')
+    parser.add_argument('--method', choices=EXPORT_METHODS, default='script', help='TorchScript script/trace, or onnx')
+    parser.add_argument('--ksz', type=int, default=3)
+    parser.add_argument('--cornet_dim', type=int, default=1000)
+    parser.add_argument('--n_cornet_blocks', type=int, default=2)
+    parser.add_argument('--label_chunk', type=int, default=0, help='score the labels in blocks of this size, 0 scores all at once')
+    args = parser.parse_args()
+
+    model, G = load_model(args.model, args.graph, args.ksz, args.cornet_dim, args.n_cornet_blocks, args.label_chunk)
+    with torch.no_grad():
+        label_feature = model.label_features(G, _node_features(G))
+    if args.method == 'onnx':
+        export_onnx(model, label_feature, args.save_path, args.label_chunk)
+        exported = OnnxScorer(args.save_path)
+    else:
+        torch.jit.save(export_model(model, label_feature, args.method, args.label_chunk), args.save_path)
+        exported = torch.jit.load(args.save_path)
+    print('saved the exported model (%s) to %s' % (args.method, args.save_path))
+
+    difference = check_export(model, G, args.save_path, args.method)
+    print('max score difference to the eager model: %g' % difference)
+
+    inputs = example_inputs(model.embedding_layer.num_embeddings, label_feature.shape[0], batch_sz=16,
+                            abstract_len=300)
+    with torch.no_grad():
+        for name, forward in (('eager', lambda *x: model(*x, G, _node_features(G))), ('exported', exported)):
+            # the TorchScript profiling executor optimizes the graph over the first calls
+            for _ in range(3):
+                forward(*inputs)
+            start = time.perf_counter()
+            for _ in range(5):
+                forward(*inputs)
+            print('%-9s batch of 16: %.1f ms' % (name, (time.perf_counter() - start) / 5 * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,23 @@
 import argparse
 import json
-import os
 import pickle
-import string
 
 import faiss
 import ijson
 import nltk
 import torch
 import torch.nn as nn
-from nltk.corpus import stopwords
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.preprocessing import MultiLabelBinarizer
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader
-from torchtext.data.utils import get_tokenizer
-from torchtext.vocab import Vectors
 from tqdm import tqdm
 
-from run_classifier_multigcn import weight_matrix
-from utils import Preprocess
+from utils import Preprocess, normalize
+from vocab_io import load_vocab
+from word_vectors import load_vectors, weight_matrix
 
 nltk.download('stopwords')
-tokenizer = get_tokenizer('basic_english')
 
 
 class Embedding(nn.Module):
@@ -69,17 +64,8 @@ def generate_batch(batch):
 
 def idf_weighted_wordvec(doc):
 
-    tokens = tokenizer(doc)
-    # remove punctuation from each word
-    table = str.maketrans('', '', string.punctuation)
-    stripped = [w.translate(table) for w in tokens]
-    # remove remaining tokens that are not alphabetic
-    tokens = [k.lower() for k in stripped if k.isalpha()]
-    # remove stopwords
-    stop_words = stopwords.words('english')
-    text = [w for w in tokens if not w in stop_words]
-    # remove single character words
-    text = [w for w in text if len(w) > 1]
+    # tokenize, remove punctuation, non alphabetic, stopword and single character tokens
+    text = normalize(doc)
 
     # get idf weighted word vectors
     vectorizer = TfidfVectorizer()
@@ -125,7 +111,8 @@ def load_idf_file(idf_path):
     return pmid, weighted_doc_vec
 
 
-def get_knn_neighbors_mesh(train_path, vectors, idf_path, k,  device, nprobe=5):
+def get_knn_neighbors_mesh(train_path, vectors, idf_path, k,  device, nprobe=5, preprocess_workers=1,
+                           vocab_path=None):
 
     pmid_idf, idfs = load_idf_file(idf_path)
 
@@ -165,7 +152,11 @@ def get_knn_neighbors_mesh(train_path, vectors, idf_path, k,  device, nprobe=5):
 
     print('Loading document done. ')
 
-    dataset = Preprocess(all_text, idfs, labels)
+    vocab = None
+    if vocab_path is not None:
+        print('load vocab from %s' % vocab_path)
+        vocab = load_vocab(vocab_path)
+    dataset = Preprocess(all_text, idfs, labels, vocab=vocab, num_workers=preprocess_workers)
     vocab = dataset.get_vocab()
 
     weights = weight_matrix(vocab, vectors)
@@ -359,6 +350,8 @@ def main():
     parser.add_argument('--save_path_neigh')
     parser.add_argument('--save_path_idf')
     parser.add_argument('--journal')
+    parser.add_argument('--preprocess_workers', type=int, default=1, help='processes used to tokenize the corpus')
+    parser.add_argument('--vocab_path', help='vocab saved with the model, used instead of building one')
     args = parser.parse_args()
 
     mapping_id = {}
@@ -378,9 +371,9 @@ def main():
 
     # 2. get masks using KNN
     device = torch.device(args.device if torch.cuda.is_available() else "cpu")
-    cache, name = os.path.split(args.word2vec_path)
-    vectors = Vectors(name=name, cache=cache)
-    knn_mask = get_knn_neighbors_mesh(args.allMesh, vectors, args.idfs_path, args.k, device)
+    vectors = load_vectors(args.word2vec_path)
+    knn_mask = get_knn_neighbors_mesh(args.allMesh, vectors, args.idfs_path, args.k, device,
+                                       preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path)
     with open(args.save_path_neigh, "w") as outfile:
         json.dump(knn_mask, outfile)
 
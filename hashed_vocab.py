@@ -0,0 +1,43 @@
+import zlib
+
+from torchtext.vocab import Vocab
+
+"""
+Hashing-trick vocabulary.
+
+The ``num_reserved`` most frequent words get their own embedding rows (in torchtext Vocab order,
+after the specials), every other word and every n-gram shares one of ``num_buckets`` rows chosen
+by a crc32 hash. The embedding table then has ``len(specials) + num_reserved + num_buckets`` rows,
+whatever the corpus size or n-gram order. crc32 is stable across processes and runs, unlike
+Python's salted ``hash``.
+"""
+
+
+def bucket(token, num_buckets):
+    return zlib.crc32(token.encode('utf-8')) % num_buckets
+
+
+class HashedVocab(Vocab):
+    """
+    Arguments:
+        counter: collections.Counter of the (unigram) word frequencies.
+        num_buckets: number of shared hash rows.
+        num_reserved: number of most frequent words with a row of their own.
+
+    ``itos``/``stoi`` only hold the specials and the reserved words, so the pre-trained vector
+    initialization (``word_vectors.weight_matrix``) applies to those rows; ``len(vocab)`` counts
+    the buckets as well.
+    """
+
+    def __init__(self, counter, num_buckets, num_reserved, specials=('<unk>', '<pad>')):
+        super(HashedVocab, self).__init__(counter, max_size=num_reserved, specials=list(specials))
+        self.num_buckets = num_buckets
+
+    def __getitem__(self, token):
+        index = self.stoi.get(token)
+        if index is None:
+            index = len(self.itos) + bucket(token, self.num_buckets)
+        return index
+
+    def __len__(self):
+        return len(self.itos) + self.num_buckets
@@ -4,6 +4,7 @@ import pickle
 import ijson
 import numpy as np
 import torch
+from torchtext.data.utils import get_tokenizer
 from tqdm import tqdm
 
 
@@ -193,25 +194,9 @@ def get_label_negative_positive_ratio(train_data_path, MeSH_id_pair_file):
     return neg_pos_ratio
 
 
-import string
-from nltk.corpus import stopwords
-from torchtext.data.utils import get_tokenizer
-stop_words = set(stopwords.words('english'))
-table = str.maketrans('', '', string.punctuation)
-
-
-def text_clean(tokens):
-
-    stripped = [w.translate(table) for w in tokens]  # remove punctuation
-    clean_tokens = [w for w in stripped if w.isalpha()]  # remove non alphabetic tokens
-    text_nostop = [word for word in clean_tokens if word not in stop_words]  # remove stopwords
-    filtered_text = [w for w in text_nostop if len(w) > 1]  # remove single character token
-
-    return filtered_text
-
-
 def get_doc_length(train_data_path):
 
+    # raw basic_english tokens, before stop word and punctuation removal
     tokenizer = get_tokenizer('basic_english')
     # get MeSH in each example
     f = open(train_data_path, encoding="utf8")
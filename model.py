@@ -1,13 +1,22 @@
-import dgl.function as fn
+import contextlib
+
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from dgl.nn.pytorch.conv import SAGEConv, RelGraphConv
 from transformers import BertModel
 from transformers.modeling_bert import BertPreTrainedModel
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-from gat import GAT
+
+from attention import CANDIDATE_FILL, candidate_label_scores, checkpoint_stage, chunked_label_scores, fp32_softmax, \
+    label_attention, label_dot_scores, masked_label_attention
+try:
+    import dgl.function as fn
+    from dgl.nn.pytorch.conv import SAGEConv, RelGraphConv
+    from gat import GAT
+except ImportError:
+    # models loaded with stored label features (see LabelFeatureCache) run without DGL
+    fn = None
 
 ########## Embedding ##########
 class Embedding(nn.Module):
@@ -204,14 +213,146 @@ class multichannel_attenCNN(nn.Module):
         return x_feature
 
 
-class single_channel_dilatedCNN(nn.Module):
-    def __init__(self, vocab_size, dropout, ksz, output_size, embedding_dim=200, rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2):
+########## RNN ##########
+def _cpu_autocast_off(device):
+    if device.type == 'cpu' and hasattr(torch, 'autocast'):
+        return torch.autocast('cpu', enabled=False)
+    return contextlib.nullcontext()
+
+
+def pack_batch(inputs, length):
+    """
+    ``pack_padded_sequence`` of a padded batch. The sort is skipped when the lengths are already
+    non-increasing, as for the abstracts of ``generate_batch`` batches; other batches are sorted as usual.
+    """
+    length = torch.as_tensor(length)
+    is_sorted = bool((length[:-1] >= length[1:]).all())
+    return pack_padded_sequence(inputs, length, batch_first=True, enforce_sorted=is_sorted)
+
+
+def rnn_channels(rnn, embedded, lengths, fused=False):
+    """
+    Run ``rnn`` over several channels of a batch (e.g. title and abstract, which share the BiLSTM).
+    With ``fused`` it is a single call: the channels are padded to the same length and packed as one
+    batch of len(embedded) * bs sequences. Otherwise each channel is packed and run on its own.
+    Arguments:
+        embedded: padded inputs of each channel, (bs, seq_len_i, dim).
+        lengths: lengths of each channel, (bs,).
+    Returns:
+        padded outputs of each channel, (bs, max(lengths_i), hidden).
+    """
+    # on the CPU the per-timestep LSTM matmuls are too small to gain from bf16 autocast, they would only
+    # pay for the casts: keep the RNN in fp32
+    with _cpu_autocast_off(embedded[0].device):
+        return _rnn_channels(rnn, embedded, lengths, fused)
+
+
+def _rnn_channels(rnn, embedded, lengths, fused):
+    if not fused:
+        outputs = []
+        for inputs, length in zip(embedded, lengths):
+            output, _ = rnn(pack_batch(inputs, length))
+            outputs.append(pad_packed_sequence(output, batch_first=True)[0])
+        return outputs
+
+    seq_len = max(inputs.shape[1] for inputs in embedded)
+    inputs = torch.cat([F.pad(inputs, (0, 0, 0, seq_len - inputs.shape[1])) for inputs in embedded])
+    lengths = [torch.as_tensor(length) for length in lengths]
+    outputs, _ = rnn(pack_batch(inputs, torch.cat(lengths)))
+    outputs, _ = pad_packed_sequence(outputs, batch_first=True)
+    outputs = outputs.split([inputs.shape[0] for inputs in embedded])
+    return [output[:, :int(length.max())] for output, length in zip(outputs, lengths)]
+
+
+########## Label features ##########
+LABEL_FEATURES_KEY = 'label_features'
+_FROM_CHECKPOINT = 'checkpoint'
+
+
+class LabelFeatureCache(object):
+    """
+    Mixin for the models with a GCN label encoder (``self.gcn``). The label features (GCN output
+    concatenated with the node features) only depend on the weights, so in eval mode without autograd
+    they are computed once and reused until the GCN parameters change (their version counters), the
+    node features change, ``train()`` or ``load_state_dict``.
+    ``store_label_features`` adds them to the state dict: a model loaded from such a checkpoint runs
+    inference with ``g=None``, without the graph and DGL.
+    """
+    _label_cache = None
+    _label_cache_key = None
+    _store_label_features = False
+
+    def _compute_label_features(self, g, g_node_feature):
+        label_feature = self.gcn(g, g_node_feature)
+        return torch.cat((label_feature, g_node_feature), dim=1)  # torch.Size([29368, 200*2])
+
+    def _label_cache_version(self, g_node_feature):
+        versions = tuple(p._version for p in self.gcn.parameters())
+        return versions + (g_node_feature.data_ptr(), g_node_feature._version)
+
+    def label_features(self, g, g_node_feature):
+        if self.training or torch.is_grad_enabled():
+            return self._compute_label_features(g, g_node_feature)
+        if self._label_cache_key == _FROM_CHECKPOINT:
+            return self._label_cache
+        if g is None:
+            raise RuntimeError('no label graph given and no label features stored in the checkpoint')
+        key = self._label_cache_version(g_node_feature)
+        if self._label_cache is None or key != self._label_cache_key:
+            self._label_cache = self._compute_label_features(g, g_node_feature)
+            self._label_cache_key = key
+        return self._label_cache
+
+    def store_label_features(self, g, g_node_feature):
+        """ Compute the label features and save them with the state dict from now on """
+        with torch.no_grad():
+            self._label_cache = self._compute_label_features(g, g_node_feature)
+        self._label_cache_key = self._label_cache_version(g_node_feature)
+        self._store_label_features = True
+
+    def train(self, mode=True):
+        if mode:
+            self._label_cache, self._label_cache_key = None, None
+        return super(LabelFeatureCache, self).train(mode)
+
+    def _apply(self, fn):
+        # .to() / .cuda() / .half() move the cached features with the weights
+        super(LabelFeatureCache, self)._apply(fn)
+        if self._label_cache is not None:
+            self._label_cache = fn(self._label_cache)
+        return self
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(LabelFeatureCache, self)._save_to_state_dict(destination, prefix, keep_vars)
+        if self._store_label_features and self._label_cache is not None:
+            destination[prefix + LABEL_FEATURES_KEY] = self._label_cache.detach()
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # load_state_dict hands every module the same copy of the state dict, popping does not touch the caller's
+        label_features = state_dict.pop(prefix + LABEL_FEATURES_KEY, None)
+        super(LabelFeatureCache, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                             unexpected_keys, error_msgs)
+        if label_features is not None:
+            device = next(self.gcn.parameters()).device
+            self._label_cache, self._label_cache_key = label_features.to(device), _FROM_CHECKPOINT
+            self._store_label_features = True
+        else:
+            self._label_cache, self._label_cache_key = None, None
+
+
+class single_channel_dilatedCNN(LabelFeatureCache, nn.Module):
+    def __init__(self, vocab_size, dropout, ksz, output_size, embedding_dim=200, rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2,
+                 label_chunk=0, candidates=False, candidate_fill=CANDIDATE_FILL):
         super(single_channel_dilatedCNN, self).__init__()
 
         self.vocab_size = vocab_size
         self.dropout = dropout
         self.ksz = ksz
         self.embedding_dim = embedding_dim
+        self.label_chunk = label_chunk
+        self.candidates = candidates
+        self.candidate_fill = candidate_fill
 
         self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim)
 
@@ -232,7 +373,7 @@ class single_channel_dilatedCNN(nn.Module):
     def forward(self, input_seq, input_length, mask, g, g_node_feature):
         embedded_seq = self.embedding_layer(input_seq)  # size: (bs, seq_len, embed_dim)
 
-        packed_seq = pack_padded_sequence(embedded_seq, input_length, batch_first=True, enforce_sorted=False)
+        packed_seq = pack_batch(embedded_seq, input_length)
         packed_output, (_,_) = self.rnn(packed_seq)
         outputs, _ = pad_packed_sequence(packed_output, batch_first=True)  # (bs, seq_len, emb_dim*2)
 
@@ -240,32 +381,35 @@ class single_channel_dilatedCNN(nn.Module):
         outputs = self.dconv(outputs)  # (bs, embed_dim*2, seq_len-ksz+1)
 
         # get label features
-        label_feature = self.gcn(g, g_node_feature)
-        label_feature = torch.cat((label_feature, g_node_feature), dim=1)  # torch.Size([29368, 200*2])
-        atten_mask = label_feature.transpose(0, 1) * mask.unsqueeze(1)
+        label_feature = self.label_features(g, g_node_feature)  # torch.Size([29368, 200*2])
 
         # label-wise attention (mapping different parts of the document representation to different labels)
-        abstract_atten = torch.softmax(torch.matmul(outputs.transpose(1, 2), atten_mask), dim=1)
-        x_feature = torch.matmul(outputs, abstract_atten).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
-
-        x_feature = torch.sum(x_feature * label_feature, dim=2)
+        if self.candidates:
+            # only the labels inside the MeSH mask
+            x_feature = candidate_label_scores(label_feature, mask, (outputs.transpose(1, 2),), self.candidate_fill)
+        else:
+            x_feature = chunked_label_scores(label_dot_scores, label_feature.shape[0], self.label_chunk, label_feature,
+                                             mask, outputs.transpose(1, 2))  # size: (bs, 29368)
 
         # CorNet
         x_feature = self.cornet(x_feature)
         return x_feature
 
 
-class multichannel_dilatedCNN(nn.Module):
+class multichannel_dilatedCNN(LabelFeatureCache, nn.Module):
     def __init__(self, vocab_size, dropout, ksz, output_size, G, device, embedding_dim=200, rnn_num_layers=2, cornet_dim=1000,
-                 n_cornet_blocks=2):
+                 n_cornet_blocks=2, label_chunk=0, fuse_rnn=False, sparse_embedding=False):
         super(multichannel_dilatedCNN, self).__init__()
 
         self.vocab_size = vocab_size
         self.dropout = dropout
         self.ksz = ksz
         self.embedding_dim = embedding_dim
+        self.label_chunk = label_chunk
+        self.fuse_rnn = fuse_rnn
 
-        self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim)
+        self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim,
+                                            sparse=sparse_embedding)
 
         self.rnn = nn.LSTM(input_size=embedding_dim, hidden_size=embedding_dim, num_layers=rnn_num_layers,
                            dropout=self.dropout, bidirectional=True, batch_first=True)
@@ -284,50 +428,47 @@ class multichannel_dilatedCNN(nn.Module):
 
     def forward(self, input_abstract, input_title, ab_length, title_length, g, g_node_feature): #g_c, g_node_feature_c):
         # get label features
-        label_feature = self.gcn(g, g_node_feature)
-        label_feature = torch.cat((label_feature, g_node_feature), dim=1)
+        label_feature = self.label_features(g, g_node_feature)
 
-        # get title content features
+        # get title and abstract content features
         title = self.embedding_layer(input_title.long())
-        title = pack_padded_sequence(title, title_length, batch_first=True, enforce_sorted=False)
-
-        title, (_,_) = self.rnn(title)
-        title, _ = pad_packed_sequence(title, batch_first=True)  # (bs, seq_len, emb_dim*2)
-
-        title_atten = torch.softmax(torch.matmul(title, label_feature.transpose(0, 1)), dim=1)
-        title_feature = torch.matmul(title.transpose(1, 2), title_atten).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
-
-        # get abstract content features
         abstract = self.embedding_layer(input_abstract)  # size: (bs, seq_len, embed_dim)
-        abstract = pack_padded_sequence(abstract, ab_length, batch_first=True, enforce_sorted=False)
-        abstract, (_,_) = self.rnn(abstract)
-        abstract, _ = pad_packed_sequence(abstract, batch_first=True)  # (bs, seq_len, emb_dim*2)
+        title, abstract = rnn_channels(self.rnn, (title, abstract), (title_length, ab_length), self.fuse_rnn)  # (bs, seq_len, emb_dim*2)
 
         abstract = abstract.permute(0, 2, 1) # (bs, emb_dim*2, seq_length)
         abstract_conv = self.dconv(abstract)  # (bs, embed_dim*2, seq_len-ksz+1)
-        abstract_atten = torch.softmax(torch.matmul(abstract_conv.transpose(1, 2), label_feature.transpose(0, 1)), dim=1)  # size: (bs, seq_len-ksz+1, 29368)
-        abstract_feature = torch.matmul(abstract_conv, abstract_atten).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
 
-        # get document feature
-        x_feature = title_feature + abstract_feature  # size: (bs, 29368, embed_dim*2)
-        x_feature = torch.sum(x_feature * label_feature, dim=2)
+        # label-wise attention over title and abstract, document feature dotted with the label features
+        x_feature = chunked_label_scores(label_dot_scores, label_feature.shape[0], self.label_chunk, label_feature, None,
+                                         title, abstract_conv.transpose(1, 2))  # size: (bs, 29368)
 
         # add CorNet
         x_feature = self.cornet(x_feature)
         return x_feature
 
 
-class multichannel_dilatedCNN_with_MeSH_mask(nn.Module):
+# stages of multichannel_dilatedCNN_with_MeSH_mask that can be recomputed in backward (checkpoint_stages)
+CHECKPOINT_STAGES = ('title_attention', 'abstract_attention', 'dconv')
+
+
+class multichannel_dilatedCNN_with_MeSH_mask(LabelFeatureCache, nn.Module):
     def __init__(self, vocab_size, dropout, ksz, output_size, G, device, embedding_dim=200, rnn_num_layers=2, cornet_dim=1000,
-                 n_cornet_blocks=2):
+                 n_cornet_blocks=2, label_chunk=0, candidates=False, candidate_fill=CANDIDATE_FILL, fuse_rnn=False,
+                 checkpoint_stages=(), sparse_embedding=False):
         super(multichannel_dilatedCNN_with_MeSH_mask, self).__init__()
 
         self.vocab_size = vocab_size
         self.dropout = dropout
         self.ksz = ksz
         self.embedding_dim = embedding_dim
+        self.label_chunk = label_chunk
+        self.fuse_rnn = fuse_rnn
+        self.candidates = candidates
+        self.candidate_fill = candidate_fill
+        self.checkpoint_stages = tuple(checkpoint_stages or ())
 
-        self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim)
+        self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim,
+                                            sparse=sparse_embedding)
 
         self.rnn = nn.LSTM(input_size=embedding_dim, hidden_size=embedding_dim, num_layers=rnn_num_layers,
                            dropout=self.dropout, bidirectional=True, batch_first=True)
@@ -353,37 +494,35 @@ class multichannel_dilatedCNN_with_MeSH_mask(nn.Module):
 
     def forward(self, abstract, title, mask, ab_length, title_length, g, g_node_feature): #g_c, g_node_feature_c):
         # get label features
-        label_feature = self.gcn(g, g_node_feature)
+        label_feature = self.label_features(g, g_node_feature)  # torch.Size([29368, 200*2])
         # label_feature = self.gat(g_node_feature)
         # label_cooccurence_feature = self.gcn(g_c, g_node_feature_c)
-        label_feature = torch.cat((label_feature, g_node_feature), dim=1) # torch.Size([29368, 200*2])
         # print('label_feature', label_feature.shape)
         # label_feature = torch.cat((label_feature, label_cooccurence_feature), dim=1)  # torch.Size([29368, 200*2])
 
-        # get title content features
-        atten_mask = label_feature.transpose(0, 1) * mask.unsqueeze(1)
-
+        # get title and abstract content features
         title = self.embedding_layer(title.long())
-        title = pack_padded_sequence(title, title_length, batch_first=True, enforce_sorted=False) # packed input title
-
-        output_title, (_,_) = self.rnn(title) # packed rnn output title
-        output_title, _ = pad_packed_sequence(output_title, batch_first=True)  # unpacked rnn output title with size: (bs, seq_len, emb_dim*2)
-        alpha_title = torch.softmax(torch.matmul(output_title, atten_mask), dim=1)
-        title_features = torch.matmul(output_title.transpose(1, 2), alpha_title).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
-
-        # get abstract content features
         abstract = self.embedding_layer(abstract)  # size: (bs, seq_len, embed_dim)
-        abstract = pack_padded_sequence(abstract, ab_length, batch_first=True, enforce_sorted=False)
-        output_abstract, (_,_) = self.rnn(abstract)
-        output_abstract, _ = pad_packed_sequence(output_abstract, batch_first=True)  # (bs, seq_len, emb_dim*2)
-
-        output_abstract = self.dconv(output_abstract.permute(0, 2, 1))  # (bs, embed_dim*2, seq_len-ksz+1)
-        alpha_abstract = torch.softmax(torch.matmul(output_abstract.transpose(1, 2), atten_mask), dim=1)  # size: (bs, seq_len-ksz+1, 29368)
-        abstract_features = torch.matmul(output_abstract, alpha_abstract).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
-
-        # get document feature
-        x_feature = title_features + abstract_features  # size: (bs, 29368, embed_dim*2)
-        x_feature = torch.sum(x_feature * label_feature, dim=2)
+        output_title, output_abstract = rnn_channels(self.rnn, (title, abstract), (title_length, ab_length),
+                                                     self.fuse_rnn)  # (bs, seq_len, emb_dim*2)
+
+        output_abstract = checkpoint_stage(self.checkpoint_stages, 'dconv', self.dconv,
+                                           output_abstract.permute(0, 2, 1))  # (bs, embed_dim*2, seq_len-ksz+1)
+
+        # masked label-wise attention over title and abstract, document feature dotted with the label features
+        channels = (('title_attention', output_title), ('abstract_attention', output_abstract.transpose(1, 2)))
+        if self.candidates:
+            # only the labels inside the MeSH mask
+            x_feature = candidate_label_scores(label_feature, mask, (output_title, output_abstract.transpose(1, 2)),
+                                               self.candidate_fill)
+        elif self.label_chunk or not set(self.checkpoint_stages).intersection(stage for stage, _ in channels):
+            x_feature = chunked_label_scores(label_dot_scores, label_feature.shape[0], self.label_chunk, label_feature,
+                                             mask, output_title, output_abstract.transpose(1, 2))  # size: (bs, 29368)
+        else:
+            # the scores of each channel on their own, so that a checkpointed channel only keeps its (bs, 29368)
+            # scores for backward instead of its attention weights and features
+            x_feature = sum(checkpoint_stage(self.checkpoint_stages, stage, label_dot_scores, 0, label_feature.shape[0],
+                                             label_feature, mask, inputs) for stage, inputs in channels)
         # x_feature = torch.sum(x_feature * (atten_mask.transpose(1, 2)), dim=2)
 
         # add CorNet
@@ -391,17 +530,22 @@ class multichannel_dilatedCNN_with_MeSH_mask(nn.Module):
         return x_feature
 
 
-class multichannel_with_MeSH_mask(nn.Module):
+class multichannel_with_MeSH_mask(LabelFeatureCache, nn.Module):
     def __init__(self, vocab_size, dropout, ksz, output_size, G, device, embedding_dim=200, rnn_num_layers=2, cornet_dim=1000,
-                 n_cornet_blocks=2):
+                 n_cornet_blocks=2, label_chunk=0, candidates=False, candidate_fill=CANDIDATE_FILL, fuse_rnn=False, sparse_embedding=False):
         super(multichannel_with_MeSH_mask, self).__init__()
 
         self.vocab_size = vocab_size
         self.dropout = dropout
         self.ksz = ksz
         self.embedding_dim = embedding_dim
+        self.label_chunk = label_chunk
+        self.fuse_rnn = fuse_rnn
+        self.candidates = candidates
+        self.candidate_fill = candidate_fill
 
-        self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim)
+        self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim,
+                                            sparse=sparse_embedding)
 
         self.rnn = nn.LSTM(input_size=embedding_dim, hidden_size=embedding_dim, num_layers=rnn_num_layers,
                            dropout=self.dropout, bidirectional=True, batch_first=True)
@@ -413,32 +557,21 @@ class multichannel_with_MeSH_mask(nn.Module):
 
     def forward(self, abstract, title, mask, ab_length, title_length, g, g_node_feature):
         # get label features
-        label_feature = self.gcn(g, g_node_feature)
-        label_feature = torch.cat((label_feature, g_node_feature), dim=1) # torch.Size([29368, 200*2])
+        label_feature = self.label_features(g, g_node_feature)  # torch.Size([29368, 200*2])
 
-        # get title content features
-        atten_mask = label_feature.transpose(0, 1) * mask.unsqueeze(1)
+        # get title and abstract content features
         title = self.embedding_layer(title.long())
-        title = pack_padded_sequence(title, title_length, batch_first=True, enforce_sorted=False) # packed input title
-
-        output_title, (_,_) = self.rnn(title) # packed rnn output title
-        output_title, _ = pad_packed_sequence(output_title, batch_first=True)  # unpacked rnn output title with size: (bs, seq_len, emb_dim*2)
-
-        alpha_title = torch.softmax(torch.matmul(output_title, atten_mask), dim=1)
-        title_features = torch.matmul(output_title.transpose(1, 2), alpha_title).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
-
-        # get abstract content features
         abstract = self.embedding_layer(abstract)  # size: (bs, seq_len, embed_dim)
-        abstract = pack_padded_sequence(abstract, ab_length, batch_first=True, enforce_sorted=False)
-        output_abstract, (_,_) = self.rnn(abstract)
-        output_abstract, _ = pad_packed_sequence(output_abstract, batch_first=True)  # (bs, seq_len, emb_dim*2)
+        output_title, output_abstract = rnn_channels(self.rnn, (title, abstract), (title_length, ab_length),
+                                                     self.fuse_rnn)  # (bs, seq_len, emb_dim*2)
 
-        alpha_abstract = torch.softmax(torch.matmul(output_abstract, atten_mask), dim=1)  # size: (bs, seq_len-ksz+1, 29368)
-        abstract_features = torch.matmul(output_abstract.transpose(1, 2), alpha_abstract).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
-
-        # get document feature
-        x_feature = title_features + abstract_features  # size: (bs, 29368, embed_dim*2)
-        x_feature = torch.sum(x_feature * label_feature, dim=2)
+        # masked label-wise attention over title and abstract, document feature dotted with the label features
+        if self.candidates:
+            # only the labels inside the MeSH mask
+            x_feature = candidate_label_scores(label_feature, mask, (output_title, output_abstract), self.candidate_fill)
+        else:
+            x_feature = chunked_label_scores(label_dot_scores, label_feature.shape[0], self.label_chunk, label_feature,
+                                             mask, output_title, output_abstract)  # size: (bs, 29368)
 
         # add CorNet
         x_feature = self.cornet(x_feature)
@@ -447,15 +580,18 @@ class multichannel_with_MeSH_mask(nn.Module):
 
 class multichannel_dilatedCNN_without_graph(nn.Module):
     def __init__(self, vocab_size, dropout, ksz, output_size, embedding_dim=200, rnn_num_layers=2, cornet_dim=1000,
-                 n_cornet_blocks=2):
+                 n_cornet_blocks=2, label_chunk=0, fuse_rnn=False, sparse_embedding=False):
         super(multichannel_dilatedCNN_without_graph, self).__init__()
 
         self.vocab_size = vocab_size
         self.dropout = dropout
         self.ksz = ksz
         self.embedding_dim = embedding_dim
+        self.label_chunk = label_chunk
+        self.fuse_rnn = fuse_rnn
 
-        self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim)
+        self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim,
+                                            sparse=sparse_embedding)
 
         self.rnn = nn.LSTM(input_size=embedding_dim, hidden_size=embedding_dim, num_layers=rnn_num_layers,
                            dropout=self.dropout, bidirectional=True, batch_first=True)
@@ -475,51 +611,49 @@ class multichannel_dilatedCNN_without_graph(nn.Module):
         # corNet
         self.cornet = CorNet(output_size, cornet_dim, n_cornet_blocks)
 
-    def forward(self, input_abstract, input_title, mask, ab_length, title_length, g_node_feature):
+    def _label_scores(self, start, end, g_node_feature, mask, output_title, abstract_conv):
+        g_node_feature, mask = g_node_feature[start:end], mask[:, start:end]
+        title_feature = masked_label_attention(output_title, g_node_feature, mask)  # size: (bs, labels, embed_dim)
+        abstract_feature = masked_label_attention(abstract_conv, g_node_feature, mask)  # size: (bs, labels, embed_dim)
 
-        # get title content features
-        atten_mask = g_node_feature.transpose(0, 1) * mask.unsqueeze(1)
-        embedded_title = self.embedding_layer(input_title.long())
-        packed_title = pack_padded_sequence(embedded_title, title_length, batch_first=True, enforce_sorted=False)
+        # get document feature
+        x_feature = title_feature + abstract_feature  # size: (bs, labels, embed_dim)
 
-        output_title, (_,_) = self.rnn(packed_title)
-        output_title, _ = pad_packed_sequence(output_title, batch_first=True)  # (bs, seq_len, emb_dim*2)
-        output_title = output_title[:, :, :self.embedding_dim] + output_title[:, :, self.embedding_dim:]  # (bs, seq_len, emb_dim)
+        x_feature = torch.tanh(self.fc1(x_feature))
+        return x_feature.squeeze(2)
 
-        title_atten = torch.softmax(torch.matmul(output_title, atten_mask), dim=1)
-        title_feature = torch.matmul(output_title.transpose(1, 2), title_atten).transpose(1, 2)  # size: (bs, 29368, embed_dim)
+    def forward(self, input_abstract, input_title, mask, ab_length, title_length, g_node_feature):
 
-        # get abstract content features
+        # get title and abstract content features
+        embedded_title = self.embedding_layer(input_title.long())
         embedded_abstract = self.embedding_layer(input_abstract)  # size: (bs, seq_len, embed_dim)
-        packed_abstract = pack_padded_sequence(embedded_abstract, ab_length, batch_first=True, enforce_sorted=False)
-        output_abstract, (_,_) = self.rnn(packed_abstract)
-        output_abstract, _ = pad_packed_sequence(output_abstract, batch_first=True)  # (bs, seq_len, emb_dim*2)
+        output_title, output_abstract = rnn_channels(self.rnn, (embedded_title, embedded_abstract),
+                                                     (title_length, ab_length), self.fuse_rnn)  # (bs, seq_len, emb_dim*2)
+        output_title = output_title[:, :, :self.embedding_dim] + output_title[:, :, self.embedding_dim:]  # (bs, seq_len, emb_dim)
         output_abstract = output_abstract[:, :, :self.embedding_dim] + output_abstract[:, :, self.embedding_dim:]
 
         outputs_abstract = output_abstract.permute(0, 2, 1) # (bs, emb_dim, seq_length)
         abstract_conv = self.dconv(outputs_abstract)  # (bs, embed_dim, seq_len-ksz+1)
 
-        abstract_atten = torch.softmax(torch.matmul(abstract_conv.transpose(1, 2), atten_mask), dim=1)  # size: (bs, seq_len-ksz+1, 29368)
-        abstract_feature = torch.matmul(abstract_conv, abstract_atten).transpose(1, 2)  # size: (bs, 29368, embed_dim)
-
-        # get document feature
-        x_feature = title_feature + abstract_feature  # size: (bs, 29368, embed_dim)
-
-        x_feature = torch.tanh(self.fc1(x_feature))
+        # masked label-wise attention and the per-label read-out
+        x_feature = chunked_label_scores(self._label_scores, g_node_feature.shape[0], self.label_chunk, g_node_feature,
+                                         mask, output_title, abstract_conv.transpose(1, 2))  # size: (bs, 29368)
         # x_feature = self.fc_drop(x_feature)
         # add CorNet
-        cor_logit = self.cornet(x_feature.squeeze(2))
+        cor_logit = self.cornet(x_feature)
         return cor_logit
 
 
-class HGCN4MeSH(nn.Module):
+class HGCN4MeSH(LabelFeatureCache, nn.Module):
 
-    def __init__(self, vocab_size, dropout, ksz, embedding_dim=200, rnn_num_layers=2):
+    def __init__(self, vocab_size, dropout, ksz, embedding_dim=200, rnn_num_layers=2, label_chunk=0, fuse_rnn=False):
         super(HGCN4MeSH, self).__init__()
         self.vocab_size = vocab_size
         self.dropout = dropout
         self.ksz = ksz
         self.embedding_dim = embedding_dim
+        self.label_chunk = label_chunk
+        self.fuse_rnn = fuse_rnn
 
         self.embedding_layer = nn.Embedding(num_embeddings=self.vocab_size, embedding_dim=embedding_dim)
         self.emb_drop = nn.Dropout(0.2)
@@ -539,39 +673,36 @@ class HGCN4MeSH(nn.Module):
 
         #self.fc_drop = nn.Dropout(0.2)
 
+    def _label_scores(self, start, end, label_feature, output_title, output_abstract):
+        label_feature = label_feature[start:end]
+        title_feature = label_attention(output_title, label_feature)  # size: (bs, labels, embed_dim*2)
+        abstract_feature = label_attention(output_abstract, label_feature)  # size: (bs, labels, embed_dim*2)
+
+        # get document feature
+        x_feature = title_feature + abstract_feature  # size: (bs, labels, embed_dim*2)
+        x_feature = nn.functional.leaky_relu(self.fc1(x_feature), negative_slope=0.2)
+        x_feature = nn.functional.leaky_relu(self.fc2(x_feature), negative_slope=0.2)
+        return x_feature.squeeze(2)
+
     def forward(self, input_abstract, input_title, ab_length, title_length, g, g_node_feature):
         # get label features
-        label_feature = self.gcn(g, g_node_feature)
-        label_feature = torch.cat((label_feature, g_node_feature), dim=1) # torch.Size([29368, 200*2])
+        label_feature = self.label_features(g, g_node_feature)  # torch.Size([29368, 200*2])
 
-        # get title content features
+        # get title and abstract content features
         embedded_title = self.embedding_layer(input_title.long())
         embedded_title = self.emb_drop(embedded_title)
-        packed_title = pack_padded_sequence(embedded_title, title_length, batch_first=True, enforce_sorted=False)
-
-        packed_output_title, _ = self.rnn(packed_title)
-        output_unpacked_title, _ = pad_packed_sequence(packed_output_title, batch_first=True)  # (bs, seq_len, emb_dim*2)
-
-        title_atten = torch.softmax(torch.matmul(output_unpacked_title, label_feature.transpose(0, 1)), dim=1)
-        title_feature = torch.matmul(output_unpacked_title.transpose(1, 2), title_atten).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
-
-        # get abstract content features
         embedded_abstract = self.embedding_layer(input_abstract)  # size: (bs, seq_len, embed_dim)
         embedded_abstract = self.emb_drop(embedded_abstract)
-        packed_abstract = pack_padded_sequence(embedded_abstract, ab_length, batch_first=True, enforce_sorted=False)
-        packed_output_abstract, _ = self.rnn(packed_abstract)
-        output_unpacked_abstract, _ = pad_packed_sequence(packed_output_abstract, batch_first=True)  # (bs, seq_len, emb_dim*2)
+        output_unpacked_title, output_unpacked_abstract = rnn_channels(self.rnn, (embedded_title, embedded_abstract),
+                                                                       (title_length, ab_length),
+                                                                       self.fuse_rnn)  # (bs, seq_len, emb_dim*2)
 
-        abstract_atten = torch.softmax(torch.matmul(output_unpacked_abstract, label_feature.transpose(0, 1)), dim=1)  # size: (bs, seq_len-ksz+1, 29368)
-        abstract_feature = torch.matmul(output_unpacked_abstract.transpose(1, 2), abstract_atten).transpose(1, 2)  # size: (bs, 29368, embed_dim*2)
-
-        # get document feature
-        x_feature = title_feature + abstract_feature  # size: (bs, 29368, embed_dim*2)
-        x_feature = nn.functional.leaky_relu(self.fc1(x_feature), negative_slope=0.2)
-        x_feature = nn.functional.leaky_relu(self.fc2(x_feature), negative_slope=0.2)
+        # label-wise attention and the per-label read-out
+        x_feature = chunked_label_scores(self._label_scores, label_feature.shape[0], self.label_chunk, label_feature,
+                                         output_unpacked_title, output_unpacked_abstract)  # size: (bs, 29368)
         # x_feature = self.fc_drop(x_feature)
 
-        return x_feature.squeeze(2)
+        return x_feature
 
 
 
@@ -584,11 +715,13 @@ class MLAttention(nn.Module):
         self.attention = nn.Linear(hidden_size, labels_num, bias=False)
         nn.init.xavier_uniform_(self.attention.weight)
 
-    def forward(self, inputs, masks):
+    def forward(self, inputs, masks, start=0, end=None):
+        # labels start..end only, for label-chunked scoring
         masks = torch.unsqueeze(masks, 1)  # N, 1, L
         masks = 1 - masks
-        attention = self.attention(inputs).transpose(1, 2).masked_fill_(masks.bool(), -np.inf)  # [bz,num_label,seq_len]
-        attention = F.softmax(attention, -1)
+        attention = F.linear(inputs, self.attention.weight[start:end])
+        attention = attention.transpose(1, 2).masked_fill_(masks.bool(), -np.inf)  # [bz,num_label,seq_len]
+        attention = fp32_softmax(attention, -1)
         x = torch.matmul(attention, inputs)  # [bz, num_label, hidden_sz]
         return x
 
@@ -660,8 +793,9 @@ class CorNet(nn.Module):
         return logits
 
 
-gcn_msg = fn.copy_src(src='h', out='m')
-gcn_reduce = fn.sum(msg='m', out='h')
+if fn is not None:
+    gcn_msg = fn.copy_src(src='h', out='m')
+    gcn_reduce = fn.sum(msg='m', out='h')
 
 
 class GCNLayer(nn.Module):
@@ -694,7 +828,7 @@ class LabelNet(nn.Module):
         return x
 
 
-class MeSH_GCN(nn.Module):
+class MeSH_GCN(LabelFeatureCache, nn.Module):
     """
     attenCNN + GCN
 
@@ -713,15 +847,14 @@ class MeSH_GCN(nn.Module):
     def forward(self, input_seq, g, g_node_feature):
         x_feature = self.content_feature(input_seq, g_node_feature)
 
-        label_feature = self.gcn(g, g_node_feature)
-        label_feature = torch.cat((label_feature, g_node_feature), dim=1)  # torch.Size([29368, 400])
+        label_feature = self.label_features(g, g_node_feature)  # torch.Size([29368, 400])
 
         x = torch.sum(x_feature * label_feature, dim=2)
         x = torch.sigmoid(x)
         return x
 
 
-class CorGCN(nn.Module):
+class CorGCN(LabelFeatureCache, nn.Module):
     """
     attenCNN + GCN + CorNet
     """
@@ -743,8 +876,7 @@ class CorGCN(nn.Module):
     def forward(self, input_seq, g_node_feature, g):
         x_feature = self.content_feature(input_seq, g_node_feature)
 
-        label_feature = self.gcn(g, g_node_feature)
-        label_feature = torch.cat((label_feature, g_node_feature), dim=1)  # torch.Size([29368, 400])
+        label_feature = self.label_features(g, g_node_feature)  # torch.Size([29368, 400])
 
         x = torch.sum(x_feature * label_feature, dim=2)
         cor_logit = self.cornet(x)
@@ -752,7 +884,7 @@ class CorGCN(nn.Module):
         return cor_logit
 
 
-class MeSH_GCN_Multi(nn.Module):
+class MeSH_GCN_Multi(LabelFeatureCache, nn.Module):
     def __init__(self, vocab_size, nKernel, ksz, hidden_gcn_size, add_original_embedding, atten_dropout, output_size,
                  embedding_dim=200, cornet_dim=1000, n_cornet_blocks=2):
         super(MeSH_GCN_Multi, self).__init__()
@@ -773,20 +905,19 @@ class MeSH_GCN_Multi(nn.Module):
     def forward(self, input_seq, input_title, g_node_feature, g):
         x_feature = self.content_feature(input_seq, input_title, g_node_feature)
 
-        label_feature = self.gcn(g, g_node_feature)
-
-        label_feature = torch.cat((label_feature, g_node_feature), dim=1)  # torch.Size([29368, 400])
+        label_feature = self.label_features(g, g_node_feature)  # torch.Size([29368, 400])
         x = torch.sum(x_feature * label_feature, dim=2)
         x = self.cornet(x)
         x = torch.sigmoid(x)
         return x
 
 
-class Bert_GCN(nn.Module):
-    def __init__(self, config, num_label):
+class Bert_GCN(LabelFeatureCache, nn.Module):
+    def __init__(self, config, num_label, label_chunk=0):
         super(Bert_GCN, self).__init__()
 
         self.config = config
+        self.label_chunk = label_chunk
         self.bert = BertModel(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         # self-attention
@@ -804,6 +935,27 @@ class Bert_GCN(nn.Module):
         self.linear_final = torch.nn.Linear(config.hidden_size, config.hidden_size)
         self.output_layer = torch.nn.Linear(config.hidden_size, 1)
 
+    def _compute_label_features(self, g, g_node_feature):
+        return self.gcn(g, g_node_feature)
+
+    def _label_scores(self, start, end, output, attention_ab, label_feature):
+        self_atten_out = self.atten(output, attention_ab, start, end)
+        label_feature = label_feature[start:end]
+        label_atten = torch.softmax(torch.matmul(output, label_feature.transpose(0, 1)), dim=1)
+        label_atten_out = torch.matmul(output.transpose(1, 2), label_atten)  # [bz, hidden_sz, number_label]
+
+        # attention fusion output
+        factor1 = torch.sigmoid(self.linear_weight1(self_atten_out))
+        factor2 = torch.sigmoid(self.linear_weight2(label_atten_out.transpose(1, 2)))
+        factor1 = factor1 / (factor1 + factor2)
+        factor2 = 1 - factor1
+
+        out = factor1 * self_atten_out + factor2 * (label_atten_out.transpose(1, 2))
+        out = F.relu(self.linear_final(out))
+        out = torch.sigmoid(self.output_layer(out).squeeze(-1))
+
+        return out
+
     def forward(self, input_ab, attention_ab, g, g_node_feature):
         # input_ab, input_title, attention_ab, attention_title, g, g_node_feature
         # self-attention output
@@ -816,28 +968,15 @@ class Bert_GCN(nn.Module):
         # output = torch.cat((title_output, ab_output), dim=1)
         # attention_mask = torch.cat((attention_title, attention_ab), dim=0)
         # self_atten_out = self.atten(output, attention_mask) # [bz, num_label, hidden_sz] [8, 29368, 768]
-        self_atten_out = self.atten(output, attention_ab)
 
         # label-wise attention output mapping different parts of the document representation to different labels
-        label_feature = self.gcn(g, g_node_feature)  # [num_labels, hidden_sz] (29468, 768)
+        label_feature = self.label_features(g, g_node_feature)  # [num_labels, hidden_sz] (29468, 768)
         # label_feature = torch.cat((label_feature, g_node_feature), dim=1)  # [29468, 768*2]
         # output_trans = self.linear(output)
         # label_atten = torch.softmax(torch.matmul(output_trans, label_feature.transpose(0, 1)),
         #                             dim=1)
-        label_atten = torch.softmax(torch.matmul(output, label_feature.transpose(0, 1)), dim=1)
-        label_atten_out = torch.matmul(output.transpose(1, 2), label_atten)  # [bz, hidden_sz, number_label]
-
-        # attention fusion output
-        factor1 = torch.sigmoid(self.linear_weight1(self_atten_out))
-        factor2 = torch.sigmoid(self.linear_weight2(label_atten_out.transpose(1, 2)))
-        factor1 = factor1 / (factor1 + factor2)
-        factor2 = 1 - factor1
-
-        out = factor1 * self_atten_out + factor2 * (label_atten_out.transpose(1, 2))
-        out = F.relu(self.linear_final(out))
-        out = torch.sigmoid(self.output_layer(out).squeeze(-1))
-
-        return out
+        return chunked_label_scores(self._label_scores, label_feature.shape[0], self.label_chunk, output, attention_ab,
+                                    label_feature)
 
 
 class BaseRGCN(nn.Module):
@@ -0,0 +1,45 @@
+import numpy as np
+import torch
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+"""
+ONNX Runtime inference for the Full model exported with ``python export.py --method onnx``.
+
+``OnnxScorer`` is called like the eager model in ``run_eval.test``,
+    scores = scorer(abstract, title, mask, ab_length, title_length, g, g_node_feature)
+with the padded token ids, the float MeSH mask and the lengths as torch tensors. The label features are
+baked into the ONNX graph, so ``g`` and ``g_node_feature`` are ignored. The scores come back as a CPU
+float tensor.
+"""
+
+ONNX_INPUTS = ('abstract', 'title', 'mask', 'ab_length', 'title_length')
+ONNX_OUTPUT = 'scores'
+
+
+class OnnxScorer(object):
+    """
+    Arguments:
+        path: .onnx file written by export.py.
+        num_threads: intra-op threads of the session, by default ONNX Runtime's (one per physical core).
+    """
+
+    def __init__(self, path, num_threads=0):
+        if onnxruntime is None:
+            raise ImportError('ONNX inference needs the onnxruntime package')
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def eval(self):
+        return self
+
+    def __call__(self, abstract, title, mask, ab_length, title_length, g=None, g_node_feature=None):
+        inputs = (abstract.long(), title.long(), mask.float(), torch.as_tensor(ab_length).long(),
+                  torch.as_tensor(title_length).long())
+        feed = {name: np.ascontiguousarray(tensor.cpu().numpy()) for name, tensor in zip(ONNX_INPUTS, inputs)}
+        scores, = self.session.run([ONNX_OUTPUT], feed)
+        return torch.from_numpy(scores)
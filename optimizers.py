@@ -0,0 +1,86 @@
+import torch
+import torch.nn as nn
+from torch.optim.lr_scheduler import StepLR
+
+"""
+Optimizers for models with sparse embedding gradients.
+
+With ``sparse_embedding=True`` the multichannel models build their ``nn.Embedding`` with ``sparse=True``:
+the backward pass then gives a gradient only for the rows of the tokens in the batch instead of a dense
+(vocab_size, embedding_dim) tensor. Adam does not take sparse gradients, so ``split_adam`` puts the
+sparse embeddings under ``torch.optim.SparseAdam``, which updates the moments and weights of those rows
+only, and the other parameters under Adam. ``step_lr`` builds the StepLR schedule of either. The
+training loops use both like a single optimizer and scheduler.
+
+SparseAdam is lazy: the moments of a row are only updated in the steps where the row has a gradient,
+so after the first step training is not step for step the same as with dense Adam.
+"""
+
+
+class MultiOptimizer(object):
+    """ Optimizers of disjoint parameter sets, stepped together """
+
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+class MultiLRScheduler(object):
+    """ One learning rate scheduler per optimizer of a MultiOptimizer """
+
+    def __init__(self, *schedulers):
+        self.schedulers = schedulers
+
+    def step(self):
+        for scheduler in self.schedulers:
+            scheduler.step()
+
+    def get_last_lr(self):
+        return [lr for scheduler in self.schedulers for lr in scheduler.get_last_lr()]
+
+    def state_dict(self):
+        return [scheduler.state_dict() for scheduler in self.schedulers]
+
+    def load_state_dict(self, state_dicts):
+        for scheduler, state_dict in zip(self.schedulers, state_dicts):
+            scheduler.load_state_dict(state_dict)
+
+
+def sparse_parameters(model):
+    """ Trainable weights of the embeddings of a model that produce sparse gradients """
+    return [module.weight for module in model.modules()
+            if isinstance(module, nn.Embedding) and module.sparse and module.weight.requires_grad]
+
+
+def split_adam(model, lr):
+    """ SparseAdam for the sparse embeddings and Adam for the other parameters, plain Adam without sparse embeddings """
+    sparse = sparse_parameters(model)
+    if not sparse:
+        return torch.optim.Adam(model.parameters(), lr=lr)
+    sparse_ids = {id(param) for param in sparse}
+    dense = [param for param in model.parameters() if id(param) not in sparse_ids]
+    return MultiOptimizer(torch.optim.SparseAdam(sparse, lr=lr), torch.optim.Adam(dense, lr=lr))
+
+
+def step_lr(optimizer, step_size, gamma):
+    if isinstance(optimizer, MultiOptimizer):
+        return MultiLRScheduler(*[StepLR(o, step_size=step_size, gamma=gamma) for o in optimizer.optimizers])
+    return StepLR(optimizer, step_size=step_size, gamma=gamma)
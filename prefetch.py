@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+
+import torch
+
+from utils import densify
+
+"""
+Background batch preparation for the training loops.
+
+``BatchPrefetcher`` wraps a DataLoader of ``utils.generate_batch`` batches. A background thread
+takes batch N+1 from the loader, densifies the labels and MeSH masks and copies the token ids to
+the device (``non_blocking``, on a side CUDA stream) while the model computes on batch N.
+``wait_time`` is the time the training loop spent waiting for data.
+"""
+
+PREFETCH_DEPTH = 2
+
+_END = object()
+
+
+class BatchPrefetcher(object):
+    """
+    Arguments:
+        loader: DataLoader with ``generate_batch`` as collate function.
+        num_labels: number of labels (columns of the densified label and mask matrices).
+        device: device the model runs on.
+        depth: number of batches prepared ahead.
+    Yields (label, mask, abstract, title, abstract_length, title_length) or (label, mask, text,
+    text_length): dense float label and mask matrices and token ids on ``device``, the int64
+    lengths on the host (as ``pack_padded_sequence`` wants them).
+    """
+
+    def __init__(self, loader, num_labels, device, depth=PREFETCH_DEPTH):
+        self.loader = loader
+        self.num_labels = num_labels
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0.
+        self._stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, batch):
+        num_channels = (len(batch) - 2) // 2
+        label = densify(*batch[0], self.num_labels, self.device)
+        mask = densify(*batch[1], self.num_labels, self.device)
+        tokens = tuple(tokens.to(self.device, non_blocking=True) for tokens in batch[2:2 + num_channels])
+        return (label, mask) + tokens + tuple(batch[2 + num_channels:])
+
+    @staticmethod
+    def _put(batches, item, stop):
+        """ Enqueue an item unless the consumer stopped, returns whether it was enqueued """
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self.loader:
+                if self._stream is not None:
+                    with torch.cuda.stream(self._stream):
+                        batch = self._prepare(batch)
+                    # the host buffers of the batch can be reused once the copies are done
+                    self._stream.synchronize()
+                else:
+                    batch = self._prepare(batch)
+                if not self._put(batches, batch, stop):
+                    return
+            self._put(batches, _END, stop)
+        except Exception as e:
+            self._put(batches, e, stop)
+
+    def __iter__(self):
+        self.wait_time = 0.
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = batches.get()
+                self.wait_time += time.perf_counter() - start
+                if batch is _END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if self._stream is not None:
+                    # tensors allocated on the side stream are now used on the compute stream
+                    current = torch.cuda.current_stream(self.device)
+                    for tensor in batch[:2 + (len(batch) - 2) // 2]:
+                        tensor.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
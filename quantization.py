@@ -0,0 +1,112 @@
+import inspect
+
+import torch
+import torch.nn as nn
+from torch.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare, quantize_dynamic
+
+from model import MLAttention
+
+"""
+Int8 quantization of the KenMeSH models for CPU inference.
+
+``dynamic``: the weights of the LSTM and Linear layers (BiLSTM, CorNet blocks) are stored in int8 and
+their activations are quantized on the fly, no calibration needed.
+``static``: in addition the Conv1d layers (the dilated CNN) run in int8, with activation ranges
+observed on a few calibration batches.
+
+The GCN label encoder stays in float: its output is computed once in eval mode (or stored in the
+checkpoint) and is not on the per-document path. The label-wise attention of ``MLAttention`` reads
+slices of its weight and stays in float as well.
+
+A quantized checkpoint is ``{'quantization': mode, 'state_dict': ...}``; ``load_quantized`` builds the
+quantized modules on a float model of the same configuration and loads it. Quantized models only run
+on the CPU.
+"""
+
+QUANTIZATION_MODES = ('dynamic', 'static')
+QUANTIZATION_KEY = 'quantization'
+
+
+class StaticConv1d(nn.Module):
+    """ Conv1d with int8 weights and activations, float inputs and outputs """
+
+    def __init__(self, conv):
+        super(StaticConv1d, self).__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def _float_prefixes(model):
+    return tuple(name + '.' for name, module in model.named_modules()
+                 if name.split('.')[-1] == 'gcn' or isinstance(module, MLAttention))
+
+
+def _wrap_convs(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv1d):
+            setattr(module, name, StaticConv1d(child))
+        elif not isinstance(child, StaticConv1d):
+            _wrap_convs(child)
+
+
+def quantize_model(model, mode='dynamic', calibrate=None):
+    """
+    Quantize a float model in place, returns it in eval mode.
+    Arguments:
+        model: float model, on the CPU.
+        mode: 'dynamic' or 'static'.
+        calibrate: static mode, ``calibrate(model)`` runs a few batches through the model to observe the
+                   conv activations. Without it the activation ranges are left for ``load_state_dict``.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError('unknown quantization mode %s, expected one of %s' % (mode, ', '.join(QUANTIZATION_MODES)))
+    model.eval()
+    if mode == 'static':
+        _wrap_convs(model)
+        qconfig = get_default_qconfig('fbgemm')
+        for module in model.modules():
+            if isinstance(module, StaticConv1d):
+                module.qconfig = qconfig
+        prepare(model, inplace=True)
+        if calibrate is not None:
+            with torch.no_grad():
+                calibrate(model)
+        convert(model, inplace=True)
+
+    float_prefixes = _float_prefixes(model)
+    layers = {name for name, module in model.named_modules()
+              if isinstance(module, (nn.LSTM, nn.Linear)) and not name.startswith(float_prefixes)}
+    quantize_dynamic(model, layers, dtype=torch.qint8, inplace=True)
+    model.quantization = mode
+    return model
+
+
+def quantized_checkpoint(model):
+    return {QUANTIZATION_KEY: model.quantization, 'state_dict': model.state_dict()}
+
+
+def load_checkpoint(path, map_location=None):
+    """
+    torch.load of a trusted model checkpoint, float or quantized. The packed int8 weights of a quantized
+    checkpoint are not plain tensors, so newer torch (weights_only by default) needs weights_only=False.
+    """
+    kwargs = {}
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        kwargs['weights_only'] = False
+    return torch.load(path, map_location=map_location, **kwargs)
+
+
+def is_quantized_checkpoint(checkpoint):
+    return isinstance(checkpoint, dict) and QUANTIZATION_KEY in checkpoint
+
+
+def load_quantized(model, checkpoint):
+    """ Quantize a float model the way the checkpoint was made and load its weights """
+    quantize_model(model.cpu(), checkpoint[QUANTIZATION_KEY])
+    model.load_state_dict(checkpoint['state_dict'])
+    return model
+
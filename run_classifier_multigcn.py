@@ -12,14 +12,19 @@ import matplotlib.pyplot as plt
 from dgl.data.utils import load_graphs
 from sklearn.preprocessing import MultiLabelBinarizer
 from torch.utils.data import DataLoader, random_split
-from torchtext.vocab import Vectors
 from tqdm import tqdm
 
+from corpus_store import corpus_files, load_corpus
 from eval_helper import precision_at_ks, example_based_evaluation, micro_macro_eval, zero_division
 from losses import *
 from model import *
+from optimizers import split_adam, step_lr
+from prefetch import BatchPrefetcher
 from pytorchtools import EarlyStopping
-from utils import MeSH_indexing, pad_sequence
+from utils import HASH_RESERVED, MeSH_indexing, batching_loader_kwargs, collate_loader_kwargs, \
+    bf16_autocast, set_loader_epoch, vocab_settings
+from vocab_io import load_vocab, save_vocab, vocab_path_for
+from word_vectors import load_vectors, weight_matrix
 
 
 def set_seed(seed):
@@ -36,15 +41,14 @@ def flatten(l):
     return flat
 
 
-def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pair_file, word2vec_path, graph_file, is_multichannel):
+def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pair_file, word2vec_path, graph_file, is_multichannel, corpus_path=None, cache_dir=None,
+                    preprocess_workers=1, vocab_path=None, compact_dataset=False, ngrams=1, hash_buckets=0,
+                    hash_reserved=HASH_RESERVED):
     """ Load Dataset and Preprocessing """
     # load training data
     print('Start loading training data')
-    mesh_mask = pickle.load(open(mask_path, 'rb'))
-
-    all_title = pickle.load(open(title_path, 'rb'))
-    all_text = pickle.load(open(abstract_path, 'rb'))
-    label_id = pickle.load(open(label_path, 'rb'))
+    all_title, all_text, label_id, mesh_mask = load_corpus(title_path, abstract_path, label_path, mask_path,
+                                                           corpus_path)
 
     assert len(all_text) == len(all_title), 'title and abstract in the training set are not matching'
     print('Finish loading training data')
@@ -67,13 +71,20 @@ def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pa
 
     # create Vector object map tokens to vectors
     print('load pre-trained BioWord2Vec')
-    cache, name = os.path.split(word2vec_path)
-    vectors = Vectors(name=name, cache=cache)
+    vectors = load_vectors(word2vec_path)
 
     # Preparing training and test datasets
     print('prepare training and test sets')
+    vocab = None
+    if vocab_path is not None and os.path.exists(vocab_path):
+        print('load vocab from %s' % vocab_path)
+        vocab = load_vocab(vocab_path)
+        ngrams = vocab.settings.get('ngrams', ngrams)
     dataset = MeSH_indexing(all_text, all_title, all_text, all_title, label_id, mesh_mask, all_text[-20000:],
-                            all_title[-20000:], label_id[-20000:], mesh_mask[-20000:], is_test=False, is_multichannel=is_multichannel)
+                            all_title[-20000:], label_id[-20000:], mesh_mask[-20000:], is_test=False, is_multichannel=is_multichannel,
+                            cache_dir=cache_dir, num_workers=preprocess_workers, vocab=vocab, compact=compact_dataset,
+                            ngrams=ngrams, hash_buckets=hash_buckets, hash_reserved=hash_reserved,
+                            source_files=corpus_files(title_path, abstract_path, label_path, mask_path, corpus_path))
 
     # build vocab
     print('building vocab')
@@ -90,61 +101,16 @@ def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pa
     return len(meshIDs), mlb, vocab, train_dataset, valid_dataset, vectors, G
 
 
-def weight_matrix(vocab, vectors, dim=200):
-    weight_matrix = np.zeros([len(vocab.itos), dim])
-    for i, token in enumerate(vocab.stoi):
-        try:
-            weight_matrix[i] = vectors.__getitem__(token)
-        except KeyError:
-            weight_matrix[i] = np.random.normal(scale=0.5, size=(dim,))
-    return torch.from_numpy(weight_matrix)
-
-
-def generate_batch(batch):
-    """
-    Output:
-        text: the text entries in the data_batch are packed into a list and
-            concatenated as a single tensor for the input of nn.EmbeddingBag.
-        cls: a tensor saving the labels of individual text entries.
-    """
-    # check if the dataset is multi-channel or not
-    if len(batch[0]) == 4:
-        label = [entry[0] for entry in batch]
-        mesh_mask = [entry[1] for entry in batch]
-
-        # padding according to the maximum sequence length in batch
-        abstract = [entry[2] for entry in batch]
-        abstract_length = [len(seq) for seq in abstract]
-        abstract = pad_sequence(abstract, ksz=3, batch_first=True)
-
-        title = [entry[3] for entry in batch]
-        title_length = []
-        for i, seq in enumerate(title):
-            if len(seq) == 0:
-                length = len(seq) + 1
-            else:
-                length = len(seq)
-            title_length.append(length)
-        title = pad_sequence(title, ksz=3, batch_first=True)
-        return label, mesh_mask, abstract, title, abstract_length, title_length
-
-    else:
-        label = [entry[0] for entry in batch]
-        mesh_mask = [entry[1] for entry in batch]
-
-        text = [entry[2] for entry in batch]
-        text_length = [len(seq) for seq in text]
-        text = pad_sequence(text, ksz=3, batch_first=True)
-
-        return label, mesh_mask, text, text_length
-
-
 def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, criterion, device, num_workers, optimizer,
-          lr_scheduler, model_name):
+          lr_scheduler, model_name, bucket_batches=False, max_tokens=0, bf16=False):
 
-    train_data = DataLoader(train_dataset, batch_size=batch_sz, shuffle=True, collate_fn=generate_batch, num_workers=num_workers, pin_memory=True)
+    train_data = DataLoader(train_dataset, num_workers=num_workers,
+                            **collate_loader_kwargs(num_workers, batch_sz, max_tokens),
+                            **batching_loader_kwargs(train_dataset, batch_sz, True, bucket_batches, max_tokens))
 
-    valid_data = DataLoader(valid_dataset, batch_size=batch_sz, shuffle=True, collate_fn=generate_batch, num_workers=num_workers, pin_memory=True)
+    valid_data = DataLoader(valid_dataset, num_workers=num_workers,
+                            **collate_loader_kwargs(num_workers, batch_sz, max_tokens),
+                            **batching_loader_kwargs(valid_dataset, batch_sz, True, bucket_batches, max_tokens))
 
     print('train', len(train_data.dataset))
 
@@ -155,20 +121,21 @@ def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, cri
 
     early_stopping = EarlyStopping(patience=3, verbose=True)
 
+    # the label graph does not change, move it to the device once
+    G = G.to(device)
+    G.ndata['feat'] = G.ndata['feat'].to(device)
+    train_batches = BatchPrefetcher(train_data, len(mlb.classes_), device)
+    valid_batches = BatchPrefetcher(valid_data, len(mlb.classes_), device)
+
     print("Training....")
     for epoch in range(num_epochs):
+        set_loader_epoch(train_data, epoch)
         model.train()  # prep model for training
         if model_name == 'ablation1':
-            for i, (label, mesh_mask, text, text_length) in enumerate(train_data):
-                label = torch.from_numpy(mlb.fit_transform(label)).type(torch.float)
-                mesh_mask = torch.from_numpy(mlb.fit_transform(mesh_mask)).type(torch.float)
-                text_length = torch.Tensor(text_length)
-                text, label, mesh_mask, text_length = text.to(device), label.to(device), mesh_mask.to(
-                    device), text_length.to(device)
-                G = G.to(device)
-                G.ndata['feat'] = G.ndata['feat'].to(device)
-                output = model(text, text_length, mesh_mask, G, G.ndata['feat'])
-                loss = criterion(output, label)
+            for i, (label, mesh_mask, text, text_length) in enumerate(train_batches):
+                with bf16_autocast(bf16, device):
+                    output = model(text, text_length, mesh_mask, G, G.ndata['feat'])
+                loss = criterion(output.float(), label)
 
                 torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=5)
                 loss.backward()
@@ -183,38 +150,26 @@ def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, cri
 
             with torch.no_grad():
                 model.eval()
-                for i, (label, mesh_mask, text, text_length) in enumerate(valid_data):
-                    label = torch.from_numpy(mlb.fit_transform(label)).type(torch.float)
-                    mesh_mask = torch.from_numpy(mlb.fit_transform(mesh_mask)).type(torch.float)
-                    text_length = torch.Tensor(text_length)
-                    text, label, mesh_mask, text_length = text.to(device), label.to(device), mesh_mask.to(
-                        device), text_length.to(device)
-                    G = G.to(device)
-                    G.ndata['feat'] = G.ndata['feat'].to(device)
-
-                    output = model(text, text_length, mesh_mask, G, G.ndata['feat'])
+                for i, (label, mesh_mask, text, text_length) in enumerate(valid_batches):
+                    with bf16_autocast(bf16, device):
+                        output = model(text, text_length, mesh_mask, G, G.ndata['feat'])
 
-                    loss = criterion(output, label)
+                    loss = criterion(output.float(), label)
                     valid_losses.append(loss.item())
         else:
-            for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(train_data):
-                label = torch.from_numpy(mlb.fit_transform(label)).type(torch.float)
-                mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-                abstract_length = torch.Tensor(abstract_length)
-                title_length = torch.Tensor(title_length)
-                abstract, title, label, mask, abstract_length, title_length = abstract.to(device), title.to(device), label.to(device), mask.to(device), abstract_length.to(device), title_length.to(device)
-                G = G.to(device)
-                G.ndata['feat'] = G.ndata['feat'].to(device)
-                if model_name == "Full":
-                    output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
-                elif model_name == "ablation2":
-                    output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
-                elif model_name == "ablation3":
-                    output = model(abstract, title, mask, abstract_length, title_length, G.ndata['feat'])
-                elif model_name == "HGCN4MeSH":
-                    output = model(abstract, title, abstract_length, title_length, G, G.ndata['feat'])
-
-                loss = criterion(output, label)
+            for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(train_batches):
+                with bf16_autocast(bf16, device):
+                    if model_name == "Full":
+                        output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
+                    elif model_name == "ablation2":
+                        output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
+                    elif model_name == "ablation3":
+                        output = model(abstract, title, mask, abstract_length, title_length, G.ndata['feat'])
+                    elif model_name == "HGCN4MeSH":
+                        output = model(abstract, title, abstract_length, title_length, G, G.ndata['feat'])
+
+                # the BCE loss is computed in fp32
+                loss = criterion(output.float(), label)
                 torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=5)
                 loss.backward()
                 optimizer.step()
@@ -228,25 +183,18 @@ def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, cri
 
             with torch.no_grad():
                 model.eval()
-                for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(valid_data):
-                    label = torch.from_numpy(mlb.fit_transform(label)).type(torch.float)
-                    mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-                    abstract_length = torch.Tensor(abstract_length)
-                    title_length = torch.Tensor(title_length)
-                    abstract, title, label, mask, abstract_length, title_length = abstract.to(device), title.to(device), label.to(device), mask.to(device), abstract_length.to(device), title_length.to(device)
-                    G = G.to(device)
-                    G.ndata['feat'] = G.ndata['feat'].to(device)
-
-                    if model_name == "Full":
-                        output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
-                    elif model_name == "ablation2":
-                        output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
-                    elif model_name == "ablation3":
-                        output = model(abstract, title, mask, abstract_length, title_length, G.ndata['feat'])
-                    elif model_name == "HGCN4MeSH":
-                        output = model(abstract, title, abstract_length, title_length, G, G.ndata['feat'])
-
-                    loss = criterion(output, label)
+                for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(valid_batches):
+                    with bf16_autocast(bf16, device):
+                        if model_name == "Full":
+                            output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
+                        elif model_name == "ablation2":
+                            output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
+                        elif model_name == "ablation3":
+                            output = model(abstract, title, mask, abstract_length, title_length, G.ndata['feat'])
+                        elif model_name == "HGCN4MeSH":
+                            output = model(abstract, title, abstract_length, title_length, G, G.ndata['feat'])
+
+                    loss = criterion(output.float(), label)
                     valid_losses.append(loss.item())
 
         train_loss = np.average(train_losses)
@@ -258,7 +206,8 @@ def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, cri
 
         print_msg = (f'[{epoch:>{epoch_len}}/{num_epochs:>{epoch_len}}] ' +
                      f'train_loss: {train_loss:.5f} ' +
-                     f'valid_loss: {valid_loss:.5f}')
+                     f'valid_loss: {valid_loss:.5f} ' +
+                     f'data_wait: {train_batches.wait_time + valid_batches.wait_time:.1f}s')
         print(print_msg)
 
         # clear lists to track next epoch
@@ -338,11 +287,29 @@ def main():
     parser.add_argument('--abstract_path')
     parser.add_argument('--label_path')
     parser.add_argument('--mask_path')
+    parser.add_argument('--corpus_path', help='corpus store written by corpus_store.py, used instead of the pickles')
+    parser.add_argument('--cache_dir', help='directory caching the tokenized corpus and vocab between runs')
+    parser.add_argument('--preprocess_workers', type=int, default=1, help='processes used to tokenize the corpus')
+    parser.add_argument('--vocab_path', help='load this vocab instead of building it from the corpus')
+    parser.add_argument('--compact_dataset', action='store_true', help='keep the tokenized corpus in flat arrays (less memory per DataLoader worker)')
+    parser.add_argument('--bucket_batches', action='store_true', help='batch documents of similar abstract length together')
+    parser.add_argument('--max_tokens', type=int, default=0, help='padded abstract tokens per batch with --bucket_batches, instead of --batch_sz')
+    parser.add_argument('--label_chunk', type=int, default=0, help='score the labels in blocks of this size (checkpointed in training) to bound memory, 0 scores all at once')
+    parser.add_argument('--candidates', action='store_true', help='masked models: only score the labels inside the MeSH mask')
+    parser.add_argument('--candidate_fill', type=float, default=CANDIDATE_FILL, help='score of the labels outside the mask with --candidates')
+    parser.add_argument('--fuse_rnn', action='store_true', help='run title and abstract through the BiLSTM in one packed call')
+    parser.add_argument('--bf16', action='store_true', help='run the models under bfloat16 autocast (softmax and loss in fp32), needs torch >= 1.10')
+    parser.add_argument('--checkpoint_stages', nargs='*', choices=CHECKPOINT_STAGES, default=[], help='Full model: stages recomputed in backward instead of keeping their activations')
+    parser.add_argument('--sparse_embedding', action='store_true', help='multichannel models: sparse embedding gradients, trained with SparseAdam (Adam for the other parameters)')
+    parser.add_argument('--ngrams', type=int, default=1, help='n-gram order of the vocab, best used with --hash_buckets')
+    parser.add_argument('--hash_buckets', type=int, default=0, help='hash words outside the reserved vocab and n-grams into this many embedding rows')
+    parser.add_argument('--hash_reserved', type=int, default=HASH_RESERVED, help='most frequent words with their own embedding row in a hashed vocab')
     parser.add_argument('----meSH_pair_path')
     parser.add_argument('--word2vec_path')
     parser.add_argument('--meSH_pair_path')
     parser.add_argument('--graph')
     parser.add_argument('--save-model-path')
+    parser.add_argument('--store_label_features', action='store_true', help='save the GCN label features with the model, inference then needs neither the label graph nor DGL')
     parser.add_argument('--model_name', default='Full', type=str)
 
     parser.add_argument('--device', default='cuda', type=str)
@@ -374,77 +341,120 @@ def main():
     if args.model_name == 'Full':
         num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
                                                                           args.label_path, args.mask_path, args.meSH_pair_path,
-                                                                          args.word2vec_path, args.graph, is_multichannel=True)
+                                                                          args.word2vec_path, args.graph, is_multichannel=True, corpus_path=args.corpus_path,
+                                                                          cache_dir=args.cache_dir,
+                                                                          preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path,
+                                                                          compact_dataset=args.compact_dataset,
+                                                                          ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
         vocab_size = len(vocab)
         model = multichannel_dilatedCNN_with_MeSH_mask(vocab_size, args.dropout, args.ksz, num_nodes, G, device,
                                                        embedding_dim=200, rnn_num_layers=2, cornet_dim=1000,
-                                                       n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
+                                                       n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                                       candidates=args.candidates, candidate_fill=args.candidate_fill, fuse_rnn=args.fuse_rnn,
+                                                       checkpoint_stages=args.checkpoint_stages, sparse_embedding=args.sparse_embedding)
+        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                              vectors_path=args.word2vec_path)).to(device)
     elif args.model_name == 'ablation1':
         num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
                                                                           args.label_path, args.mask_path,
                                                                           args.meSH_pair_path,
                                                                           args.word2vec_path, args.graph,
-                                                                          is_multichannel=False)
+                                                                          is_multichannel=False, corpus_path=args.corpus_path,
+                                                                          cache_dir=args.cache_dir,
+                                                                          preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path,
+                                                                          compact_dataset=args.compact_dataset,
+                                                                          ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
         vocab_size = len(vocab)
         model = single_channel_dilatedCNN(vocab_size, args.dropout, args.ksz, num_nodes, embedding_dim=200,
-                                          rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
+                                          rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                          candidates=args.candidates, candidate_fill=args.candidate_fill)
+        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                              vectors_path=args.word2vec_path)).to(device)
     elif args.model_name == 'ablation2':
         num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
                                                                           args.label_path, args.mask_path,
                                                                           args.meSH_pair_path,
                                                                           args.word2vec_path, args.graph,
-                                                                          is_multichannel=True)
+                                                                          is_multichannel=True, corpus_path=args.corpus_path,
+                                                                          cache_dir=args.cache_dir,
+                                                                          preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path,
+                                                                          compact_dataset=args.compact_dataset,
+                                                                          ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
         vocab_size = len(vocab)
         model = multichannel_with_MeSH_mask(vocab_size, args.dropout, args.ksz, num_nodes, G, device, embedding_dim=200,
-                                            rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
+                                            rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                            candidates=args.candidates, candidate_fill=args.candidate_fill, fuse_rnn=args.fuse_rnn,
+                                            sparse_embedding=args.sparse_embedding)
+        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                              vectors_path=args.word2vec_path)).to(device)
     elif args.model_name == 'ablation3':
         num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
                                                                           args.label_path, args.mask_path,
                                                                           args.meSH_pair_path,
                                                                           args.word2vec_path, args.graph,
-                                                                          is_multichannel=True)
+                                                                          is_multichannel=True, corpus_path=args.corpus_path,
+                                                                          cache_dir=args.cache_dir,
+                                                                          preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path,
+                                                                          compact_dataset=args.compact_dataset,
+                                                                          ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
         vocab_size = len(vocab)
         model = multichannel_dilatedCNN_without_graph(vocab_size, args.dropout, args.ksz, num_nodes, embedding_dim=200,
-                                                      rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
+                                                      rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk, fuse_rnn=args.fuse_rnn,
+                                                      sparse_embedding=args.sparse_embedding)
+        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                              vectors_path=args.word2vec_path)).to(device)
     elif args.model_name == 'ablation4':
         num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
                                                                           args.label_path, args.mask_path,
                                                                           args.meSH_pair_path,
                                                                           args.word2vec_path, args.graph,
-                                                                          is_multichannel=True)
+                                                                          is_multichannel=True, corpus_path=args.corpus_path,
+                                                                          cache_dir=args.cache_dir,
+                                                                          preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path,
+                                                                          compact_dataset=args.compact_dataset,
+                                                                          ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
         vocab_size = len(vocab)
         model = multichannel_dilatedCNN(vocab_size, args.dropout, args.ksz, num_nodes, G, device, embedding_dim=200,
-                                        rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
+                                        rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk, fuse_rnn=args.fuse_rnn,
+                                        sparse_embedding=args.sparse_embedding)
+        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                              vectors_path=args.word2vec_path)).to(device)
     elif args.model_name == 'HGCN4MeSH':
         num_nodes, mlb, vocab, train_dataset, valid_dataset, vectors, G = \
             prepare_dataset(args.title_path, args.abstract_path, args.label_path, args.mask_path, args.meSH_pair_path,
-                            args.word2vec_path, args.graph, is_multichannel=True)
+                            args.word2vec_path, args.graph, is_multichannel=True, corpus_path=args.corpus_path,
+                            cache_dir=args.cache_dir,
+                            preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path,
+                            compact_dataset=args.compact_dataset,
+                            ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
         vocab_size = len(vocab)
 
         model = HGCN4MeSH(vocab_size, args.dropout, args.ksz, embedding_dim=200, rnn_num_layers=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
+        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                              vectors_path=args.word2vec_path)).to(device)
 
     model.to(device)
     G = G.to(device)
 
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
-    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=args.scheduler_step_sz, gamma=args.lr_gamma)
+    # SparseAdam for a sparse embedding, Adam for the other parameters
+    optimizer = split_adam(model, args.lr)
+    lr_scheduler = step_lr(optimizer, args.scheduler_step_sz, args.lr_gamma)
     criterion = nn.BCEWithLogitsLoss()
 
     # training
     print("Start training!")
     model, train_loss, valid_loss = train(train_dataset, valid_dataset, model, mlb, G, args.batch_sz,
                                           args.num_epochs, criterion, device, args.num_workers, optimizer, lr_scheduler,
-                                          args.model_name)
+                                          args.model_name, bucket_batches=args.bucket_batches, max_tokens=args.max_tokens,
+                                          bf16=args.bf16)
     print('Finish training!')
 
     print('save model for inference')
+    if args.store_label_features:
+        G = G.to(device)
+        model.store_label_features(G, G.ndata['feat'])
     torch.save(model.state_dict(), args.save_model_path)
+    save_vocab(vocab, vocab_path_for(args.save_model_path), vocab_settings(args.ngrams))
 
 
 if __name__ == "__main__":
@@ -10,12 +10,17 @@ from dgl.data.utils import load_graphs
 from sklearn.preprocessing import MultiLabelBinarizer
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import SubsetRandomSampler
-from torchtext.vocab import Vectors
 
+from corpus_store import corpus_files, load_corpus
 from eval_helper import precision_at_ks, example_based_evaluation, micro_macro_eval, zero_division
 from model import *
+from optimizers import split_adam, step_lr
+from prefetch import BatchPrefetcher
 from pytorchtools import EarlyStopping
-from utils import MeSH_indexing, pad_sequence, DistributedSamplerWrapper
+from utils import HASH_RESERVED, MeSH_indexing, BucketBatchSampler, DistributedSamplerWrapper, batching_loader_kwargs, \
+    collate_loader_kwargs, dataset_lengths, densify, vocab_settings
+from vocab_io import load_vocab, save_vocab, vocab_path_for
+from word_vectors import load_vectors, weight_matrix
 
 
 def set_seed(seed):
@@ -32,15 +37,14 @@ def flatten(l):
     return flat
 
 
-def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pair_file, word2vec_path, graph_file, num_example): #graph_cooccurence_file
+def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pair_file, word2vec_path, graph_file, num_example, corpus_path=None, cache_dir=None,
+                    preprocess_workers=1, vocab_path=None, compact_dataset=False, ngrams=1, hash_buckets=0,
+                    hash_reserved=HASH_RESERVED): #graph_cooccurence_file
     """ Load Dataset and Preprocessing """
     # load training data
     print('Start loading training data')
-    mesh_mask = pickle.load(open(mask_path, 'rb'))
-
-    all_title = pickle.load(open(title_path, 'rb'))
-    all_text = pickle.load(open(abstract_path, 'rb'))
-    label_id = pickle.load(open(label_path, 'rb'))
+    all_title, all_text, label_id, mesh_mask = load_corpus(title_path, abstract_path, label_path, mask_path,
+                                                           corpus_path)
 
     assert len(all_text) == len(all_title) #'title and abstract in the training set are not matching'
     print('Finish loading training data')
@@ -64,15 +68,22 @@ def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pa
 
     # create Vector object map tokens to vectors
     print('load pre-trained BioWord2Vec')
-    cache, name = os.path.split(word2vec_path)
-    vectors = Vectors(name=name, cache=cache)
+    vectors = load_vectors(word2vec_path)
 
     # Preparing training and test datasets
     print('prepare training and test sets')
 
+    vocab = None
+    if vocab_path is not None and os.path.exists(vocab_path):
+        print('load vocab from %s' % vocab_path)
+        vocab = load_vocab(vocab_path)
+        ngrams = vocab.settings.get('ngrams', ngrams)
     dataset = MeSH_indexing(all_text, all_title, all_text[:num_example], all_title[:num_example],
-                            label_id[:num_example], all_text[-20000:], all_title[-20000:], label_id[-20000:],
-                            is_test=False, is_multichannel=True)
+                            label_id[:num_example], mesh_mask[:num_example], all_text[-20000:], all_title[-20000:],
+                            label_id[-20000:], mesh_mask[-20000:], is_test=False, is_multichannel=True,
+                            cache_dir=cache_dir, num_workers=preprocess_workers, vocab=vocab, compact=compact_dataset,
+                            ngrams=ngrams, hash_buckets=hash_buckets, hash_reserved=hash_reserved,
+                            source_files=corpus_files(title_path, abstract_path, label_path, mask_path, corpus_path))
 
     # get validation set
     valid_size = 0.02
@@ -96,63 +107,32 @@ def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pa
     return len(meshIDs), mlb, vocab, dataset, vectors, G, train_sampler, valid_sampler
 
 
-def weight_matrix(vocab, vectors, dim=200):
-    weight_matrix = np.zeros([len(vocab.itos), dim])
-    for i, token in enumerate(vocab.stoi):
-        try:
-            weight_matrix[i] = vectors.__getitem__(token)
-        except KeyError:
-            weight_matrix[i] = np.random.normal(scale=0.5, size=(dim,))
-    return torch.from_numpy(weight_matrix)
-
-
-def generate_batch(batch):
-    """
-    Output:
-        text: the text entries in the data_batch are packed into a list and
-            concatenated as a single tensor for the input of nn.EmbeddingBag.
-        cls: a tensor saving the labels of individual text entries.
-    """
-    # check if the dataset is multi-channel or not
-    if len(batch[0]) == 3:
-        label = [entry[0] for entry in batch]
-
-        # padding according to the maximum sequence length in batch
-        abstract = [entry[1] for entry in batch]
-        abstract_length = [len(seq) for seq in abstract]
-        abstract = pad_sequence(abstract, ksz=3, batch_first=True)
-
-        title = [entry[2] for entry in batch]
-        title_length = []
-        for i, seq in enumerate(title):
-            if len(seq) == 0:
-                length = len(seq) + 1
-            else:
-                length = len(seq)
-            title_length.append(length)
-        title = pad_sequence(title, ksz=3, batch_first=True)
-        return label, abstract, title, abstract_length, title_length
-
-    else:
-        label = [entry[0] for entry in batch]
-
-        text = [entry[1] for entry in batch]
-        text_length = [len(seq) for seq in text]
-        text = pad_sequence(text, ksz=3, batch_first=True)
-
-        return label, text, text_length
-
-
 def train(train_dataset, train_sampler, valid_sampler, model, mlb, G, batch_sz, num_epochs, criterion, device,
-          num_workers, optimizer, lr_scheduler, world_size, rank):
-    _train_sampler = DistributedSamplerWrapper(train_sampler, num_replicas=world_size, rank=rank)
+          num_workers, optimizer, lr_scheduler, world_size, rank, bucket_batches=False, max_tokens=0):
+    if bucket_batches:
+        # every rank draws the same seeded batches, the wrappers hand each rank its share of them
+        lengths = dataset_lengths(train_dataset)
+        batch_size = None if max_tokens > 0 else batch_sz
+        _train_sampler = DistributedSamplerWrapper(
+            BucketBatchSampler(lengths, batch_size, max_tokens or None, indices=train_sampler.indices),
+            num_replicas=world_size, rank=rank)
+        train_data = DataLoader(train_dataset, batch_sampler=_train_sampler, num_workers=num_workers,
+                                **collate_loader_kwargs(num_workers, batch_sz, max_tokens))
+
+        _valid_sampler = DistributedSamplerWrapper(
+            BucketBatchSampler(lengths, batch_size, max_tokens or None, indices=valid_sampler.indices),
+            num_replicas=world_size, rank=rank)
+        valid_data = DataLoader(train_dataset, batch_sampler=_valid_sampler, num_workers=num_workers,
+                                **collate_loader_kwargs(num_workers, batch_sz, max_tokens))
+    else:
+        _train_sampler = DistributedSamplerWrapper(train_sampler, num_replicas=world_size, rank=rank)
 
-    train_data = DataLoader(train_dataset, batch_size=batch_sz, sampler=_train_sampler, collate_fn=generate_batch,
-                            num_workers=num_workers, pin_memory=True)
+        train_data = DataLoader(train_dataset, batch_size=batch_sz, sampler=_train_sampler, num_workers=num_workers,
+                                **collate_loader_kwargs(num_workers, batch_sz))
 
-    _valid_sampler = DistributedSamplerWrapper(valid_sampler, num_replicas=world_size, rank=rank)
-    valid_data = DataLoader(train_dataset, batch_size=batch_sz, sampler=_valid_sampler,
-                            collate_fn=generate_batch, num_workers=num_workers, pin_memory=True)
+        _valid_sampler = DistributedSamplerWrapper(valid_sampler, num_replicas=world_size, rank=rank)
+        valid_data = DataLoader(train_dataset, batch_size=batch_sz, sampler=_valid_sampler, num_workers=num_workers,
+                                **collate_loader_kwargs(num_workers, batch_sz))
 
     # num_lines = num_epochs * len(train_data)
 
@@ -163,18 +143,17 @@ def train(train_dataset, train_sampler, valid_sampler, model, mlb, G, batch_sz,
 
     early_stopping = EarlyStopping(patience=3, verbose=True)
 
+    # the label graph does not change, move it to the device once
+    G = G.to(device)
+    G.ndata['feat'] = G.ndata['feat'].to(device)
+    train_batches = BatchPrefetcher(train_data, len(mlb.classes_), device)
+    valid_batches = BatchPrefetcher(valid_data, len(mlb.classes_), device)
+
     print("Training....")
     for epoch in range(num_epochs):
+        _train_sampler.set_epoch(epoch)
         model.train()  # prep model for training
-        for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(train_data):
-            label = torch.from_numpy(mlb.fit_transform(label)).type(torch.float)
-            mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-            abstract_length = torch.Tensor(abstract_length)
-            title_length = torch.Tensor(title_length)
-            abstract, title, label, mask, abstract_length, title_length = abstract.to(device), title.to(device), label.to(device), mask.to(device), abstract_length.to(device), title_length.to(device)
-
-            G = G.to(device)
-            G.ndata['feat'] = G.ndata['feat'].to(device)
+        for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(train_batches):
             output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
 
             optimizer.zero_grad()
@@ -189,15 +168,7 @@ def train(train_dataset, train_sampler, valid_sampler, model, mlb, G, batch_sz,
 
         model.eval()
         with torch.no_grad():
-            for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(valid_data):
-                label = torch.from_numpy(mlb.fit_transform(label)).type(torch.float)
-                mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-                abstract_length = torch.Tensor(abstract_length)
-                title_length = torch.Tensor(title_length)
-                abstract, title, label, mask, abstract_length, title_length = abstract.to(device), title.to(device), label.to(device), mask.to(device), abstract_length.to(device), title_length.to(device)
-
-                G = G.to(device)
-                G.ndata['feat'] = G.ndata['feat'].to(device)
+            for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(valid_batches):
                 output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat']) #, G_c, G_c.ndata['feat'])
 
                 loss = criterion(output, label)
@@ -212,7 +183,8 @@ def train(train_dataset, train_sampler, valid_sampler, model, mlb, G, batch_sz,
 
         print_msg = (f'[{epoch:>{epoch_len}}/{num_epochs:>{epoch_len}}] ' +
                      f'train_loss: {train_loss:.5f} ' +
-                     f'valid_loss: {valid_loss:.5f}')
+                     f'valid_loss: {valid_loss:.5f} ' +
+                     f'data_wait: {train_batches.wait_time + valid_batches.wait_time:.1f}s')
         print(print_msg)
 
         # clear lists to track next epoch
@@ -227,8 +199,9 @@ def train(train_dataset, train_sampler, valid_sampler, model, mlb, G, batch_sz,
     return model, avg_train_losses, avg_valid_losses
 
 
-def test(test_dataset, model, mlb, G, batch_sz, device):
-    test_data = DataLoader(test_dataset, batch_size=batch_sz, collate_fn=generate_batch, shuffle=False, pin_memory=True)
+def test(test_dataset, model, mlb, G, batch_sz, device, bucket_batches=False, max_tokens=0):
+    test_data = DataLoader(test_dataset, **collate_loader_kwargs(0, batch_sz, max_tokens),
+                           **batching_loader_kwargs(test_dataset, batch_sz, False, bucket_batches, max_tokens))
     pred = []
     true_label = []
     top_k_precisions = []
@@ -240,15 +213,14 @@ def test(test_dataset, model, mlb, G, batch_sz, device):
     fp = 0.
     fn = 0.
     print('Testing....')
+    G = G.to(device)
+    G.ndata['feat'] = G.ndata['feat'].to(device)
     model.eval()
     for label, mask, abstract, title, abstract_length, title_length in test_data:
-        mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-        abstract_length = torch.Tensor(abstract_length)
-        title_length = torch.Tensor(title_length)
-        mask, abstract, title, abstract_length, title_length = mask.to(device), abstract.to(device), title.to(device), abstract_length.to(device), title_length.to(device)
+        mask = densify(*mask, len(mlb.classes_), device)
+        abstract, title = abstract.to(device), title.to(device)
 
-        G, G.ndata['feat'] = G.to(device), G.ndata['feat'].to(device)
-        label = mlb.fit_transform(label)
+        label = densify(*label, len(mlb.classes_)).numpy()
 
         with torch.no_grad():
             output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat']) #, G_c, G_c.ndata['feat'])
@@ -365,8 +337,8 @@ def preallocate_gpu_memory(G, model, batch_sz, device, num_label, criterion):
     sudo_title = torch.randint(123900, size=(batch_sz, 60), device=device)
     sudo_label = torch.randint(2, size=(batch_sz, num_label), device=device).type(torch.float)
     sudo_mask = torch.randint(2, size=(batch_sz, num_label), device=device).type(torch.float)
-    sudo_abstract_length = torch.full((batch_sz,), 400, dtype=int, device=device)
-    sudo_title_length = torch.full((batch_sz,), 60, dtype=int, device=device)
+    sudo_abstract_length = torch.full((batch_sz,), 400, dtype=torch.long)
+    sudo_title_length = torch.full((batch_sz,), 60, dtype=torch.long)
     G, G.ndata['feat'] = G.to(device), G.ndata['feat'].to(device)
 
     output = model(sudo_abstract, sudo_title, sudo_mask, sudo_abstract_length, sudo_title_length, G, G.ndata['feat'])  # , G_c, G_c.ndata['feat'])
@@ -383,6 +355,22 @@ def main():
     parser.add_argument('--abstract_path')
     parser.add_argument('--label_path')
     parser.add_argument('--mask_path')
+    parser.add_argument('--corpus_path', help='corpus store written by corpus_store.py, used instead of the pickles')
+    parser.add_argument('--cache_dir', help='directory caching the tokenized corpus and vocab between runs')
+    parser.add_argument('--preprocess_workers', type=int, default=1, help='processes used to tokenize the corpus')
+    parser.add_argument('--vocab_path', help='load this vocab instead of building it from the corpus')
+    parser.add_argument('--compact_dataset', action='store_true', help='keep the tokenized corpus in flat arrays (less memory per DataLoader worker)')
+    parser.add_argument('--bucket_batches', action='store_true', help='batch documents of similar abstract length together')
+    parser.add_argument('--max_tokens', type=int, default=0, help='padded abstract tokens per batch with --bucket_batches, instead of --batch_sz')
+    parser.add_argument('--label_chunk', type=int, default=0, help='score the labels in blocks of this size (checkpointed in training) to bound memory, 0 scores all at once')
+    parser.add_argument('--candidates', action='store_true', help='masked models: only score the labels inside the MeSH mask')
+    parser.add_argument('--candidate_fill', type=float, default=CANDIDATE_FILL, help='score of the labels outside the mask with --candidates')
+    parser.add_argument('--fuse_rnn', action='store_true', help='run title and abstract through the BiLSTM in one packed call')
+    parser.add_argument('--checkpoint_stages', nargs='*', choices=CHECKPOINT_STAGES, default=[], help='Full model: stages recomputed in backward instead of keeping their activations')
+    parser.add_argument('--sparse_embedding', action='store_true', help='not supported with DistributedDataParallel on CUDA, see run_classifier_multigcn.py')
+    parser.add_argument('--ngrams', type=int, default=1, help='n-gram order of the vocab, best used with --hash_buckets')
+    parser.add_argument('--hash_buckets', type=int, default=0, help='hash words outside the reserved vocab and n-grams into this many embedding rows')
+    parser.add_argument('--hash_reserved', type=int, default=HASH_RESERVED, help='most frequent words with their own embedding row in a hashed vocab')
     parser.add_argument('----meSH_pair_path')
     parser.add_argument('--word2vec_path')
     parser.add_argument('--meSH_pair_path')
@@ -391,6 +379,7 @@ def main():
     parser.add_argument('--results')
     parser.add_argument('--true')
     parser.add_argument('--save-model-path')
+    parser.add_argument('--store_label_features', action='store_true', help='save the GCN label features with the model, inference then needs neither the label graph nor DGL')
     parser.add_argument('--loss')
 
     parser.add_argument('--num_example', type=int, default=10000)
@@ -416,6 +405,11 @@ def main():
     parser.add_argument('--dist_backend', default='nccl', type=str, help='distributed backend')
 
     args = parser.parse_args()
+    if args.sparse_embedding:
+        # this script trains on CUDA; NCCL cannot all-reduce sparse gradients and sparse gradients under
+        # DistributedDataParallel were only checked on the CPU with gloo
+        parser.error('--sparse_embedding is not supported by run_distributed.py, train with run_classifier_multigcn.py '
+                     'or without it')
     set_seed(0)
     ngpus_per_node = torch.cuda.device_count()
     print('number of gpus per node: %d' % ngpus_per_node)
@@ -437,20 +431,28 @@ def main():
     # Get dataset and label graph & Load pre-trained embeddings
     num_nodes, mlb, vocab, train_dataset, vectors, G, train_sampler, valid_sampler = prepare_dataset(
         args.title_path, args.abstract_path, args.label_path, args.mask_path, args.meSH_pair_path, args.word2vec_path,
-        args.graph, args.num_example)
+        args.graph, args.num_example, corpus_path=args.corpus_path,
+        cache_dir=args.cache_dir,
+        preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path,
+        compact_dataset=args.compact_dataset,
+        ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
 
     vocab_size = len(vocab)
     model = multichannel_dilatedCNN_with_MeSH_mask(vocab_size, args.dropout, args.ksz, num_nodes, G, current_device,
-                                    embedding_dim=200, rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
+                                    embedding_dim=200, rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                    candidates=args.candidates, candidate_fill=args.candidate_fill, fuse_rnn=args.fuse_rnn,
+                                    checkpoint_stages=args.checkpoint_stages, sparse_embedding=args.sparse_embedding)
 
-    model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).cuda()
+    model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                          vectors_path=args.word2vec_path)).cuda()
 
     model.cuda()
     model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[current_device], output_device=current_device)
     print('From Rank: {}, ==> Preparing data..'.format(rank))
 
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
-    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=args.scheduler_step_sz, gamma=args.lr_gamma)
+    # SparseAdam for a sparse embedding, Adam for the other parameters
+    optimizer = split_adam(model, args.lr)
+    lr_scheduler = step_lr(optimizer, args.scheduler_step_sz, args.lr_gamma)
     criterion = nn.BCEWithLogitsLoss().cuda()
 
     preallocate_gpu_memory(G, model, args.batch_sz, current_device, num_nodes, criterion)
@@ -458,11 +460,17 @@ def main():
     print("Start training!")
     model, train_loss, valid_loss = train(train_dataset, train_sampler, valid_sampler, model, mlb, G, args.batch_sz,
                                           args.num_epochs, criterion, current_device, args.num_workers, optimizer,
-                                          lr_scheduler, world_size, rank)
+                                          lr_scheduler, world_size, rank, bucket_batches=args.bucket_batches,
+                                          max_tokens=args.max_tokens)
     print('Finish training!')
 
     print('save model')
+    if args.store_label_features:
+        G = G.to(current_device)
+        model.module.store_label_features(G, G.ndata['feat'])
     torch.save(model.state_dict(), args.save_model_path)
+    if rank == 0:
+        save_vocab(vocab, vocab_path_for(args.save_model_path), vocab_settings(args.ngrams))
 
     # load model
     # model = torch.load(args.model_path)
@@ -3,15 +3,23 @@ import os
 import pickle
 import random
 
-from dgl.data.utils import load_graphs
+import numpy as np
+import torch
 from sklearn.preprocessing import MultiLabelBinarizer
 from torch.utils.data import DataLoader
-from torchtext.vocab import Vectors
 
+from attention import CANDIDATE_FILL
+from corpus_store import corpus_files, load_corpus
 from eval_helper import precision_at_ks, example_based_evaluation, micro_macro_eval
-from model import *
+from onnx_backend import OnnxScorer
 from threshold import *
-from utils import MeSH_indexing, pad_sequence
+from utils import HASH_RESERVED, MeSH_indexing, batching_loader_kwargs, bf16_autocast, collate_loader_kwargs, densify
+from vocab_io import check_embedding, load_vocab, vocab_path_for
+from word_vectors import load_vectors, weight_matrix
+try:
+    from dgl.data.utils import load_graphs
+except ImportError:
+    load_graphs = None
 
 
 def set_seed(seed):
@@ -28,15 +36,14 @@ def flatten(l):
     return flat
 
 
-def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pair_file, word2vec_path, graph_file, is_multichannel=True): #graph_cooccurence_file
+def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pair_file, word2vec_path, graph_file, is_multichannel=True, corpus_path=None, cache_dir=None,
+                    preprocess_workers=1, vocab_path=None, compact_dataset=False, ngrams=1, hash_buckets=0,
+                    hash_reserved=HASH_RESERVED): #graph_cooccurence_file
     """ Load Dataset and Preprocessing """
     # load training data
     print('Start loading training data')
-    mesh_mask = pickle.load(open(mask_path, 'rb'))
-
-    all_title = pickle.load(open(title_path, 'rb'))
-    all_text = pickle.load(open(abstract_path, 'rb'))
-    label_id = pickle.load(open(label_path, 'rb'))
+    all_title, all_text, label_id, mesh_mask = load_corpus(title_path, abstract_path, label_path, mask_path,
+                                                           corpus_path)
 
     assert len(all_text) == len(all_title), 'title and abstract in the training set are not matching'
     print('Finish loading training data')
@@ -62,118 +69,84 @@ def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pa
     mlb.fit(mesh_index)
 
     # create Vector object map tokens to vectors
-    print('load pre-trained BioWord2Vec')
-    cache, name = os.path.split(word2vec_path)
-    vectors = Vectors(name=name, cache=cache)
+    vectors = None
+    if word2vec_path is not None:
+        print('load pre-trained BioWord2Vec')
+        vectors = load_vectors(word2vec_path)
 
     # Preparing training and test datasets
     print('prepare training and test sets')
+    vocab = None
+    if vocab_path is not None and os.path.exists(vocab_path):
+        print('load vocab from %s' % vocab_path)
+        vocab = load_vocab(vocab_path)
+        ngrams = vocab.settings.get('ngrams', ngrams)
     dataset = MeSH_indexing(all_text, all_title, all_text, all_title, label_id, mesh_mask, all_text[-20000:],
                             all_title[-20000:], label_id[-20000:], mesh_mask[-20000:], is_test=True,
-                            is_multichannel=is_multichannel)
+                            is_multichannel=is_multichannel,
+                            cache_dir=cache_dir, num_workers=preprocess_workers, vocab=vocab, compact=compact_dataset,
+                            ngrams=ngrams, hash_buckets=hash_buckets, hash_reserved=hash_reserved,
+                            source_files=corpus_files(title_path, abstract_path, label_path, mask_path, corpus_path))
 
     # build vocab
     print('building vocab')
     vocab = dataset.get_vocab()
 
     # Prepare label features
-    print('Load graph')
-    G = load_graphs(graph_file)[0][0]
-    print('graph', G.ndata['feat'].shape)
+    G = None
+    if graph_file is not None:
+        print('Load graph')
+        G = load_graphs(graph_file)[0][0]
+        print('graph', G.ndata['feat'].shape)
 
     print('prepare dataset and labels graph done!')
     return len(meshIDs), mlb, vocab, dataset, vectors, G#, neg_pos_ratio#, train_sampler, valid_sampler #, G_c
 
 
-def weight_matrix(vocab, vectors, dim=200):
-    weight_matrix = np.zeros([len(vocab.itos), dim])
-    for i, token in enumerate(vocab.stoi):
-        try:
-            weight_matrix[i] = vectors.__getitem__(token)
-        except KeyError:
-            weight_matrix[i] = np.random.normal(scale=0.5, size=(dim,))
-    return torch.from_numpy(weight_matrix)
-
-
-def generate_batch(batch):
-    """
-    Output:
-        text: the text entries in the data_batch are packed into a list and
-            concatenated as a single tensor for the input of nn.EmbeddingBag.
-        cls: a tensor saving the labels of individual text entries.
-    """
-    # check if the dataset is multi-channel or not
-    if len(batch[0]) == 4:
-        label = [entry[0] for entry in batch]
-        mesh_mask = [entry[1] for entry in batch]
-
-        # padding according to the maximum sequence length in batch
-        abstract = [entry[2] for entry in batch]
-        abstract_length = [len(seq) for seq in abstract]
-        abstract = pad_sequence(abstract, ksz=3, batch_first=True)
-
-        title = [entry[3] for entry in batch]
-        title_length = []
-        for i, seq in enumerate(title):
-            if len(seq) == 0:
-                length = len(seq) + 1
-            else:
-                length = len(seq)
-            title_length.append(length)
-        title = pad_sequence(title, ksz=3, batch_first=True)
-        return label, mesh_mask, abstract, title, abstract_length, title_length
-
-    else:
-        label = [entry[0] for entry in batch]
-        mesh_mask = [entry[1] for entry in batch]
-
-        text = [entry[2] for entry in batch]
-        text_length = [len(seq) for seq in text]
-        text = pad_sequence(text, ksz=3, batch_first=True)
-
-        return label, mesh_mask, text, text_length
-
-
-def test(test_dataset, model, mlb, G, batch_sz, device, model_name="Full"):
-    test_data = DataLoader(test_dataset, batch_size=batch_sz, collate_fn=generate_batch, shuffle=False, pin_memory=True)
+def test(test_dataset, model, mlb, G, batch_sz, device, model_name="Full", bucket_batches=False, max_tokens=0,
+         bf16=False):
+    test_data = DataLoader(test_dataset, **collate_loader_kwargs(0, batch_sz, max_tokens),
+                           **batching_loader_kwargs(test_dataset, batch_sz, False, bucket_batches, max_tokens))
     pred = []
     true_label = []
 
     print('Testing....')
+    g_node_feature = None
+    if G is not None:
+        G = G.to(device)
+        G.ndata['feat'] = G.ndata['feat'].to(device)
+        g_node_feature = G.ndata['feat']
     with torch.no_grad():
         model.eval()
         if model_name == 'ablation1':
             for label, mesh_mask, text, text_length in test_data:
-                mesh_mask = torch.from_numpy(mlb.fit_transform(mesh_mask)).type(torch.float)
-                text_length = torch.Tensor(text_length)
+                mesh_mask = densify(*mesh_mask, len(mlb.classes_), device)
 
-                mesh_mask, text, text_length = mesh_mask.to(device), text.to(device), text_length.to(device)
-                G, G.ndata['feat'] = G.to(device), G.ndata['feat'].to(device)
-                label = mlb.fit_transform(label)
-                output = model(text, text_length, mesh_mask, G, G.ndata['feat'])
+                text = text.to(device)
+                label = densify(*label, len(mlb.classes_)).numpy()
+                with bf16_autocast(bf16, device):
+                    output = model(text, text_length, mesh_mask, G, g_node_feature)
 
-                results = output.data.cpu().numpy()
+                results = output.data.float().cpu().numpy()
                 pred.append(results)
                 true_label.append(label)
         else:
             for label, mask, abstract, title, abstract_length, title_length in test_data:
-                mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-                abstract_length = torch.Tensor(abstract_length)
-                title_length = torch.Tensor(title_length)
-                mask, abstract, title, abstract_length, title_length = mask.to(device), abstract.to(device), title.to(device), abstract_length.to(device), title_length.to(device)
-                G, G.ndata['feat'] = G.to(device), G.ndata['feat'].to(device)
-                label = mlb.fit_transform(label)
-
-                if model_name == "Full":
-                    output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
-                elif model_name == "ablation2":
-                    output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat'])
-                elif model_name == "ablation3":
-                    output = model(abstract, title, mask, abstract_length, title_length, G.ndata['feat'])
-                elif model_name == "HGCN4MeSH":
-                    output = model(abstract, title, abstract_length, title_length, G, G.ndata['feat'])
-
-                results = output.data.cpu().numpy()
+                mask = densify(*mask, len(mlb.classes_), device)
+                abstract, title = abstract.to(device), title.to(device)
+                label = densify(*label, len(mlb.classes_)).numpy()
+
+                with bf16_autocast(bf16, device):
+                    if model_name == "Full":
+                        output = model(abstract, title, mask, abstract_length, title_length, G, g_node_feature)
+                    elif model_name == "ablation2":
+                        output = model(abstract, title, mask, abstract_length, title_length, G, g_node_feature)
+                    elif model_name == "ablation3":
+                        output = model(abstract, title, mask, abstract_length, title_length, g_node_feature)
+                    elif model_name == "HGCN4MeSH":
+                        output = model(abstract, title, abstract_length, title_length, G, g_node_feature)
+
+                results = output.data.float().cpu().numpy()
                 pred.append(results)
                 true_label.append(label)
 
@@ -209,12 +182,73 @@ def getLabelIndex(labels):
     return label_index
 
 
+def load_model(args, num_nodes, vocab, vectors, G, device):
+    """ Eager model of --model_name with the weights of the --model checkpoint, and the device it runs on """
+    # imported here: ONNX evaluation does not need model.py and its DGL and transformers imports
+    from model import HGCN4MeSH, multichannel_dilatedCNN, multichannel_dilatedCNN_with_MeSH_mask, \
+        multichannel_dilatedCNN_without_graph, multichannel_with_MeSH_mask, single_channel_dilatedCNN
+    from quantization import QUANTIZATION_KEY, is_quantized_checkpoint, load_checkpoint, load_quantized
+
+    vocab_size = len(vocab)
+    if args.model_name == 'Full':
+        model = multichannel_dilatedCNN_with_MeSH_mask(vocab_size, args.dropout, args.ksz, num_nodes, G, device,
+                                                       embedding_dim=200, rnn_num_layers=2, cornet_dim=1000,
+                                                       n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                                       candidates=args.candidates, candidate_fill=args.candidate_fill, fuse_rnn=args.fuse_rnn)
+    elif args.model_name == 'ablation1':
+        model = single_channel_dilatedCNN(vocab_size, args.dropout, args.ksz, num_nodes, embedding_dim=200,
+                                          rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                          candidates=args.candidates, candidate_fill=args.candidate_fill)
+    elif args.model_name == 'ablation2':
+        model = multichannel_with_MeSH_mask(vocab_size, args.dropout, args.ksz, num_nodes, G, device, embedding_dim=200,
+                                            rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                            candidates=args.candidates, candidate_fill=args.candidate_fill, fuse_rnn=args.fuse_rnn)
+    elif args.model_name == 'ablation3':
+        model = multichannel_dilatedCNN_without_graph(vocab_size, args.dropout, args.ksz, num_nodes, embedding_dim=200,
+                                                      rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk, fuse_rnn=args.fuse_rnn)
+    elif args.model_name == 'ablation4':
+        model = multichannel_dilatedCNN(vocab_size, args.dropout, args.ksz, num_nodes, G, device, embedding_dim=200,
+                                        rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk, fuse_rnn=args.fuse_rnn)
+    elif args.model_name == 'HGCN4MeSH':
+        model = HGCN4MeSH(vocab_size, args.dropout, args.ksz, embedding_dim=200, rnn_num_layers=2)
+    model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                          vectors_path=args.word2vec_path)).to(device)
+
+    state_dict = load_checkpoint(args.model)
+    if is_quantized_checkpoint(state_dict):
+        # int8 models (quantization.py) only run on the CPU
+        print('load %s quantized model' % state_dict[QUANTIZATION_KEY])
+        device = torch.device('cpu')
+        check_embedding(state_dict['state_dict'], vocab, model.embedding_layer.weight.shape[1])
+        load_quantized(model, state_dict)
+    else:
+        check_embedding(state_dict, vocab, model.embedding_layer.weight.shape[1])
+        model.load_state_dict(state_dict)
+    model.to(device)
+    return model, device
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--title_path')
     parser.add_argument('--abstract_path')
     parser.add_argument('--label_path')
     parser.add_argument('--mask_path')
+    parser.add_argument('--corpus_path', help='corpus store written by corpus_store.py, used instead of the pickles')
+    parser.add_argument('--cache_dir', help='directory caching the tokenized corpus and vocab between runs')
+    parser.add_argument('--preprocess_workers', type=int, default=1, help='processes used to tokenize the corpus')
+    parser.add_argument('--vocab_path', help='vocab saved with the model, defaults to <model>.vocab.json')
+    parser.add_argument('--compact_dataset', action='store_true', help='keep the tokenized corpus in flat arrays (less memory per DataLoader worker)')
+    parser.add_argument('--bucket_batches', action='store_true', help='batch documents of similar abstract length together')
+    parser.add_argument('--max_tokens', type=int, default=0, help='padded abstract tokens per batch with --bucket_batches, instead of --batch_sz')
+    parser.add_argument('--label_chunk', type=int, default=0, help='score the labels in blocks of this size (checkpointed in training) to bound memory, 0 scores all at once')
+    parser.add_argument('--candidates', action='store_true', help='masked models: only score the labels inside the MeSH mask')
+    parser.add_argument('--candidate_fill', type=float, default=CANDIDATE_FILL, help='score of the labels outside the mask with --candidates')
+    parser.add_argument('--fuse_rnn', action='store_true', help='run title and abstract through the BiLSTM in one packed call')
+    parser.add_argument('--bf16', action='store_true', help='run the models under bfloat16 autocast (softmax and loss in fp32), needs torch >= 1.10')
+    parser.add_argument('--ngrams', type=int, default=1, help='n-gram order of the vocab, best used with --hash_buckets')
+    parser.add_argument('--hash_buckets', type=int, default=0, help='hash words outside the reserved vocab and n-grams into this many embedding rows')
+    parser.add_argument('--hash_reserved', type=int, default=HASH_RESERVED, help='most frequent words with their own embedding row in a hashed vocab')
     parser.add_argument('----meSH_pair_path')
     parser.add_argument('--word2vec_path')
     parser.add_argument('--meSH_pair_path')
@@ -247,71 +281,38 @@ def main():
     device = torch.device(args.device if torch.cuda.is_available() else "cpu")
     print('Device:{}'.format(device))
 
-    # Get dataset and label graph & Load pre-trained embeddings
-    if args.model_name == 'Full':
-        num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
-                                                                          args.label_path, args.mask_path, args.meSH_pair_path,
-                                                                          args.word2vec_path, args.graph, is_multichannel=True)
-        vocab_size = len(vocab)
-        model = multichannel_dilatedCNN_with_MeSH_mask(vocab_size, args.dropout, args.ksz, num_nodes, G, device,
-                                                       embedding_dim=200, rnn_num_layers=2, cornet_dim=1000,
-                                                       n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
-    elif args.model_name == 'ablation1':
-        num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
-                                                                          args.label_path, args.mask_path,
-                                                                          args.meSH_pair_path,
-                                                                          args.word2vec_path, args.graph,
-                                                                          is_multichannel=False)
-        vocab_size = len(vocab)
-        model = single_channel_dilatedCNN(vocab_size, args.dropout, args.ksz, num_nodes, embedding_dim=200,
-                                          rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
-    elif args.model_name == 'ablation2':
-        num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
-                                                                          args.label_path, args.mask_path,
-                                                                          args.meSH_pair_path,
-                                                                          args.word2vec_path, args.graph,
-                                                                          is_multichannel=True)
-        vocab_size = len(vocab)
-        model = multichannel_with_MeSH_mask(vocab_size, args.dropout, args.ksz, num_nodes, G, device, embedding_dim=200,
-                                            rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
-    elif args.model_name == 'ablation3':
-        num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
-                                                                          args.label_path, args.mask_path,
-                                                                          args.meSH_pair_path,
-                                                                          args.word2vec_path, args.graph,
-                                                                          is_multichannel=True)
-        vocab_size = len(vocab)
-        model = multichannel_dilatedCNN_without_graph(vocab_size, args.dropout, args.ksz, num_nodes, embedding_dim=200,
-                                                      rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
-    elif args.model_name == 'ablation4':
-        num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
-                                                                          args.label_path, args.mask_path,
-                                                                          args.meSH_pair_path,
-                                                                          args.word2vec_path, args.graph,
-                                                                          is_multichannel=True)
-        vocab_size = len(vocab)
-        model = multichannel_dilatedCNN(vocab_size, args.dropout, args.ksz, num_nodes, G, device, embedding_dim=200,
-                                        rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
-    elif args.model_name == 'HGCN4MeSH':
-        num_nodes, mlb, vocab, train_dataset, valid_dataset, vectors, G = \
-            prepare_dataset(args.title_path, args.abstract_path, args.label_path, args.mask_path, args.meSH_pair_path,
-                            args.word2vec_path, args.graph, is_multichannel=True)
-        vocab_size = len(vocab)
+    vocab_path = args.vocab_path or vocab_path_for(args.model)
+    if not os.path.exists(vocab_path):
+        print('no vocab file found at %s, rebuilding the vocab from the corpus' % vocab_path)
 
-        model = HGCN4MeSH(vocab_size, args.dropout, args.ksz, embedding_dim=200, rnn_num_layers=2)
-        model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
+    # the ONNX graph (export.py --method onnx) holds the embedding and the label features: it is run without
+    # the word vectors, the label graph and the eager model, so without DGL and transformers
+    onnx_model = args.model.endswith('.onnx')
+    if onnx_model and args.model_name != 'Full':
+        parser.error('export.py only exports the Full model')
 
-    model.load_state_dict(torch.load(args.model))
-    model.to(device)
+    # Get dataset and label graph & Load pre-trained embeddings
+    num_nodes, mlb, vocab, test_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path,
+                                                                      args.label_path, args.mask_path, args.meSH_pair_path,
+                                                                      None if onnx_model else args.word2vec_path,
+                                                                      None if onnx_model else args.graph,
+                                                                      is_multichannel=args.model_name != 'ablation1',
+                                                                      corpus_path=args.corpus_path, cache_dir=args.cache_dir,
+                                                                      preprocess_workers=args.preprocess_workers, vocab_path=vocab_path,
+                                                                      compact_dataset=args.compact_dataset,
+                                                                      ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved)
+
+    if onnx_model:
+        print('run %s with ONNX Runtime' % args.model)
+        model = OnnxScorer(args.model)
+        device = torch.device('cpu')
+    else:
+        model, device = load_model(args, num_nodes, vocab, vectors, G, device)
     model.eval()
 
     # testing
-    pred, true_label = test(test_dataset, model, mlb, G, args.batch_sz, device, model)
+    pred, true_label = test(test_dataset, model, mlb, G, args.batch_sz, device, args.model_name,
+                            bucket_batches=args.bucket_batches, max_tokens=args.max_tokens, bf16=args.bf16)
     pred = np.concatenate(pred, axis=0)
     true_label = np.concatenate(true_label, axis=0)
 
@@ -12,14 +12,19 @@ import matplotlib.pyplot as plt
 from dgl.data.utils import load_graphs
 from sklearn.preprocessing import MultiLabelBinarizer
 from torch.utils.data import DataLoader, random_split
-from torchtext.vocab import Vectors
 from tqdm import tqdm
 
+from corpus_store import corpus_files, load_corpus
 from eval_helper import precision_at_ks, example_based_evaluation, micro_macro_eval, zero_division
 from losses import *
 from model import *
+from optimizers import split_adam, step_lr
+from prefetch import BatchPrefetcher
 from pytorchtools import EarlyStopping
-from utils import MeSH_indexing, pad_sequence
+from utils import HASH_RESERVED, MeSH_indexing, batching_loader_kwargs, collate_loader_kwargs, densify, \
+    bf16_autocast, persistent_loader_kwargs, set_loader_epoch, vocab_settings
+from vocab_io import load_vocab, save_vocab, vocab_path_for
+from word_vectors import load_vectors, weight_matrix
 
 
 def set_seed(seed):
@@ -61,15 +66,14 @@ def get_tail_labels(label_id):
     return tail_label
 
 
-def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pair_file, word2vec_path, graph_file, num_example): #graph_cooccurence_file
+def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pair_file, word2vec_path, graph_file, num_example, corpus_path=None, cache_dir=None,
+                    preprocess_workers=1, vocab_path=None, compact_dataset=False, lazy_dataset=False, lazy_cache_size=0, ngrams=1,
+                    hash_buckets=0, hash_reserved=HASH_RESERVED): #graph_cooccurence_file
     """ Load Dataset and Preprocessing """
     # load training data
     print('Start loading training data')
-    mesh_mask = pickle.load(open(mask_path, 'rb'))
-
-    all_title = pickle.load(open(title_path, 'rb'))
-    all_text = pickle.load(open(abstract_path, 'rb'))
-    label_id = pickle.load(open(label_path, 'rb'))
+    all_title, all_text, label_id, mesh_mask = load_corpus(title_path, abstract_path, label_path, mask_path,
+                                                           corpus_path)
 
     assert len(all_text) == len(all_title), 'title and abstract in the training set are not matching'
     print('Finish loading training data')
@@ -92,13 +96,21 @@ def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pa
 
     # create Vector object map tokens to vectors
     print('load pre-trained BioWord2Vec')
-    cache, name = os.path.split(word2vec_path)
-    vectors = Vectors(name=name, cache=cache)
+    vectors = load_vectors(word2vec_path)
 
     # Preparing training and test datasets
     print('prepare training and test sets')
+    vocab = None
+    if vocab_path is not None and os.path.exists(vocab_path):
+        print('load vocab from %s' % vocab_path)
+        vocab = load_vocab(vocab_path)
+        ngrams = vocab.settings.get('ngrams', ngrams)
     dataset = MeSH_indexing(all_text, all_title, all_text[:num_example], all_title[:num_example], label_id[:num_example], mesh_mask[:num_example], all_text[-20000:],
-                            all_title[-20000:], label_id[-20000:], mesh_mask[-20000:], is_test=False, is_multichannel=True)
+                            all_title[-20000:], label_id[-20000:], mesh_mask[-20000:], is_test=False, is_multichannel=True,
+                            cache_dir=cache_dir, num_workers=preprocess_workers, vocab=vocab, compact=compact_dataset,
+                            ngrams=ngrams, hash_buckets=hash_buckets, hash_reserved=hash_reserved,
+                            lazy=lazy_dataset, lazy_cache_size=lazy_cache_size,
+                            source_files=corpus_files(title_path, abstract_path, label_path, mask_path, corpus_path))
 
     # build vocab
     print('building vocab')
@@ -119,61 +131,20 @@ def prepare_dataset(title_path, abstract_path, label_path, mask_path, MeSH_id_pa
     return len(meshIDs), mlb, vocab, train_dataset, valid_dataset, vectors, G#, neg_pos_ratio#, train_sampler, valid_sampler #, G_c
 
 
-def weight_matrix(vocab, vectors, dim=200):
-    weight_matrix = np.zeros([len(vocab.itos), dim])
-    for i, token in enumerate(vocab.stoi):
-        try:
-            weight_matrix[i] = vectors.__getitem__(token)
-        except KeyError:
-            weight_matrix[i] = np.random.normal(scale=0.5, size=(dim,))
-    return torch.from_numpy(weight_matrix)
-
-
-def generate_batch(batch):
-    """
-    Output:
-        text: the text entries in the data_batch are packed into a list and
-            concatenated as a single tensor for the input of nn.EmbeddingBag.
-        cls: a tensor saving the labels of individual text entries.
-    """
-    # check if the dataset is multi-channel or not
-    if len(batch[0]) == 4:
-        label = [entry[0] for entry in batch]
-        mesh_mask = [entry[1] for entry in batch]
-
-        # padding according to the maximum sequence length in batch
-        abstract = [entry[2] for entry in batch]
-        abstract_length = [len(seq) for seq in abstract]
-        abstract = pad_sequence(abstract, ksz=3, batch_first=True)
-
-        title = [entry[3] for entry in batch]
-        title_length = []
-        for i, seq in enumerate(title):
-            if len(seq) == 0:
-                length = len(seq) + 1
-            else:
-                length = len(seq)
-            title_length.append(length)
-        title = pad_sequence(title, ksz=3, batch_first=True)
-        return label, mesh_mask, abstract, title, abstract_length, title_length
-
-    else:
-        label = [entry[0] for entry in batch]
-        mesh_mask = [entry[1] for entry in batch]
-
-        text = [entry[2] for entry in batch]
-        text_length = [len(seq) for seq in text]
-        text = pad_sequence(text, ksz=3, batch_first=True)
-
-        return label, mesh_mask, text, text_length
-
-
 def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, criterion, device, num_workers, optimizer,
-          lr_scheduler):
+          lr_scheduler, persistent_workers=False, bucket_batches=False, max_tokens=0, bf16=False):
 
-    train_data = DataLoader(train_dataset, batch_size=batch_sz, shuffle=True, collate_fn=generate_batch, num_workers=num_workers, pin_memory=True)
+    # lazy datasets cache numericalized documents inside the workers, keep them alive between epochs
+    loader_kwargs = persistent_loader_kwargs(num_workers) if persistent_workers else {}
+    train_data = DataLoader(train_dataset, num_workers=num_workers,
+                            **collate_loader_kwargs(num_workers, batch_sz, max_tokens),
+                            **batching_loader_kwargs(train_dataset, batch_sz, True, bucket_batches, max_tokens),
+                            **loader_kwargs)
 
-    valid_data = DataLoader(valid_dataset, batch_size=batch_sz, shuffle=True, collate_fn=generate_batch, num_workers=num_workers, pin_memory=True)
+    valid_data = DataLoader(valid_dataset, num_workers=num_workers,
+                            **collate_loader_kwargs(num_workers, batch_sz, max_tokens),
+                            **batching_loader_kwargs(valid_dataset, batch_sz, True, bucket_batches, max_tokens),
+                            **loader_kwargs)
 
     print('train', len(train_data.dataset))
     # num_lines = num_epochs * len(train_data)
@@ -185,20 +156,22 @@ def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, cri
 
     early_stopping = EarlyStopping(patience=3, verbose=True)
 
+    # the label graph does not change, move it to the device once
+    G = G.to(device)
+    G.ndata['feat'] = G.ndata['feat'].to(device)
+    train_batches = BatchPrefetcher(train_data, len(mlb.classes_), device)
+    valid_batches = BatchPrefetcher(valid_data, len(mlb.classes_), device)
+
     print("Training....")
     for epoch in range(num_epochs):
+        set_loader_epoch(train_data, epoch)
         model.train()  # prep model for training
-        for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(train_data):
-            label = torch.from_numpy(mlb.fit_transform(label)).type(torch.float)
-            mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-            abstract_length = torch.Tensor(abstract_length)
-            title_length = torch.Tensor(title_length)
-            abstract, title, label, mask, abstract_length, title_length = abstract.to(device), title.to(device), label.to(device), mask.to(device), abstract_length.to(device), title_length.to(device)
-            G = G.to(device)
-            G.ndata['feat'] = G.ndata['feat'].to(device)
+        for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(train_batches):
             # output = model(abstract, title, mask, abstract_length, title_length, G.ndata['feat'])
-            output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat']) #, G_c, G_c.ndata['feat'])
-            loss = criterion(output, label)
+            with bf16_autocast(bf16, device):
+                output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat']) #, G_c, G_c.ndata['feat'])
+            # the BCE loss is computed in fp32
+            loss = criterion(output.float(), label)
 
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=5)
             loss.backward()
@@ -219,19 +192,12 @@ def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, cri
 
         with torch.no_grad():
             model.eval()
-            for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(valid_data):
-                label = torch.from_numpy(mlb.fit_transform(label)).type(torch.float)
-                mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-                abstract_length = torch.Tensor(abstract_length)
-                title_length = torch.Tensor(title_length)
-                abstract, title, label, mask, abstract_length, title_length = abstract.to(device), title.to(device), label.to(device), mask.to(device), abstract_length.to(device), title_length.to(device)
-                G = G.to(device)
-                G.ndata['feat'] = G.ndata['feat'].to(device)
-
-                output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat']) #, G_c, G_c.ndata['feat'])
+            for i, (label, mask, abstract, title, abstract_length, title_length) in enumerate(valid_batches):
+                with bf16_autocast(bf16, device):
+                    output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat']) #, G_c, G_c.ndata['feat'])
                 # output = model(abstract, title, mask, abstract_length, title_length, G.ndata['feat'])
 
-                loss = criterion(output, label)
+                loss = criterion(output.float(), label)
                 valid_losses.append(loss.item())
 
         train_loss = np.average(train_losses)
@@ -244,7 +210,8 @@ def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, cri
 
         print_msg = (f'[{epoch:>{epoch_len}}/{num_epochs:>{epoch_len}}] ' +
                      f'train_loss: {train_loss:.5f} ' +
-                     f'valid_loss: {valid_loss:.5f}')
+                     f'valid_loss: {valid_loss:.5f} ' +
+                     f'data_wait: {train_batches.wait_time + valid_batches.wait_time:.1f}s')
         print(print_msg)
 
         # clear lists to track next epoch
@@ -259,8 +226,9 @@ def train(train_dataset, valid_dataset, model, mlb, G, batch_sz, num_epochs, cri
     return model, avg_train_losses, avg_valid_losses
 
 
-def test(test_dataset, model, mlb, G, batch_sz, device):
-    test_data = DataLoader(test_dataset, batch_size=batch_sz, collate_fn=generate_batch, shuffle=False, pin_memory=True)
+def test(test_dataset, model, mlb, G, batch_sz, device, bucket_batches=False, max_tokens=0):
+    test_data = DataLoader(test_dataset, **collate_loader_kwargs(0, batch_sz, max_tokens),
+                           **batching_loader_kwargs(test_dataset, batch_sz, False, bucket_batches, max_tokens))
     pred = []
     top_k_precisions = []
     true_label = []
@@ -272,15 +240,14 @@ def test(test_dataset, model, mlb, G, batch_sz, device):
     fp = 0.
     fn = 0.
     print('Testing....')
+    G = G.to(device)
+    G.ndata['feat'] = G.ndata['feat'].to(device)
     with torch.no_grad():
         model.eval()
         for label, mask, abstract, title, abstract_length, title_length in test_data:
-            mask = torch.from_numpy(mlb.fit_transform(mask)).type(torch.float)
-            abstract_length = torch.Tensor(abstract_length)
-            title_length = torch.Tensor(title_length)
-            mask, abstract, title, abstract_length, title_length = mask.to(device), abstract.to(device), title.to(device), abstract_length.to(device), title_length.to(device)
-            G, G.ndata['feat'] = G.to(device), G.ndata['feat'].to(device)
-            label = mlb.fit_transform(label)
+            mask = densify(*mask, len(mlb.classes_), device)
+            abstract, title = abstract.to(device), title.to(device)
+            label = densify(*label, len(mlb.classes_)).numpy()
             # m = torch.nn.Sigmoid().to(device)
             output = model(abstract, title, mask, abstract_length, title_length, G, G.ndata['feat']) #, G_c, G_c.ndata['feat'])
             # output = m(output)
@@ -407,8 +374,8 @@ def preallocate_gpu_memory(G, model, batch_sz, device, num_label, criterion):
     sudo_title = torch.randint(123827, size=(batch_sz, 60), device=device)
     sudo_label = torch.randint(2, size=(batch_sz, num_label), device=device).type(torch.float)
     sudo_mask = torch.randint(2, size=(batch_sz, num_label), device=device).type(torch.float)
-    sudo_abstract_length = torch.full((batch_sz,), 400, dtype=int, device=device)
-    sudo_title_length = torch.full((batch_sz,), 60, dtype=int, device=device)
+    sudo_abstract_length = torch.full((batch_sz,), 400, dtype=torch.long)
+    sudo_title_length = torch.full((batch_sz,), 60, dtype=torch.long)
 
     output = model(sudo_abstract, sudo_title, sudo_mask, sudo_abstract_length, sudo_title_length, G, G.ndata['feat'])  # , G_c, G_c.ndata['feat'])
     loss = criterion(output, sudo_label)
@@ -424,6 +391,25 @@ def main():
     parser.add_argument('--abstract_path')
     parser.add_argument('--label_path')
     parser.add_argument('--mask_path')
+    parser.add_argument('--corpus_path', help='corpus store written by corpus_store.py, used instead of the pickles')
+    parser.add_argument('--cache_dir', help='directory caching the tokenized corpus and vocab between runs')
+    parser.add_argument('--preprocess_workers', type=int, default=1, help='processes used to tokenize the corpus')
+    parser.add_argument('--vocab_path', help='load this vocab instead of building it from the corpus')
+    parser.add_argument('--lazy_dataset', action='store_true', help='tokenize documents on demand in the DataLoader workers')
+    parser.add_argument('--lazy_cache_size', type=int, default=0, help='documents cached per worker by the lazy dataset')
+    parser.add_argument('--compact_dataset', action='store_true', help='keep the tokenized corpus in flat arrays (less memory per DataLoader worker)')
+    parser.add_argument('--bucket_batches', action='store_true', help='batch documents of similar abstract length together')
+    parser.add_argument('--max_tokens', type=int, default=0, help='padded abstract tokens per batch with --bucket_batches, instead of --batch_sz')
+    parser.add_argument('--label_chunk', type=int, default=0, help='score the labels in blocks of this size (checkpointed in training) to bound memory, 0 scores all at once')
+    parser.add_argument('--candidates', action='store_true', help='masked models: only score the labels inside the MeSH mask')
+    parser.add_argument('--candidate_fill', type=float, default=CANDIDATE_FILL, help='score of the labels outside the mask with --candidates')
+    parser.add_argument('--fuse_rnn', action='store_true', help='run title and abstract through the BiLSTM in one packed call')
+    parser.add_argument('--bf16', action='store_true', help='run the models under bfloat16 autocast (softmax and loss in fp32), needs torch >= 1.10')
+    parser.add_argument('--checkpoint_stages', nargs='*', choices=CHECKPOINT_STAGES, default=[], help='Full model: stages recomputed in backward instead of keeping their activations')
+    parser.add_argument('--sparse_embedding', action='store_true', help='multichannel models: sparse embedding gradients, trained with SparseAdam (Adam for the other parameters)')
+    parser.add_argument('--ngrams', type=int, default=1, help='n-gram order of the vocab, best used with --hash_buckets')
+    parser.add_argument('--hash_buckets', type=int, default=0, help='hash words outside the reserved vocab and n-grams into this many embedding rows')
+    parser.add_argument('--hash_reserved', type=int, default=HASH_RESERVED, help='most frequent words with their own embedding row in a hashed vocab')
     parser.add_argument('----meSH_pair_path')
     parser.add_argument('--word2vec_path')
     parser.add_argument('--meSH_pair_path')
@@ -431,6 +417,7 @@ def main():
     parser.add_argument('--graph_cooccurence')
     parser.add_argument('--results')
     parser.add_argument('--save-model-path')
+    parser.add_argument('--store_label_features', action='store_true', help='save the GCN label features with the model, inference then needs neither the label graph nor DGL')
     parser.add_argument('--true')
     parser.add_argument('--loss')
 
@@ -463,18 +450,26 @@ def main():
     # Get dataset and label graph & Load pre-trained embeddings
     num_nodes, mlb, vocab, train_dataset, valid_dataset, vectors, G = prepare_dataset(args.title_path, args.abstract_path, args.label_path,
                                                                       args.mask_path, args.meSH_pair_path, args.word2vec_path,
-                                                                      args.graph, args.num_example) # args. graph_cooccurence,
+                                                                      args.graph, args.num_example, corpus_path=args.corpus_path,
+                                                                      cache_dir=args.cache_dir,
+                                                                      preprocess_workers=args.preprocess_workers, vocab_path=args.vocab_path,
+                                                                      compact_dataset=args.compact_dataset, lazy_dataset=args.lazy_dataset,
+                                                                      lazy_cache_size=args.lazy_cache_size,
+                                                                      ngrams=args.ngrams, hash_buckets=args.hash_buckets, hash_reserved=args.hash_reserved) # args. graph_cooccurence,
     # neg_pos_ratio = pickle.load(open(args.neg_pos, 'rb'))
     vocab_size = len(vocab)
     model = multichannel_dilatedCNN_with_MeSH_mask(vocab_size, args.dropout, args.ksz, num_nodes, G, device,
-                                                   embedding_dim=200, rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
+                                                   embedding_dim=200, rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2, label_chunk=args.label_chunk,
+                                                   candidates=args.candidates, candidate_fill=args.candidate_fill, fuse_rnn=args.fuse_rnn,
+                                                   checkpoint_stages=args.checkpoint_stages, sparse_embedding=args.sparse_embedding)
                                     #gat_num_heads=8, gat_num_layers=2, gat_num_out_heads=1)
     # model = multichannel_dilatedCNN(vocab_size, args.dropout, args.ksz, num_nodes, G, device, embedding_dim=200,
     #                                 rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
 
     # model = multichannel_dilatedCNN_without_graph(vocab_size, args.dropout, args.ksz, num_nodes, embedding_dim=200,
     #                                               rnn_num_layers=2, cornet_dim=1000, n_cornet_blocks=2)
-    model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors)).to(device)
+    model.embedding_layer.weight.data.copy_(weight_matrix(vocab, vectors, cache_dir=args.cache_dir,
+                                                          vectors_path=args.word2vec_path)).to(device)
 
     model.to(device)
     G = G.to(device)
@@ -482,9 +477,9 @@ def main():
     # neg_pos_ratio = neg_pos_ratio.to(device)
     # G_c.to(device)
 
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
-
-    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=args.scheduler_step_sz, gamma=args.lr_gamma)
+    # SparseAdam for a sparse embedding, Adam for the other parameters
+    optimizer = split_adam(model, args.lr)
+    lr_scheduler = step_lr(optimizer, args.scheduler_step_sz, args.lr_gamma)
     criterion = nn.BCEWithLogitsLoss()
 
     # criterion = FocalLoss_MultiLabel()
@@ -496,11 +491,17 @@ def main():
     # training
     print("Start training!")
     model, train_loss, valid_loss = train(train_dataset, valid_dataset, model, mlb, G, args.batch_sz,
-                                          args.num_epochs, criterion, device, args.num_workers, optimizer, lr_scheduler)
+                                          args.num_epochs, criterion, device, args.num_workers, optimizer, lr_scheduler,
+                                          persistent_workers=args.lazy_dataset, bucket_batches=args.bucket_batches,
+                                          max_tokens=args.max_tokens, bf16=args.bf16)
     print('Finish training!')
 
     print('save model for inference')
+    if args.store_label_features:
+        G = G.to(device)
+        model.store_label_features(G, G.ndata['feat'])
     torch.save(model.state_dict(), args.save_model_path)
+    save_vocab(vocab, vocab_path_for(args.save_model_path), vocab_settings(args.ngrams))
 
     # print('loading model')
     # model.load_state_dict(torch.load(args.save_model_path))
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from vocab_io import load_vocab, save_vocab
+
+"""
+On-disk cache of numericalized corpora.
+
+An entry stores, for every channel (``abstract``/``title`` or ``text``), one flat int64 array of
+token ids with an int64 offset array, plus the vocabulary (itos and frequencies). Entries are
+keyed by a hash of the input files and of every setting that changes the token ids
+(truncation limits, ngrams, cleaning options), so a hit can skip tokenization entirely.
+"""
+
+# bump when the tokenization/cleaning code changes in a way that alters token ids
+CACHE_VERSION = 2
+
+
+def file_fingerprint(paths):
+    """ Cheap fingerprint of input files: absolute path, size and modification time """
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        h.update('{}:{}:{}\n'.format(os.path.abspath(path), st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
+def text_fingerprint(texts):
+    """ Content hash, used when the corpus did not come from files """
+    h = hashlib.sha1()
+    for text in texts:
+        h.update(text.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def cache_key(fingerprint, **settings):
+    settings['cache_version'] = CACHE_VERSION
+    h = hashlib.sha1(fingerprint.encode('utf-8'))
+    h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+class TokenCache(object):
+    """
+    Arguments:
+        cache_dir: directory holding one sub-directory per cache entry.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """
+        Returns (vocab, columns) or None on a miss. ``columns`` maps a channel name to a
+        (token_ids, offsets) pair of copy-on-write memory-mapped arrays: writes stay in memory, the
+        entry on disk is never modified.
+        """
+        path = self._entry(key)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        vocab = load_vocab(os.path.join(path, 'vocab.json'))
+
+        columns = {}
+        for name in meta['columns']:
+            token_ids = np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+            offsets = np.load(os.path.join(path, name + '_offsets.npy'), mmap_mode='c')
+            columns[name] = (token_ids, offsets)
+        return vocab, columns
+
+    def save(self, key, vocab, columns, settings=None):
+        """
+        columns: a dict mapping a channel name to a list of 1-D token id tensors, one per document.
+        """
+        path = self._entry(key)
+        os.makedirs(path, exist_ok=True)
+        for name, sequences in columns.items():
+            lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+            offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            token_ids = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences]) \
+                if len(sequences) > 0 else np.zeros(0, dtype=np.int64)
+            np.save(os.path.join(path, name + '.npy'), token_ids)
+            np.save(os.path.join(path, name + '_offsets.npy'), offsets)
+        save_vocab(vocab, os.path.join(path, 'vocab.json'), settings)
+        # meta.json is written last, so a half-written entry is never treated as a hit
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'columns': list(columns.keys()), 'settings': settings or {}}, f)
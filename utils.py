@@ -1,71 +1,118 @@
+import contextlib
+import inspect
 import logging
+import math
 import re
 import string
-from operator import itemgetter
+from collections import Counter, OrderedDict
+from functools import partial
+from multiprocessing import Pool
 from typing import Iterator, TypeVar, List
 
+import numpy as np
 import torch
 from nltk.corpus import stopwords
-from torch.utils.data import Dataset, Sampler, DistributedSampler
-from torchtext.data.utils import get_tokenizer
+from torch.utils.data import Dataset, Sampler, DistributedSampler, Subset
 from torchtext.data.utils import ngrams_iterator
 from torchtext.vocab import Vocab
 from torchtext.vocab import build_vocab_from_iterator
 from tqdm import tqdm
 
+from hashed_vocab import HashedVocab
+from token_cache import TokenCache, cache_key, file_fingerprint, text_fingerprint
+from vocab_io import vocab_fingerprint
+
 T_co = TypeVar('T_co', covariant=True)
 T = TypeVar('T')
 
 stop_words = set(stopwords.words('english'))
 table = str.maketrans('', '', string.punctuation)
 
+# truncation limits (in tokens) of the abstract and title channels and of the single-channel text
+MAX_ABSTRACT_LEN = 400
+MAX_TITLE_LEN = 60
+MAX_TEXT_LEN = 460
+
+# words with an embedding row of their own in a hashed vocab (the rest share the hash buckets)
+HASH_RESERVED = 50000
+
+# documents shuffled together and sorted by length before BucketBatchSampler cuts them into batches
+BUCKET_SIZE = 3200
+
+# pinned collate buffers, two per batch (abstract and title)
+PINNED_BUFFERS = 4
+
+
+# The characters basic_english splits on become spaces, every other punctuation character is
+# deleted, so a single translate() + split() matches basic_english followed by text_clean.
+_SEPARATORS = "'.,()!?;:"
+_normalize_table = str.maketrans(_SEPARATORS, ' ' * len(_SEPARATORS),
+                                 ''.join(c for c in string.punctuation if c not in _SEPARATORS))
+
 
 def text_clean(tokens):
+    """ remove punctuation, non alphabetic, stopword and single character tokens """
+    cleaned = []
+    for w in tokens:
+        w = w.translate(table)
+        if len(w) > 1 and w.isalpha() and w not in stop_words:
+            cleaned.append(w)
+    return cleaned
 
-    stripped = [w.translate(table) for w in tokens]  # remove punctuation
-    clean_tokens = [w for w in stripped if w.isalpha()]  # remove non alphabetic tokens
-    text_nostop = [word for word in clean_tokens if word not in stop_words]  # remove stopwords
-    filtered_text = [w for w in text_nostop if len(w) > 1]  # remove single character token
 
-    return filtered_text
+def normalize(text):
+    """
+    Tokenize and clean a document in one pass.
+    Token-for-token identical to ``text_clean(get_tokenizer('basic_english')(text))``.
+    """
+    line = text.lower().replace('"', '')
+    if '<br />' in line:
+        line = line.replace('<br />', ' ')
+    return [w for w in line.translate(_normalize_table).split()
+            if len(w) > 1 and w.isalpha() and w not in stop_words]
 
 
-def _vocab_iterator(all_text, all_title, ngrams=1):
+def vocab_settings(ngrams=1):
+    """ The tokenization settings a vocab depends on, stored with saved vocab files """
+    return dict(tokenizer='basic_english', ngrams=ngrams, stop_words=sorted(stop_words))
+
 
-    tokenizer = get_tokenizer('basic_english')
+def normalize_batch(texts):
+    """ ``normalize`` over a list of documents """
+    _normalize = normalize
+    return [_normalize(text) for text in texts]
+
+
+def _vocab_iterator(all_text, all_title, ngrams=1):
 
     for i, text in enumerate(all_text):
-        texts = tokenizer(text + all_title[i])
-        texts = text_clean(texts)
+        texts = normalize(text + all_title[i])
         yield ngrams_iterator(texts, ngrams)
 
 
+def _document_tokens(text, title, is_multichannel=True):
+    """ Cleaned and truncated tokens of one document: (abstract, title) or (title + abstract,) """
+    if is_multichannel:
+        texts = normalize(text)
+        if len(texts) > MAX_ABSTRACT_LEN:
+            texts = texts[:MAX_ABSTRACT_LEN]
+        heading = normalize(title)
+        if len(heading) > MAX_TITLE_LEN:
+            heading = heading[:MAX_TITLE_LEN]
+        return texts, heading
+
+    texts = normalize(title) + normalize(text)
+    if len(texts) > MAX_TEXT_LEN:
+        texts = texts[:MAX_TEXT_LEN]
+    return (texts,)
+
+
 def _text_iterator(text, title=None, labels=None, mesh_mask=None, ngrams=1, is_multichannel=True):
-    tokenizer = get_tokenizer('basic_english')
     for i, text in enumerate(text):
-        if is_multichannel:
-            texts = tokenizer(text)
-            texts = text_clean(texts)
-            if len(texts) > 400:
-                texts = texts[:400]
-            heading = tokenizer(title[i])
-            heading = text_clean(heading)
-            if len(heading) > 60:
-                heading = heading[:60]
-            mask = mesh_mask[i]
-            label = labels[i]
-            yield label, mask, ngrams_iterator(texts, ngrams), ngrams_iterator(heading, ngrams)
-
-        else:
-            heading = tokenizer(title[i])
-            abstract = tokenizer(text)
-            texts = heading + abstract
-            texts = text_clean(texts)
-            if len(texts) > 460:
-                texts = texts[:460]
-            mask = mesh_mask[i]
-            label = labels[i]
-            yield label, mask, ngrams_iterator(texts, ngrams)
+        mask = mesh_mask[i]
+        label = labels[i]
+        yield (label, mask) + tuple(ngrams_iterator(tokens, ngrams)
+                                    for tokens in _document_tokens(text, title[i], is_multichannel))
 
 
 def _create_data_from_iterator(vocab, iterator, include_unk, is_multichannel=True):
@@ -105,6 +152,125 @@ def _create_data_from_iterator(vocab, iterator, include_unk, is_multichannel=Tru
             return data, list(set(labels))
 
 
+# Parallel tokenization engine. The document list is cut into contiguous shards, each shard is
+# cleaned and numericalized by a worker process with the serial iterators above, and the results
+# are merged back in document order, so the output is identical to the serial path.
+PARALLEL_SHARD_SIZE = 2000
+
+_worker_vocab = None
+
+
+def _init_numericalize_worker(vocab):
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def _shard_tokens(mode, texts, titles, ngrams):
+    """ Yields the cleaned token lists of a shard (one tuple of channels per document) """
+    placeholders = [None] * len(texts)
+    if mode == 'vocab':
+        for tokens in _vocab_iterator(texts, titles, ngrams):
+            yield (tokens,)
+    elif mode == 'multichannel':
+        for _, _, text, title in _text_iterator(texts, titles, placeholders, placeholders, ngrams, True):
+            yield text, title
+    elif mode == 'single':
+        for _, _, text in _text_iterator(texts, titles, placeholders, placeholders, ngrams, False):
+            yield (text,)
+    elif mode == 'mesh_mask':
+        for tokens in _text_iterator_for_mesh_mask(texts, None, ngrams=ngrams, yield_label=False):
+            yield (tokens,)
+    else:
+        raise ValueError('unknown tokenization mode {}'.format(mode))
+
+
+def _count_shard(args):
+    mode, texts, titles, ngrams = args
+    counter = Counter()
+    for (tokens,) in _shard_tokens(mode, texts, titles, ngrams):
+        counter.update(tokens)
+    return counter
+
+
+def _token_ids(vocab, tokens, include_unk):
+    if include_unk:
+        token_ids = [vocab[token] for token in tokens]
+    else:
+        token_ids = list(filter(lambda x: x is not Vocab.UNK, [vocab[token] for token in tokens]))
+    return np.array(token_ids, dtype=np.int64)
+
+
+def _numericalize_shard(args):
+    mode, texts, titles, ngrams, include_unk = args
+    return [tuple(_token_ids(_worker_vocab, tokens, include_unk) for tokens in channels)
+            for channels in _shard_tokens(mode, texts, titles, ngrams)]
+
+
+def _shards(mode, texts, titles, ngrams, *extra):
+    # materialize each shard as plain lists, lazy corpus columns must not be pickled whole
+    for start in range(0, len(texts), PARALLEL_SHARD_SIZE):
+        stop = start + PARALLEL_SHARD_SIZE
+        yield (mode, list(texts[start:stop]), list(titles[start:stop]) if titles is not None else None,
+               ngrams) + extra
+
+
+def parallel_count_tokens(texts, titles, num_workers, ngrams=1, mode='vocab'):
+    """ Token frequencies over the (mode) token iterator, counted by a process pool """
+    counter = Counter()
+    with Pool(num_workers) as pool:
+        with tqdm(unit_scale=0, unit='lines', total=len(texts)) as t:
+            for shard_counter in pool.imap(_count_shard, _shards(mode, texts, titles, ngrams)):
+                counter.update(shard_counter)
+                t.update(PARALLEL_SHARD_SIZE)
+    return counter
+
+
+def parallel_build_vocab(texts, titles, num_workers, ngrams=1, mode='vocab'):
+    """ Same vocab as ``build_vocab_from_iterator`` over the (mode) token iterator, counted by a process pool """
+    return Vocab(parallel_count_tokens(texts, titles, num_workers, ngrams, mode))
+
+
+def build_vocab(all_text, all_title, ngrams=1, num_workers=1, hash_buckets=0, hash_reserved=HASH_RESERVED):
+    """
+    Vocab of the titles and abstracts. With ``hash_buckets`` > 0 a ``HashedVocab`` is built instead:
+    the ``hash_reserved`` most frequent words keep their own rows, other words and all n-grams are
+    hashed, so the vocab size does not depend on the corpus or on ``ngrams``.
+    """
+    if hash_buckets > 0:
+        if num_workers > 1:
+            counter = parallel_count_tokens(all_text, all_title, num_workers)
+        else:
+            counter = Counter()
+            for tokens in _vocab_iterator(all_text, all_title):
+                counter.update(tokens)
+        return HashedVocab(counter, hash_buckets, hash_reserved)
+    if num_workers > 1:
+        return parallel_build_vocab(all_text, all_title, num_workers, ngrams)
+    return build_vocab_from_iterator(_vocab_iterator(all_text, all_title, ngrams))
+
+
+def parallel_numericalize(vocab, texts, titles, num_workers, mode, ngrams=1, include_unk=False):
+    """
+    Returns one tuple of int64 token id tensors per document, in document order.
+    mode: 'multichannel' (abstract, title), 'single' (title + abstract) or 'mesh_mask' (text).
+    """
+    token_ids = []
+    with Pool(num_workers, initializer=_init_numericalize_worker, initargs=(vocab,)) as pool:
+        with tqdm(unit_scale=0, unit='lines', total=len(texts)) as t:
+            for shard in pool.imap(_numericalize_shard, _shards(mode, texts, titles, ngrams, include_unk)):
+                token_ids.extend(tuple(torch.from_numpy(ids) for ids in channels) for channels in shard)
+                t.update(len(shard))
+    return token_ids
+
+
+def _create_data_parallel(vocab, text, title, labels, mesh_mask, ngrams, include_unk, num_workers,
+                          is_multichannel=True):
+    mode = 'multichannel' if is_multichannel else 'single'
+    token_ids = parallel_numericalize(vocab, text, title, num_workers, mode, ngrams, include_unk)
+    data = [(labels[i], mesh_mask[i]) + channels for i, channels in enumerate(token_ids)]
+    return data, list(set(label for doc in labels for label in doc))
+
+
 class MultiLabelTextClassificationDataset(torch.utils.data.Dataset):
     def __init__(self, vocab, data, labels=None):
         """Initiate text-classification dataset.
@@ -137,17 +303,271 @@ class MultiLabelTextClassificationDataset(torch.utils.data.Dataset):
     def get_vocab(self):
         return self._vocab
 
+    def lengths(self):
+        """ Abstract (or text) length of every document """
+        return np.fromiter((len(entry[2]) for entry in self._data), dtype=np.int64, count=len(self._data))
+
+
+def _flatten(sequences, dtype):
+    """ Concatenate variable length sequences into one flat array plus int64 offsets (CSR) """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.empty(offsets[-1], dtype=dtype)
+    for i, seq in enumerate(sequences):
+        flat[offsets[i]:offsets[i + 1]] = np.asarray(seq, dtype=dtype)
+    return flat, offsets
+
+
+class CompactMultiLabelDataset(torch.utils.data.Dataset):
+    def __init__(self, vocab, channels, labels, masks, label_set=None):
+        """Text-classification dataset stored in a few flat arrays instead of one tuple per document.
+         Forked DataLoader workers then only touch the handful of array objects, not one refcount per
+         document, so they do not slowly copy the parent's pages.
+         Arguments:
+             vocab: Vocabulary object used for dataset.
+             channels: list of (token_ids, offsets) pairs, [abstract, title] or [text]. token_ids is an
+                   int32 array, document i is token_ids[offsets[i]:offsets[i + 1]].
+             labels: (label_ids, offsets) pair in the same CSR layout.
+             masks: (mask_ids, offsets) pair in the same CSR layout.
+             label_set: a list of the labels.
+        """
+        super(CompactMultiLabelDataset, self).__init__()
+        self._vocab = vocab
+        self._channels = channels
+        self._label_ids, self._label_offsets = labels
+        self._mask_ids, self._mask_offsets = masks
+        self._labels = label_set
+
+    @classmethod
+    def from_data(cls, vocab, data, label_set=None):
+        """ Build from the (label, mask, ab_tokens, title_tokens) / (label, mask, tokens) tuples """
+        num_channels = len(data[0]) - 2 if len(data) > 0 else 2
+        channels = [_flatten([entry[2 + c] for entry in data], np.int32) for c in range(num_channels)]
+        labels = _flatten([entry[0] for entry in data], np.int32)
+        masks = _flatten([entry[1] for entry in data], np.int32)
+        return cls(vocab, channels, labels, masks, label_set)
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        return cls.from_data(dataset.get_vocab(), dataset._data, dataset.get_labels())
+
+    def __getitem__(self, i):
+        """ Returns (label, mask, ab_tokens, title_tokens) or (label, mask, tokens), all views into the arrays """
+        label = self._label_ids[self._label_offsets[i]:self._label_offsets[i + 1]]
+        mask = self._mask_ids[self._mask_offsets[i]:self._mask_offsets[i + 1]]
+        tokens = tuple(torch.from_numpy(token_ids[offsets[i]:offsets[i + 1]]) for token_ids, offsets in self._channels)
+        return (label, mask) + tokens
+
+    def __len__(self):
+        return len(self._label_offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_labels(self):
+        return self._labels
+
+    def get_vocab(self):
+        return self._vocab
+
+    def lengths(self):
+        """ Abstract (or text) length of every document """
+        return np.diff(self._channels[0][1])
+
+    def nbytes(self):
+        """ Memory held by the flat arrays """
+        arrays = [self._label_ids, self._label_offsets, self._mask_ids, self._mask_offsets]
+        arrays += [array for channel in self._channels for array in channel]
+        return sum(array.nbytes for array in arrays)
+
+
+class LazyMultiLabelDataset(torch.utils.data.Dataset):
+    def __init__(self, vocab, texts, titles, labels, masks, is_multichannel=True, ngrams=1, include_unk=False,
+                 cache_size=0):
+        """Text-classification dataset that tokenizes and numericalizes a raw document in ``__getitem__``.
+         Building it costs O(1) in corpus size, the preprocessing runs inside the DataLoader workers.
+         Items are identical to the ones of MultiLabelTextClassificationDataset.
+         Arguments:
+             vocab: prebuilt Vocabulary object.
+             texts, titles, labels, masks: lists or lazy corpus_store columns.
+             cache_size: number of numericalized documents kept in an LRU cache (0 disables it). Each
+                   worker process has its own cache, keep the workers alive between epochs (see
+                   ``persistent_loader_kwargs``) so later epochs can hit it.
+        """
+        super(LazyMultiLabelDataset, self).__init__()
+        self._vocab = vocab
+        self._texts = texts
+        self._titles = titles
+        self._label_ids = labels
+        self._masks = masks
+        self._is_multichannel = is_multichannel
+        self._ngrams = ngrams
+        self._include_unk = include_unk
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._labels = None
+        self._lengths = None
+
+    def _numericalize(self, tokens):
+        token_ids = [self._vocab[token] for token in ngrams_iterator(tokens, self._ngrams)]
+        if not self._include_unk:
+            token_ids = list(filter(lambda x: x is not Vocab.UNK, token_ids))
+        return torch.tensor(token_ids, dtype=torch.long)
+
+    def _load(self, i):
+        channels = _document_tokens(self._texts[i], self._titles[i], self._is_multichannel)
+        return (self._label_ids[i], self._masks[i]) + tuple(self._numericalize(tokens) for tokens in channels)
+
+    def __getitem__(self, i):
+        if self._cache_size <= 0:
+            return self._load(i)
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        item = self._load(i)
+        self._cache[i] = item
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return item
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_labels(self):
+        # O(corpus), only computed on request
+        if self._labels is None:
+            self._labels = list(set(label for doc in self._label_ids for label in doc))
+        return self._labels
+
+    def get_vocab(self):
+        return self._vocab
+
+    def lengths(self):
+        """ Abstract (or text) length of every document, tokenized as in ``__getitem__``. O(corpus), computed once """
+        if self._lengths is None:
+            self._lengths = np.fromiter(
+                (len(self._numericalize(_document_tokens(text, title, self._is_multichannel)[0]))
+                 for text, title in zip(self._texts, self._titles)), dtype=np.int64, count=len(self._texts))
+        return self._lengths
+
+
+def dataset_lengths(dataset):
+    """ Abstract (or text) length of every document of a dataset or of a ``random_split`` subset of it """
+    if isinstance(dataset, Subset):
+        return dataset_lengths(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    return dataset.lengths()
+
+
+def persistent_loader_kwargs(num_workers):
+    """ DataLoader arguments keeping the workers (and their dataset caches) alive between epochs, if supported """
+    if num_workers > 0 and 'persistent_workers' in inspect.signature(torch.utils.data.DataLoader.__init__).parameters:
+        return {'persistent_workers': True}
+    return {}
+
+
+def batching_loader_kwargs(dataset, batch_sz, shuffle, bucket=False, max_tokens=0, seed=0):
+    """
+    DataLoader batching arguments: plain ``batch_size``/``shuffle``, or a ``BucketBatchSampler`` over the
+    document lengths if ``bucket`` (``max_tokens`` > 0 replaces ``batch_sz`` by a token budget).
+    """
+    if not bucket:
+        return {'batch_size': batch_sz, 'shuffle': shuffle}
+    sampler = BucketBatchSampler(dataset_lengths(dataset), batch_size=None if max_tokens > 0 else batch_sz,
+                                 max_tokens=max_tokens or None, shuffle=shuffle, seed=seed)
+    return {'batch_sampler': sampler}
+
+
+def set_loader_epoch(loader, epoch):
+    """ Reshuffle the batches of a DataLoader whose (batch) sampler supports ``set_epoch`` """
+    for sampler in (loader.batch_sampler, loader.sampler):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+            return
+
+
+def bf16_autocast(enabled, device):
+    """
+    Context running the ops that support it (matmuls, convolutions, linear layers) in bfloat16 on ``device``
+    if ``enabled``, a no-op context otherwise. CPU autocast needs torch >= 1.10.
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError('bf16 autocast needs torch >= 1.10, found %s' % torch.__version__)
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+
+
+def _compact_from_columns(vocab, columns, labels, mesh_mask, is_multichannel=True):
+    """ CompactMultiLabelDataset over the memory-mapped (token_ids, offsets) columns of a cache entry """
+    names = ['abstract', 'title'] if is_multichannel else ['text']
+    label_set = list(set(label for doc in labels for label in doc))
+    return CompactMultiLabelDataset(vocab, [columns[name] for name in names], _flatten(labels, np.int32),
+                                    _flatten(mesh_mask, np.int32), label_set)
+
+
+def _columns_from_data(data, is_multichannel=True):
+    if is_multichannel:
+        return {'abstract': [entry[2] for entry in data], 'title': [entry[3] for entry in data]}
+    return {'text': [entry[2] for entry in data]}
+
 
 def _setup_datasets(all_text, all_title, train_text, train_labels, test_text, test_labels, train_mask, test_mask, train_title=None, test_title=None, ngrams=1, vocab=None,
-                    include_unk=False, is_test=False, is_multichannel=True):
+                    include_unk=False, is_test=False, is_multichannel=True, cache_dir=None, source_files=None,
+                    num_workers=1, hash_buckets=0, hash_reserved=HASH_RESERVED):
+    if cache_dir is not None:
+        if source_files is not None:
+            fingerprint = file_fingerprint(source_files)
+        else:
+            fingerprint = text_fingerprint(list(all_text) + list(all_title))
+        texts = test_text if is_test else train_text
+        settings = dict(vocab_settings(ngrams), include_unk=include_unk, is_multichannel=is_multichannel,
+                        is_test=is_test, num_docs=len(all_text), num_subset=len(texts),
+                        max_abstract_len=MAX_ABSTRACT_LEN, max_title_len=MAX_TITLE_LEN, max_text_len=MAX_TEXT_LEN)
+        if vocab is not None:
+            settings['vocab'] = vocab_fingerprint(vocab)
+        elif hash_buckets > 0:
+            settings.update(hash_buckets=hash_buckets, hash_reserved=hash_reserved)
+        key = cache_key(fingerprint, **settings)
+        cache = TokenCache(cache_dir)
+        cached = cache.load(key)
+        if cached is not None:
+            logging.info('Loading tokenized corpus from cache {}'.format(key))
+            cached_vocab, columns = cached
+            vocab = cached_vocab if vocab is None else vocab
+            labels, masks = (test_labels, test_mask) if is_test else (train_labels, train_mask)
+            return _compact_from_columns(vocab, columns, labels, masks, is_multichannel)
+
+        dataset = _setup_datasets(all_text, all_title, train_text, train_labels, test_text, test_labels, train_mask,
+                                  test_mask, train_title, test_title, ngrams, vocab, include_unk, is_test,
+                                  is_multichannel, num_workers=num_workers, hash_buckets=hash_buckets,
+                                  hash_reserved=hash_reserved)
+        cache.save(key, dataset.get_vocab(), _columns_from_data(dataset._data, is_multichannel), settings)
+        return dataset
+
     if vocab is None:
         logging.info('Building Vocab based on {}'.format(train_text))
-        vocab = build_vocab_from_iterator(_vocab_iterator(all_text, all_title, ngrams))
+        vocab = build_vocab(all_text, all_title, ngrams, num_workers, hash_buckets, hash_reserved)
     else:
         if not isinstance(vocab, Vocab):
             raise TypeError("Passed vocabulary is not of type Vocab")
     print('Vocab has {} entries'.format(len(vocab)))
 
+    if num_workers > 1:
+        logging.info('Creating {} data with {} processes'.format('testing' if is_test else 'training', num_workers))
+        if is_test:
+            data, labels = _create_data_parallel(vocab, test_text, test_title, test_labels, test_mask, ngrams,
+                                                 include_unk, num_workers, is_multichannel)
+        else:
+            data, labels = _create_data_parallel(vocab, train_text, train_title, train_labels, train_mask, ngrams,
+                                                 include_unk, num_workers, is_multichannel)
+        return MultiLabelTextClassificationDataset(vocab, data, labels)
+
     if is_multichannel:
         if is_test:
             logging.info('Creating testing data')
@@ -181,17 +601,51 @@ def _setup_datasets(all_text, all_title, train_text, train_labels, test_text, te
 
 
 def MeSH_indexing(all_text, all_title, train_text, train_title, train_labels, train_mask, test_text, test_title,
-                  test_labels, test_mask, is_test, is_multichannel):
+                  test_labels, test_mask, is_test, is_multichannel, cache_dir=None, source_files=None, num_workers=1,
+                  vocab=None, compact=False, lazy=False, lazy_cache_size=0, ngrams=1, hash_buckets=0,
+                  hash_reserved=HASH_RESERVED):
     """
 
     Defines MeSH_indexing datasets.
     The label set contains all mesh terms in 2019 version (https://meshb.nlm.nih.gov/treeView)
 
+    Texts, titles, labels and masks can be lists or the lazy columns of a ``corpus_store.CorpusStore``.
+
+    If ``cache_dir`` is given, the numericalized corpus and vocab are cached there, keyed by
+    ``source_files`` (the files the corpus was read from) and the tokenization settings.
+
+    With ``num_workers`` > 1 the vocab and token ids are built by a process pool, with identical output.
+
+    Pass a ``vocab`` (e.g. from ``vocab_io.load_vocab``) to numericalize with it instead of building one.
+
+    With ``compact`` the dataset is returned as a ``CompactMultiLabelDataset`` (flat arrays). A hit of the
+    ``cache_dir`` token cache always is one, its token ids are the memory-mapped arrays of the cache entry.
+
+    With ``lazy`` nothing is numericalized up front: a ``LazyMultiLabelDataset`` tokenizes documents on
+    access. It needs a ``vocab``, which is built from the corpus if not given.
+
+    ``hash_buckets`` > 0 builds a hashed vocab (see ``build_vocab``), which keeps the embedding table
+    bounded when ``ngrams`` > 1.
 
     """
-    return _setup_datasets(all_text, all_title, train_text, train_labels, test_text, test_labels, train_mask, test_mask,
-                           train_title, test_title, ngrams=1, vocab=None, include_unk=False, is_test=is_test,
-                           is_multichannel=is_multichannel)
+    if lazy:
+        if vocab is None:
+            logging.info('Building Vocab based on {}'.format(train_text))
+            vocab = build_vocab(all_text, all_title, ngrams, num_workers, hash_buckets, hash_reserved)
+        if is_test:
+            return LazyMultiLabelDataset(vocab, test_text, test_title, test_labels, test_mask, is_multichannel,
+                                         ngrams=ngrams, cache_size=lazy_cache_size)
+        return LazyMultiLabelDataset(vocab, train_text, train_title, train_labels, train_mask, is_multichannel,
+                                     ngrams=ngrams, cache_size=lazy_cache_size)
+
+    dataset = _setup_datasets(all_text, all_title, train_text, train_labels, test_text, test_labels, train_mask,
+                              test_mask, train_title, test_title, ngrams=ngrams, vocab=vocab, include_unk=False,
+                              is_test=is_test, is_multichannel=is_multichannel, cache_dir=cache_dir,
+                              source_files=source_files, num_workers=num_workers, hash_buckets=hash_buckets,
+                              hash_reserved=hash_reserved)
+    if compact and not isinstance(dataset, CompactMultiLabelDataset):
+        dataset = CompactMultiLabelDataset.from_dataset(dataset)
+    return dataset
 
 
 def pad_sequence(sequences, ksz, batch_first=False, padding_value=0.0):
@@ -232,28 +686,115 @@ def pad_sequence(sequences, ksz, batch_first=False, padding_value=0.0):
         Tensor of size ``B x T x *`` otherwise
     """
 
+    out_tensor, _ = pad_batch(sequences, ksz, padding_value=padding_value)
+    if not batch_first:
+        out_tensor = out_tensor.transpose(0, 1).contiguous()
+    return out_tensor
+
+
+def pad_batch(sequences, ksz, min_length=0, padding_value=0, pool=None):
+    """
+    Batch-first ``pad_sequence`` that also returns the int64 lengths (at least ``min_length``).
+    The sequences are concatenated once and scattered into the padded tensor with a single
+    masked assignment; the padded length is at least ``ksz`` for the convolutions. With a
+    ``PinnedBufferPool`` the output is written into one of its buffers.
+    """
     # assuming trailing dimensions and type of all the Tensors
     # in sequences are same and fetching those from sequences[0]
-    max_size = sequences[0].size()
-    trailing_dims = max_size[1:]
-    max_len = max([s.size(0) for s in sequences])
-    if max_len < ksz:
-        max_len = ksz
-    if batch_first:
-        out_dims = (len(sequences), max_len) + trailing_dims
-    else:
-        out_dims = (max_len, len(sequences)) + trailing_dims
-
-    out_tensor = sequences[0].new_full(out_dims, padding_value)
-    for i, tensor in enumerate(sequences):
-        length = tensor.size(0)
-        # use index notation to prevent duplicate references to the tensor
-        if batch_first:
-            out_tensor[i, :length, ...] = tensor
-        else:
-            out_tensor[:length, i, ...] = tensor
+    trailing_dims = sequences[0].size()[1:]
+    lengths = torch.tensor([seq.size(0) for seq in sequences], dtype=torch.long)
+    max_len = max(int(lengths.max()), ksz)
+    # compact datasets hand out int32 token ids, embedding layers need int64
+    dtype = torch.long if sequences[0].dtype == torch.int32 else sequences[0].dtype
+
+    out_dims = (len(sequences), max_len) + trailing_dims
+    out_tensor = pool.take(out_dims, dtype) if pool is not None else torch.empty(out_dims, dtype=dtype)
+    out_tensor.fill_(padding_value)
+    out_tensor[torch.arange(max_len) < lengths.unsqueeze(1)] = torch.cat(sequences).to(dtype)
+    if min_length > 0:
+        lengths.clamp_(min=min_length)
+    return out_tensor, lengths
+
+
+class PinnedBufferPool(object):
+    """
+    Round-robin pool of page-locked host buffers the collate function pads batches into, so
+    batches are neither allocated nor copied again by ``pin_memory``. Each buffer holds
+    ``capacity`` elements (size it for the largest batch: batch size x longest sequence, or
+    the token budget); a larger batch gets a regular tensor. A buffer is handed out again
+    after ``num_buffers`` calls, its batch must have been copied to the device by then.
+    Pinned memory cannot be passed between processes, so this is for batches collated in
+    the main process only (see ``collate_loader_kwargs``).
+    """
+
+    def __init__(self, capacity, num_buffers=PINNED_BUFFERS, dtype=torch.long):
+        self.capacity = capacity
+        self.dtype = dtype
+        self._buffers = [torch.empty(capacity, dtype=dtype).pin_memory() for _ in range(num_buffers)]
+        self._next = 0
+
+    def take(self, shape, dtype):
+        numel = int(np.prod(shape))
+        if dtype != self.dtype or numel > self.capacity:
+            return torch.empty(shape, dtype=dtype)
+        buffer = self._buffers[self._next]
+        self._next = (self._next + 1) % len(self._buffers)
+        return buffer[:numel].view(shape)
+
+
+def label_offsets(sequences):
+    """ Label (or MeSH mask) lists of a batch as a flat int64 index tensor plus offsets (CSR), see ``densify`` """
+    indices, offsets = _flatten(sequences, np.int64)
+    return torch.from_numpy(indices), torch.from_numpy(offsets)
 
-    return out_tensor
+
+def densify(indices, offsets, num_labels, device=None):
+    """
+    Dense float (bs, num_labels) 0/1 matrix of a batch of label lists given as ``label_offsets``, built
+    directly on ``device``: only the indices are copied, the matrix is scattered there.
+    Document i owns the labels indices[offsets[i]:offsets[i + 1]].
+    """
+    batch_size = len(offsets) - 1
+    rows = torch.repeat_interleave(torch.arange(batch_size), offsets[1:] - offsets[:-1])
+    dense = torch.zeros(batch_size, num_labels, device=device)
+    dense[rows.to(device, non_blocking=True), indices.to(device, non_blocking=True)] = 1
+    return dense
+
+
+def generate_batch(batch, pool=None):
+    """
+    Collate (label, mask, ab_tokens, title_tokens) or (label, mask, tokens) documents, longest abstract
+    (or text) first, so the models pack the abstracts without sorting them (``model.pack_batch``). Runs in
+    the DataLoader workers.
+    Output:
+        label, mask: (indices, offsets) pairs of the label and MeSH mask ids, see ``densify``.
+        abstract, title, abstract_length, title_length: padded token ids and their int64 lengths, or
+        text, text_length for single-channel documents. The lengths stay on the host for packing.
+    """
+    batch = sorted(batch, key=lambda entry: len(entry[2]), reverse=True)
+    label = label_offsets([entry[0] for entry in batch])
+    mesh_mask = label_offsets([entry[1] for entry in batch])
+    if len(batch[0]) == 4:
+        # padding according to the maximum sequence length in batch
+        abstract, abstract_length = pad_batch([entry[2] for entry in batch], ksz=3, pool=pool)
+        # an empty title is packed as a single padding token
+        title, title_length = pad_batch([entry[3] for entry in batch], ksz=3, min_length=1, pool=pool)
+        return label, mesh_mask, abstract, title, abstract_length, title_length
+
+    text, text_length = pad_batch([entry[2] for entry in batch], ksz=3, pool=pool)
+    return label, mesh_mask, text, text_length
+
+
+def collate_loader_kwargs(num_workers, batch_sz, max_tokens=0):
+    """
+    DataLoader collate arguments. Batches collated in the main process of a CUDA host are padded
+    straight into a ``PinnedBufferPool``; worker processes cannot hand over pinned memory, their
+    batches are pinned by the DataLoader.
+    """
+    if num_workers == 0 and torch.cuda.is_available():
+        pool = PinnedBufferPool(max(batch_sz * MAX_TEXT_LEN, max_tokens))
+        return {'collate_fn': partial(generate_batch, pool=pool), 'pin_memory': False}
+    return {'collate_fn': generate_batch, 'pin_memory': True}
 
 
 # torchtext 0.6.0 rewrite torchtext.data.Dataset to inherit torch.data.utils.Dataset
@@ -313,15 +854,8 @@ def text_preprocess(string):
 
 
 def _text_iterator_for_mesh_mask(texts, idfs, labels=None, ngrams=1, yield_label=False):
-    tokenizer = get_tokenizer('basic_english')
-    table = str.maketrans('', '', string.punctuation)
-
     for i, text in enumerate(texts):
-        tokens = tokenizer(text)
-        stripped = [w.translate(table) for w in tokens]  # remove punctuation
-        clean_tokens = [w for w in stripped if w.isalpha()]  # remove non alphabetic tokens
-        text_nostop = [word for word in clean_tokens if word not in stop_words]  # remove stopwords
-        filtered_text = [w for w in text_nostop if len(w) > 1]  # remove single character token
+        filtered_text = normalize(text)
         if yield_label:
             label = labels[i]
             idf = idfs[i]
@@ -403,23 +937,31 @@ class MeSHMaskDataset(torch.utils.data.Dataset):
         return self._idfs
 
 
-def _setup_mesh_mask(train_text, idfs, train_labels, ngrams=1, vocab=None, include_unk=False):
+def _setup_mesh_mask(train_text, idfs, train_labels, ngrams=1, vocab=None, include_unk=False, num_workers=1):
     if vocab is None:
         logging.info('Building Vocab based on {}'.format(train_text))
-        vocab = build_vocab_from_iterator(_text_iterator_for_mesh_mask(train_text, idfs, labels=train_labels, ngrams=ngrams, yield_label=False))
+        if num_workers > 1:
+            vocab = parallel_build_vocab(train_text, None, num_workers, ngrams, mode='mesh_mask')
+        else:
+            vocab = build_vocab_from_iterator(_text_iterator_for_mesh_mask(train_text, idfs, labels=train_labels, ngrams=ngrams, yield_label=False))
     else:
         if not isinstance(vocab, Vocab):
             raise TypeError("Passed vocabulary is not of type Vocab")
     logging.info('Vocab has {} entries'.format(len(vocab)))
     logging.info('Creating training data')
+    if num_workers > 1:
+        token_ids = parallel_numericalize(vocab, train_text, None, num_workers, 'mesh_mask', ngrams, include_unk)
+        train_data = [(train_labels[i], tokens, idfs[i]) for i, (tokens,) in enumerate(token_ids)]
+        labels = list(set(label for doc in train_labels for label in doc))
+        return MeSHMaskDataset(vocab, train_data, list(idfs), labels)
     train_data, train_labels, train_idfs = _create_data_from_iterator_mesh_mask(
         vocab, _text_iterator_for_mesh_mask(train_text, idfs, labels=train_labels, ngrams=ngrams, yield_label=True), include_unk,
         is_test=False)
     return MeSHMaskDataset(vocab, train_data, train_idfs, train_labels)
 
 
-def Preprocess(text, idfs, labels, ngrams=1, vocab=None, include_unk=False):
-    return _setup_mesh_mask(text, idfs, labels, ngrams, vocab, include_unk)
+def Preprocess(text, idfs, labels, ngrams=1, vocab=None, include_unk=False, num_workers=1):
+    return _setup_mesh_mask(text, idfs, labels, ngrams, vocab, include_unk, num_workers)
 
 
 class DatasetFromSampler(Dataset):
@@ -487,12 +1029,92 @@ class DistributedSamplerWrapper(DistributedSampler):
         )
         self.sampler = sampler
 
+    def set_epoch(self, epoch):
+        """ Also reshuffles the wrapped sampler, which must draw the same order on every rank """
+        super(DistributedSamplerWrapper, self).set_epoch(epoch)
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
     def __iter__(self) -> Iterator[int]:
         """Iterate over sampler.
         Returns:
             python iterator
         """
         self.dataset = DatasetFromSampler(self.sampler)
+        # a token-budget batch sampler does not yield the same number of batches every epoch
+        self.num_samples = int(math.ceil(len(self.dataset) * 1.0 / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
         indexes_of_indexes = super().__iter__()
         subsampler_indexes = self.dataset
-        return iter(itemgetter(*indexes_of_indexes)(subsampler_indexes))
+        return iter([subsampler_indexes[i] for i in indexes_of_indexes])
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping documents of similar abstract length, so batches carry little padding.
+    Every epoch the documents are shuffled, split into buckets of ``bucket_size`` documents, sorted
+    by decreasing length within a bucket and cut into batches; the batch order is shuffled again.
+    Each batch comes out sorted by decreasing length. Without ``shuffle`` (evaluation) the whole
+    set is sorted once.
+    Arguments:
+        lengths: abstract (or text) length of every document (``dataset_lengths``).
+        batch_size: documents per batch, or
+        max_tokens: padded abstract tokens per batch (documents x longest abstract) instead of
+              a fixed batch size. A document longer than the budget gets a batch of its own.
+        indices: only sample these dataset indices (e.g. the training split), default all.
+        seed: shuffling seed, combined with the epoch (``set_epoch``). All ranks of a distributed
+              run must use the same seed, see ``DistributedSamplerWrapper``.
+    """
+
+    def __init__(self, lengths, batch_size=None, max_tokens=None, indices=None, shuffle=True,
+                 bucket_size=BUCKET_SIZE, seed=0):
+        if (batch_size is None) == (max_tokens is None):
+            raise ValueError('BucketBatchSampler needs either batch_size or max_tokens')
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.indices = np.arange(len(self.lengths)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def _split(self, bucket):
+        """ Cut a bucket sorted by decreasing length into batches """
+        if self.max_tokens is None:
+            return [bucket[start:start + self.batch_size] for start in range(0, len(bucket), self.batch_size)]
+        batches, start = [], 0
+        while start < len(bucket):
+            # the first document is the longest of the batch and sets its padded length
+            size = max(1, self.max_tokens // max(int(self.lengths[bucket[start]]), 1))
+            batches.append(bucket[start:start + size])
+            start += size
+        return batches
+
+    def batches(self):
+        """ The batches of the current epoch, lists of dataset indices """
+        if self._batches is None:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            order = self.indices[rng.permutation(len(self.indices))] if self.shuffle else self.indices
+            bucket_size = self.bucket_size if self.shuffle else max(len(order), 1)
+            batches = []
+            for start in range(0, len(order), bucket_size):
+                bucket = order[start:start + bucket_size]
+                bucket = bucket[np.argsort(-self.lengths[bucket], kind='stable')]
+                batches.extend(self._split(bucket))
+            if self.shuffle:
+                batches = [batches[i] for i in rng.permutation(len(batches))]
+            self._batches = [batch.tolist() for batch in batches]
+        return self._batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
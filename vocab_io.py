@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+from collections import Counter, defaultdict
+
+from torchtext.vocab import Vocab
+
+from hashed_vocab import HashedVocab
+
+"""
+Frozen vocabulary files.
+
+The trainers save the vocab they built next to the model (``<model>.vocab.json``), and
+evaluation and MeSH mask building load it instead of rebuilding it from the corpus, so the
+embedding rows of a checkpoint always line up with the token ids. A file holds the itos list,
+the token frequencies (aligned with itos), the index of ``<unk>`` and the build settings, plus the
+number of hash buckets of a ``hashed_vocab.HashedVocab``.
+Loading is O(vocab): the torchtext Vocab is restored directly, without re-sorting the counter.
+"""
+
+VOCAB_FORMAT_VERSION = 1
+
+
+def vocab_path_for(model_path):
+    """ Vocab file saved next to a model checkpoint """
+    return model_path + '.vocab.json'
+
+
+def vocab_fingerprint(vocab):
+    h = hashlib.sha1()
+    for token in vocab.itos:
+        h.update(token.encode('utf-8'))
+        h.update(b'\0')
+    if isinstance(vocab, HashedVocab):
+        h.update('buckets:{}'.format(vocab.num_buckets).encode('utf-8'))
+    return h.hexdigest()
+
+
+def save_vocab(vocab, path, settings=None):
+    """
+    Arguments:
+        vocab: torchtext Vocab.
+        path: json file to write.
+        settings: dict of the tokenization settings the vocab was built with.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    content = {'version': VOCAB_FORMAT_VERSION,
+               'itos': vocab.itos,
+               'freqs': [vocab.freqs.get(token, 0) for token in vocab.itos],
+               'unk_index': vocab.unk_index,
+               'settings': settings or {}}
+    if isinstance(vocab, HashedVocab):
+        content['num_buckets'] = vocab.num_buckets
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def load_vocab(path):
+    """ Restore a Vocab saved by ``save_vocab``, token ids are identical to the saved ones """
+    with open(path, 'r', encoding='utf-8') as f:
+        content = json.load(f)
+    if content.get('version') != VOCAB_FORMAT_VERSION:
+        raise ValueError('unsupported vocab file version {} in {}'.format(content.get('version'), path))
+
+    if 'num_buckets' in content:
+        vocab = HashedVocab.__new__(HashedVocab)
+        vocab.num_buckets = content['num_buckets']
+    else:
+        vocab = Vocab.__new__(Vocab)
+    vocab.itos = content['itos']
+    vocab.freqs = Counter({token: freq for token, freq in zip(vocab.itos, content['freqs']) if freq > 0})
+    vocab.unk_index = content['unk_index']
+    if vocab.unk_index is not None:
+        vocab.stoi = defaultdict(vocab._default_unk_index)
+    else:
+        vocab.stoi = defaultdict()
+    vocab.stoi.update({token: i for i, token in enumerate(vocab.itos)})
+    vocab.vectors = None
+    vocab.settings = content['settings']
+    return vocab
+
+
+def check_embedding(state_dict, vocab, embedding_dim=None, key='embedding_layer.weight'):
+    """ Raise a ValueError if the checkpoint embedding does not match the vocab (and embedding_dim) """
+    keys = [k for k in state_dict if k == key or k.endswith('.' + key)]
+    if not keys:
+        raise ValueError('checkpoint has no {} parameter'.format(key))
+    num_embeddings, dim = state_dict[keys[0]].shape
+    if num_embeddings != len(vocab):
+        raise ValueError('checkpoint embedding has {} rows but the vocab has {} entries, the vocab does not '
+                         'belong to this model'.format(num_embeddings, len(vocab)))
+    if embedding_dim is not None and dim != embedding_dim:
+        raise ValueError('checkpoint embedding dimension is {}, expected {}'.format(dim, embedding_dim))
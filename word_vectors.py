@@ -0,0 +1,191 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torchtext.vocab import Vectors
+from tqdm import tqdm
+
+from token_cache import file_fingerprint
+from vocab_io import load_vocab, vocab_fingerprint
+
+"""
+Pre-trained word vectors (BioWord2Vec) for the embedding layers.
+
+``weight_matrix`` builds the float32 embedding matrix of a vocab in one indexed copy from the
+word2vec matrix: known tokens get their pre-trained row, the others a row of a single seeded
+normal draw. With a ``cache_dir`` the matrix is stored as ``.npy``, keyed by the vocab and the
+vector file, and later launches memory-map it instead of rebuilding it.
+
+The text word2vec file takes minutes to parse, so it can be converted once to a binary store
+(``convert_vectors``, or ``python word_vectors.py``), a directory holding:
+    vectors.npy        float32 matrix, one row per token
+    tokens.json        the tokens, in row order
+``load_vectors`` memory-maps such a store (``MemmapVectors``) and falls back to torchtext
+``Vectors`` for a text file; both are looked up with ``vectors[token]``.
+"""
+
+OOV_SCALE = 0.5
+MATRIX_FILE = 'vectors.npy'
+TOKENS_FILE = 'tokens.json'
+
+
+def _vector_files(vectors_path):
+    if os.path.isdir(vectors_path):
+        return [os.path.join(vectors_path, MATRIX_FILE), os.path.join(vectors_path, TOKENS_FILE)]
+    return [vectors_path]
+
+
+class MemmapVectors(object):
+    """
+    Word vectors converted by ``convert_vectors``, with the lookup semantics of torchtext ``Vectors``:
+    ``vectors[token]`` is the token's row as a float tensor, or ``unk_init`` (zeros) of unknown tokens.
+    The matrix is memory-mapped, only the rows that are looked up are read from disk.
+    """
+
+    def __init__(self, path, unk_init=None):
+        self.path = path
+        with open(os.path.join(path, TOKENS_FILE), 'r', encoding='utf-8') as f:
+            self.itos = json.load(f)
+        self.stoi = {token: i for i, token in enumerate(self.itos)}
+        self.vectors = np.load(os.path.join(path, MATRIX_FILE), mmap_mode='r')
+        self.dim = self.vectors.shape[1]
+        self.unk_init = torch.Tensor.zero_ if unk_init is None else unk_init
+
+    def __getitem__(self, token):
+        if token in self.stoi:
+            return torch.from_numpy(np.array(self.vectors[self.stoi[token]]))
+        return self.unk_init(torch.Tensor(self.dim))
+
+    def __len__(self):
+        return len(self.itos)
+
+    def get_vecs_by_tokens(self, tokens):
+        return torch.stack([self[token] for token in tokens])
+
+
+def load_vectors(word2vec_path):
+    """ A converted store is memory-mapped, a text word2vec file is parsed by torchtext """
+    if os.path.isdir(word2vec_path):
+        return MemmapVectors(word2vec_path)
+    cache, name = os.path.split(word2vec_path)
+    return Vectors(name=name, cache=cache)
+
+
+def _parse_line(line):
+    entries = line.rstrip().split(b' ')
+    return entries[0], entries[1:]
+
+
+def convert_vectors(word2vec_path, save_path, vocab=None):
+    """
+    Convert a text word2vec file to a ``MemmapVectors`` store. Lines are read as torchtext does
+    (header and undecodable tokens are skipped). If ``vocab`` is given only its tokens are kept.
+    Returns the number of tokens written.
+    """
+    keep = set(vocab.itos) if vocab is not None else None
+    # first pass: tokens and dimension, so the matrix can be written straight to disk
+    itos, lines, dim = [], [], None
+    with open(word2vec_path, 'rb') as f:
+        for line_no, line in enumerate(tqdm(f, unit='lines')):
+            word, entries = _parse_line(line)
+            if len(entries) <= 1:
+                continue
+            if dim is None:
+                dim = len(entries)
+            elif len(entries) != dim:
+                raise RuntimeError('vector for token {} has {} dimensions, but previously read vectors have {} '
+                                   'dimensions'.format(word, len(entries), dim))
+            try:
+                word = word.decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            if keep is not None and word not in keep:
+                continue
+            itos.append(word)
+            lines.append(line_no)
+
+    os.makedirs(save_path, exist_ok=True)
+    matrix = np.lib.format.open_memmap(os.path.join(save_path, MATRIX_FILE), mode='w+', dtype=np.float32,
+                                       shape=(len(itos), dim or 0))
+    wanted = iter(lines)
+    row, next_line = 0, next(wanted, None)
+    with open(word2vec_path, 'rb') as f:
+        for line_no, line in enumerate(f):
+            if line_no != next_line:
+                continue
+            matrix[row] = np.array(_parse_line(line)[1], dtype=np.float32)
+            row, next_line = row + 1, next(wanted, None)
+    matrix.flush()
+    del matrix
+    with open(os.path.join(save_path, TOKENS_FILE), 'w', encoding='utf-8') as f:
+        json.dump(itos, f)
+    return len(itos)
+
+
+def _matrix_key(vocab, vectors_path, dim, oov_scale, seed):
+    h = hashlib.sha1()
+    h.update(vocab_fingerprint(vocab).encode('utf-8'))
+    h.update(file_fingerprint(_vector_files(vectors_path)).encode('utf-8'))
+    h.update('{}:{}:{}'.format(dim, oov_scale, seed).encode('utf-8'))
+    return h.hexdigest()
+
+
+def embedding_matrix(vocab, vectors, dim=200, oov_scale=OOV_SCALE, seed=0):
+    """
+    Arguments:
+        vocab: Vocabulary object, row i of the matrix belongs to vocab.itos[i]. Rows past itos (the
+               buckets of a hashed vocab) are drawn at random.
+        vectors: torchtext Vectors (anything with ``stoi`` and a ``vectors`` matrix).
+        oov_scale: standard deviation of the random rows of tokens without a pre-trained vector.
+    Returns:
+        float32 numpy array of shape (len(vocab), dim).
+    """
+    rows = np.full(len(vocab), -1, dtype=np.int64)
+    rows[:len(vocab.itos)] = np.fromiter((vectors.stoi.get(token, -1) for token in vocab.itos), dtype=np.int64,
+                                         count=len(vocab.itos))
+    found = rows >= 0
+    source = vectors.vectors
+    if isinstance(source, torch.Tensor):
+        source = source.numpy()
+    if vectors.dim != dim:
+        raise ValueError('word vectors have dimension {}, expected {}'.format(vectors.dim, dim))
+
+    matrix = np.empty((len(vocab), dim), dtype=np.float32)
+    matrix[found] = source[rows[found]]
+    rng = np.random.RandomState(seed)
+    matrix[~found] = rng.normal(scale=oov_scale, size=(int((~found).sum()), dim))
+    return matrix
+
+
+def weight_matrix(vocab, vectors, dim=200, cache_dir=None, vectors_path=None, oov_scale=OOV_SCALE, seed=0):
+    """ Embedding weights of ``vocab`` as a float32 tensor, cached in ``cache_dir`` if given with ``vectors_path`` """
+    if cache_dir is None or vectors_path is None:
+        return torch.from_numpy(embedding_matrix(vocab, vectors, dim, oov_scale, seed))
+
+    path = os.path.join(cache_dir, 'embedding_' + _matrix_key(vocab, vectors_path, dim, oov_scale, seed) + '.npy')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, embedding_matrix(vocab, vectors, dim, oov_scale, seed))
+        os.replace(tmp_path, path)
+    # copy-on-write mapping: pages are read on demand and the tensor stays writable
+    return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--word2vec_path', help='text word2vec file, e.g. BioWord2Vec_standard.w2v')
+    parser.add_argument('--save_path', help='directory of the converted store')
+    parser.add_argument('--vocab_path', help='only keep the tokens of this vocab file (saved with a model)')
+    args = parser.parse_args()
+
+    vocab = load_vocab(args.vocab_path) if args.vocab_path is not None else None
+    num_tokens = convert_vectors(args.word2vec_path, args.save_path, vocab)
+    print('wrote %d vectors to %s' % (num_tokens, args.save_path))
+
+
+if __name__ == "__main__":
+    main()